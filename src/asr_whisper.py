@@ -1,37 +1,174 @@
-import whisper
-import json
 import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import config
+from model_registry import get_whisper_model
+from extract_audio import AudioBuffer
+from vad import split_on_silence
+from segment_store import save_segments, segments_path
+from metrics import instrument, record
 
 
-def transcribe(audio_path, out_json, model_size="small"):
+# Sample rate Whisper yêu cầu
+WHISPER_SAMPLE_RATE = 16000
+
+# Trạng thái của worker process: (shared_memory, audio, model)
+_worker_state = None
+
+
+def _init_worker(shm_name, length, model_size, threads):
+    """
+    Initializer của worker: map audio dùng chung và load model riêng của process
+    
+    Giới hạn số thread torch để các worker không tranh nhau CPU.
+    """
+    global _worker_state
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    shm = shared_memory.SharedMemory(name=shm_name)
+    audio = np.ndarray((length,), dtype=np.float32, buffer=shm.buf)
+    _worker_state = (shm, audio, get_whisper_model(model_size))
+
+
+def _transcribe_chunk(span):
+    """Worker: nhận dạng một đoạn [start, end) sample, timestamp tính từ đầu đoạn"""
+    _, audio, model = _worker_state
+    start, end = span
+    result = model.transcribe(
+        np.array(audio[start:end]),
+        fp16=False,
+        language=config.WHISPER_LANGUAGE,
+        verbose=False
+    )
+    return [(seg["start"], seg["end"], seg["text"]) for seg in result["segments"]]
+
+
+def _load_samples(audio_path):
+    """Audio dạng float32 16kHz cho Whisper (decode file bằng whisper nếu chưa có)"""
+    if isinstance(audio_path, AudioBuffer):
+        if audio_path.sample_rate != WHISPER_SAMPLE_RATE:
+            raise ValueError(f"Whisper cần audio 16kHz, nhận {audio_path.sample_rate}Hz")
+        return audio_path.samples
+    import whisper
+    return whisper.load_audio(audio_path)
+
+
+def transcribe_long_form(samples, model_size, workers, chunk_seconds=None):
+    """
+    Nhận dạng audio dài: chia tại khoảng lặng, chạy song song nhiều process
+    
+    Mỗi worker giữ một Whisper model riêng và đọc audio từ shared memory.
+    Segment của từng đoạn được cộng offset về timestamp toàn cục.
+    
+    Args:
+        samples: Mảng float32 16kHz
+        model_size: Kích thước Whisper model
+        workers: Số process
+        chunk_seconds: Độ dài mong muốn mỗi đoạn (mặc định: config.ASR_CHUNK_SECONDS)
+    
+    Returns:
+        List (start, end, text) theo thứ tự thời gian
+    """
+    chunk_seconds = chunk_seconds or config.ASR_CHUNK_SECONDS
+    spans = split_on_silence(samples, WHISPER_SAMPLE_RATE, target_seconds=chunk_seconds)
+    workers = max(1, min(workers, len(spans)))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    print(f"   ✂️ Chia {len(samples) / WHISPER_SAMPLE_RATE:.0f}s audio thành {len(spans)} đoạn "
+          f"tại khoảng lặng, {workers} process × {threads} thread")
+    
+    samples = np.ascontiguousarray(samples, dtype=np.float32)
+    shm = shared_memory.SharedMemory(create=True, size=max(samples.nbytes, 1))
+    try:
+        view = np.ndarray(samples.shape, dtype=np.float32, buffer=shm.buf)
+        view[:] = samples
+        del view
+        
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(shm.name, len(samples), model_size, threads)
+        ) as pool:
+            chunk_results = list(pool.map(_transcribe_chunk, spans))
+    finally:
+        shm.close()
+        shm.unlink()
+    
+    # Ghép lại theo thời gian toàn cục, không để segment vượt quá đoạn của nó
+    stitched = []
+    for (start, end), segments in zip(spans, chunk_results):
+        offset = start / WHISPER_SAMPLE_RATE
+        limit = end / WHISPER_SAMPLE_RATE
+        for seg_start, seg_end, text in segments:
+            stitched.append((
+                round(min(offset + seg_start, limit), 3),
+                round(min(offset + seg_end, limit), 3),
+                text
+            ))
+        print(f"   ✅ Đoạn {offset:.0f}s - {limit:.0f}s: {len(segments)} câu")
+    return stitched
+
+
+@instrument("asr")
+def transcribe(audio_path, out_json, model_size="small", model=None, workers=None):
     """
     Nhận dạng giọng nói bằng Whisper
     
     Args:
-        audio_path: Đường dẫn audio input
-        out_json: Đường dẫn JSON output chứa segments
+        audio_path: Đường dẫn audio input hoặc AudioBuffer 16kHz (không đọc lại file)
+        out_json: Đường dẫn JSON output chứa segments hoặc SegmentStore
         model_size: Kích thước model (tiny, base, small, medium, large)
+        model: Whisper model đã load (mặc định: lấy từ model_registry, load một lần mỗi process)
+        workers: Số process cho audio dài (mặc định: config.ASR_WORKERS); > 1 thì audio dài
+                 hơn config.ASR_LONG_FORM_MIN_SECONDS được chia tại khoảng lặng và
+                 nhận dạng song song, mỗi process một model (bỏ qua tham số model)
     """
-    print(f"🎤 Đang nhận dạng giọng nói với Whisper model '{model_size}'...")
+    if workers is None:
+        workers = config.ASR_WORKERS
     
-    # Tạo thư mục nếu chưa tồn tại
-    os.makedirs(os.path.dirname(out_json), exist_ok=True)
+    print(f"🎤 Đang nhận dạng giọng nói với Whisper model '{model_size}'...")
     
     try:
-        # Load model (fp16=False để chạy trên CPU)
-        model = whisper.load_model(model_size)
+        # Audio dài + nhiều process: chia tại khoảng lặng và nhận dạng song song
+        samples = None
+        if workers > 1:
+            samples = _load_samples(audio_path)
         
-        # Transcribe với timestamp chi tiết
-        result = model.transcribe(
-            audio_path,
-            fp16=False,  # CPU mode
-            language="en",  # Có thể để None để auto-detect
-            verbose=True
-        )
+        long_form = samples is not None and len(samples) / WHISPER_SAMPLE_RATE > config.ASR_LONG_FORM_MIN_SECONDS
+        if long_form:
+            stitched = transcribe_long_form(samples, model_size, workers)
+            # id liên tục trên toàn bộ audio
+            raw_segments = [
+                {"id": k, "start": start, "end": end, "text": text}
+                for k, (start, end, text) in enumerate(stitched)
+            ]
+        else:
+            # Load model (fp16=False để chạy trên CPU), dùng lại nếu đã load
+            if model is None:
+                model = get_whisper_model(model_size)
+            
+            # Audio đã decode trong bộ nhớ: Whisper nhận thẳng mảng float32 16kHz
+            audio = audio_path
+            if samples is not None:
+                audio = samples
+            elif isinstance(audio_path, AudioBuffer):
+                audio = _load_samples(audio_path)
+            
+            # Transcribe với timestamp chi tiết
+            result = model.transcribe(
+                audio,
+                fp16=False,  # CPU mode
+                language="en",  # Có thể để None để auto-detect
+                verbose=True
+            )
+            raw_segments = result["segments"]
         
         # Lưu segments với timestamp
         segments_data = []
-        for seg in result["segments"]:
+        for seg in raw_segments:
             segments_data.append({
                 "id": seg["id"],
                 "start": seg["start"],
@@ -40,13 +177,14 @@ def transcribe(audio_path, out_json, model_size="small"):
                 "vi_text": ""  # Sẽ được điền ở bước translate
             })
         
-        with open(out_json, "w", encoding="utf-8") as f:
-            json.dump(segments_data, f, ensure_ascii=False, indent=2)
+        # Nhận dạng lại tạo danh sách câu mới: thay toàn bộ (kể cả trong store)
+        save_segments(out_json, segments_data)
         
         print(f"✅ Nhận dạng hoàn tất: {len(segments_data)} câu")
-        print(f"📄 Kết quả lưu tại: {out_json}")
+        record(segments=len(segments_data), long_form=long_form)
+        print(f"📄 Kết quả lưu tại: {segments_path(out_json)}")
         return True
-        
+    
     except Exception as e:
         print(f"❌ Lỗi khi nhận dạng: {e}")
         return False
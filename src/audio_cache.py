@@ -0,0 +1,196 @@
+"""
+Audio Cache
+Cache audio TTS theo nội dung (content-addressed) để không tổng hợp lại
+những câu đã có: cùng text, giọng, rate, pitch, volume và backend
+"""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+
+import config
+
+
+def default_cache_dir():
+    """Thư mục mặc định của cache audio TTS (trong thư mục cache của project)"""
+    base_dir = Path(__file__).parent.parent
+    return str(base_dir / config.CACHE_DIR / "tts_audio")
+
+
+def make_audio_key(**fields):
+    """
+    Tạo key từ các tham số quyết định nội dung audio
+    
+    Ví dụ: make_audio_key(text=..., voice=..., rate=..., pitch=..., volume=..., backend=...)
+    
+    Returns:
+        SHA-256 hex digest
+    """
+    payload = json.dumps(fields, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def link_or_copy(src, dst):
+    """
+    Hard-link src sang dst, copy nếu không link được (khác ổ đĩa, FS không hỗ trợ)
+    
+    dst cũ (nếu có) bị thay thế bằng os.replace để không ghi đè lên inode
+    đang được chia sẻ với cache.
+    """
+    dst_dir = os.path.dirname(dst) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=dst_dir, suffix=".tmp")
+    os.close(fd)
+    os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+class AudioCache:
+    """
+    Cache file audio theo hash nội dung
+    
+    - File lưu tại <cache_dir>/<2 ký tự đầu>/<hash><ext>
+    - Cache hit được hard-link vào thư mục output (không tốn dung lượng)
+    - Giới hạn tổng dung lượng, loại bỏ theo LRU; thời điểm dùng gần nhất lưu
+      trong index SQLite của cache, không chạm vào file audio (inode được
+      hard-link ra output, đổi mtime sẽ làm fingerprint của clip thay đổi)
+    - Dùng chung được giữa nhiều lần chạy: ghi file qua tên tạm + os.replace
+    """
+    
+    def __init__(self, cache_dir=None, max_bytes=None, ext=".mp3"):
+        """
+        Args:
+            cache_dir: Thư mục cache (mặc định: cache/tts_audio)
+            max_bytes: Dung lượng tối đa (mặc định: config.TTS_CACHE_MAX_MB)
+            ext: Phần mở rộng file audio
+        """
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes if max_bytes is not None else config.TTS_CACHE_MAX_MB * 1024 * 1024
+        self.ext = ext
+        self.hits = 0
+        self.misses = 0
+        
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(self.cache_dir, "access.sqlite"), timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS access ("
+            " key TEXT PRIMARY KEY,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self._size = sum(size for _, size, _ in self._entries())
+    
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + self.ext)
+    
+    def _touch(self, key):
+        """Ghi nhận key vừa được dùng (cho LRU)"""
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO access (key, last_access) VALUES (?, ?)",
+                (key, time.time())
+            )
+    
+    def _entries(self):
+        """Liệt kê (path, size, mtime) của tất cả file trong cache"""
+        entries = []
+        for sub in os.scandir(self.cache_dir):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.is_file() and entry.name.endswith(self.ext):
+                    st = entry.stat()
+                    entries.append((entry.path, st.st_size, st.st_mtime))
+        return entries
+    
+    def contains(self, key):
+        """Kiểm tra key có trong cache (không tính vào hit/miss)"""
+        return os.path.exists(self._path(key))
+    
+    def fetch(self, key, dst):
+        """
+        Lấy audio từ cache ra dst
+        
+        Returns:
+            True nếu hit (dst đã được tạo), False nếu miss
+        """
+        path = self._path(key)
+        try:
+            link_or_copy(path, dst)
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+        
+        self._touch(key)
+        self.hits += 1
+        return True
+    
+    def store(self, key, src):
+        """
+        Đưa file audio src vào cache
+        
+        Args:
+            key: Key từ make_audio_key
+            src: File audio vừa tổng hợp (vẫn giữ nguyên sau khi store)
+        """
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        link_or_copy(src, path)
+        self._touch(key)
+        self._size += os.path.getsize(path)
+        if self.max_bytes and self._size > self.max_bytes:
+            self.evict()
+    
+    def evict(self):
+        """
+        Xóa các file ít được dùng nhất cho đến khi dưới giới hạn dung lượng
+        
+        File chưa có trong index (cache cũ) lấy mtime làm thời điểm dùng gần nhất.
+        
+        Returns:
+            Số file đã xóa
+        """
+        last_access = dict(self._conn.execute("SELECT key, last_access FROM access"))
+        
+        def recency(entry):
+            key = os.path.basename(entry[0])[:-len(self.ext)]
+            return last_access.get(key, entry[2])
+        
+        entries = sorted(self._entries(), key=recency)
+        total = sum(size for _, size, _ in entries)
+        removed = []
+        for path, size, _ in entries:
+            if not self.max_bytes or total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed.append(os.path.basename(path)[:-len(self.ext)])
+        if removed:
+            with self._conn:
+                self._conn.executemany("DELETE FROM access WHERE key = ?", [(key,) for key in removed])
+        self._size = total
+        return len(removed)
+    
+    def stats(self):
+        """Thống kê hit/miss của phiên hiện tại và kích thước cache"""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "bytes": self._size
+        }
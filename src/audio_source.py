@@ -0,0 +1,196 @@
+"""
+Audio Source
+Mở file audio gốc một lần và cắt segment theo thời gian mà không decode
+lại cả file (WAV PCM được memory-map trực tiếp)
+"""
+import os
+import struct
+
+import numpy as np
+from pydub import AudioSegment
+
+from extract_audio import AudioBuffer
+from timeline_mixer import SAMPLE_DTYPES, WAV_8BIT_OFFSET
+
+
+# WAVE format tags
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# dtype tương ứng với sample width của PCM little-endian trong file WAV
+# (8-bit không dấu; AudioSegment giữ 8-bit dạng có dấu, xem timeline_mixer)
+PCM_DTYPES = {1: np.uint8, 2: np.dtype("<i2"), 4: np.dtype("<i4")}
+
+
+def parse_wav_header(path):
+    """
+    Đọc header RIFF/WAVE để lấy thông số và vị trí chunk data
+    
+    Returns:
+        dict (format_tag, channels, frame_rate, sample_width, data_offset, data_size)
+        hoặc None nếu không phải WAV đọc được
+    """
+    file_size = os.path.getsize(path)
+    info = {}
+    with open(path, "rb") as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+            return None
+        
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            chunk_id, chunk_size = struct.unpack("<4sI", header)
+            
+            if chunk_id == b"fmt ":
+                fmt = f.read(chunk_size)
+                format_tag, channels, frame_rate, _, _, bits = struct.unpack("<HHIIHH", fmt[:16])
+                if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+                    format_tag = struct.unpack("<H", fmt[24:26])[0]
+                info.update(
+                    format_tag=format_tag,
+                    channels=channels,
+                    frame_rate=frame_rate,
+                    sample_width=bits // 8
+                )
+                f.seek(chunk_size % 2, os.SEEK_CUR)
+            elif chunk_id == b"data":
+                if "format_tag" not in info:
+                    return None
+                data_offset = f.tell()
+                # ffmpeg ghi dạng stream có thể để size = 0xFFFFFFFF
+                info["data_offset"] = data_offset
+                info["data_size"] = min(chunk_size, file_size - data_offset)
+                return info
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+
+class AudioSource:
+    """
+    Nguồn audio dùng chung cho nhiều segment
+    
+    - WAV PCM (8/16/32-bit): memory-map phần data, mỗi lần cắt chỉ đọc
+      đúng đoạn cần thiết
+    - AudioBuffer (audio gốc đã decode trong bộ nhớ): cắt trực tiếp, đổi
+      từng đoạn về int16
+    - Định dạng khác: decode một lần bằng pydub rồi cắt trong bộ nhớ
+    
+    Cắt theo millisecond với cùng cách làm tròn như AudioSegment[start_ms:end_ms]
+    nên kết quả trùng từng sample với cách cũ.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._audio = None
+        self._samples = None
+        self._buffer = None
+        
+        if isinstance(path, AudioBuffer):
+            self._buffer = path
+            self.path = path.path
+            self.frame_rate = path.sample_rate
+            self.channels = 1
+            self.sample_width = 2
+            return
+        
+        info = parse_wav_header(path)
+        if info and info["format_tag"] == WAVE_FORMAT_PCM and info["sample_width"] in PCM_DTYPES:
+            self.frame_rate = info["frame_rate"]
+            self.channels = info["channels"]
+            self.sample_width = info["sample_width"]
+            n_frames = info["data_size"] // (self.sample_width * self.channels)
+            self._samples = np.memmap(
+                path,
+                dtype=PCM_DTYPES[self.sample_width],
+                mode="r",
+                offset=info["data_offset"],
+                shape=(n_frames, self.channels)
+            )
+        else:
+            self._audio = AudioSegment.from_file(path)
+            self.frame_rate = self._audio.frame_rate
+            self.channels = self._audio.channels
+            self.sample_width = self._audio.sample_width
+    
+    @property
+    def frame_count(self):
+        if self._buffer is not None:
+            return len(self._buffer.samples)
+        if self._samples is not None:
+            return self._samples.shape[0]
+        return int(self._audio.frame_count())
+    
+    @property
+    def duration(self):
+        """Độ dài (giây)"""
+        return self.frame_count / self.frame_rate
+    
+    def __len__(self):
+        """Độ dài (ms), giống len(AudioSegment)"""
+        return round(1000 * self.frame_count / self.frame_rate)
+    
+    def _frame_index(self, ms):
+        return int(min(ms, len(self)) * self.frame_rate / 1000.0)
+    
+    def samples(self, start_ms, end_ms):
+        """
+        Mảng sample của đoạn [start_ms, end_ms), shape (n_frames, channels)
+        
+        Sample theo layout của file WAV (PCM_DTYPES, 8-bit không dấu). Với WAV
+        memory-map và audio 16/32-bit đã decode bằng pydub đây là view, không
+        copy dữ liệu.
+        """
+        if self._buffer is not None:
+            start = self._frame_index(start_ms)
+            return self._buffer.to_pcm16(start, self._frame_index(end_ms)).reshape(-1, 1)
+        if self._samples is None:
+            # Định dạng khác: view trên raw_data của pydub (8-bit đổi về không dấu như WAV)
+            samples = np.frombuffer(self._audio.raw_data, dtype=SAMPLE_DTYPES[self.sample_width])
+            if self.sample_width == 1:
+                samples = (samples.astype(np.int16) + WAV_8BIT_OFFSET).astype(np.uint8)
+            self._samples = samples.reshape(-1, self.channels)
+        return self._samples[self._frame_index(start_ms):self._frame_index(end_ms)]
+    
+    def segment_ms(self, start_ms, end_ms):
+        """Cắt đoạn [start_ms, end_ms) thành pydub AudioSegment"""
+        if self._audio is not None:
+            return self._audio[start_ms:end_ms]
+        
+        start = self._frame_index(start_ms)
+        end = self._frame_index(end_ms)
+        if self._buffer is not None:
+            data = self._buffer.to_pcm16(start, end).reshape(-1, 1)
+        else:
+            data = np.asarray(self._samples[start:end])
+            if self.sample_width == 1:
+                # WAV 8-bit không dấu → dạng có dấu của AudioSegment (như pydub khi đọc WAV)
+                data = (data.astype(np.int16) - WAV_8BIT_OFFSET).astype(np.int8)
+        # Bù frame thiếu do làm tròn ở cuối file bằng silence (giống pydub)
+        missing = (end - start) - data.shape[0]
+        if missing > 0:
+            data = np.concatenate([data, np.zeros((missing, self.channels), dtype=data.dtype)])
+        
+        return AudioSegment(
+            data=data.tobytes(),
+            sample_width=self.sample_width,
+            frame_rate=self.frame_rate,
+            channels=self.channels
+        )
+    
+    def segment(self, start_time, end_time):
+        """Cắt đoạn theo giây (làm tròn về ms như extract_segment_audio)"""
+        return self.segment_ms(int(start_time * 1000), int(end_time * 1000))
+    
+    def close(self):
+        """Bỏ tham chiếu tới memory map / audio đã decode"""
+        self._samples = None
+        self._audio = None
+        self._buffer = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,401 @@
+"""
+Lồng tiếng hàng loạt
+Xử lý cả thư mục (hoặc manifest) video theo kiểu dây chuyền: video N+1
+nhận dạng giọng nói trong khi video N đang TTS và video N-1 đang ghép video
+
+Mỗi bước có giới hạn số video chạy đồng thời riêng (ASR/dịch tốn CPU,
+TTS chờ mạng, ghép audio/video chờ I/O). Mỗi video có thư mục làm việc
+riêng nên các video chạy song song không ghi đè file của nhau.
+
+Chạy: python batch_dub.py <thư_mục_video | manifest.txt | manifest.json> [-o output]
+"""
+
+import argparse
+import heapq
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from extract_audio import extract_audio, extract_audio_buffer
+from asr_whisper import transcribe
+from voice_analysis import analyze_all_segments, VOICE_FIELDS
+from translate import translate_segments
+from tts_advanced import tts_segments_advanced
+from merge_audio import merge_segments
+from merge_video import merge_video, merge_segments_to_video
+from model_registry import get_registry
+from segment_store import SegmentStore
+from utils import format_time
+from metrics import labels
+import config
+
+
+VIDEO_EXTENSIONS = ['.mp4', '.avi', '.mkv', '.mov', '.wmv', '.flv', '.webm']
+
+
+class StageGate:
+    """
+    Giới hạn số video chạy đồng thời trong một bước
+    
+    Khi có chỗ trống, video đứng trước trong danh sách được vào trước
+    (để dây chuyền giữ đúng thứ tự N-1, N, N+1).
+    """
+    
+    def __init__(self, limit):
+        self.limit = max(1, limit)
+        self.active = 0
+        self._waiting = []  # heap thứ tự video đang chờ
+        self._cond = threading.Condition()
+    
+    def acquire(self, order):
+        with self._cond:
+            heapq.heappush(self._waiting, order)
+            while self.active >= self.limit or self._waiting[0] != order:
+                self._cond.wait()
+            heapq.heappop(self._waiting)
+            self.active += 1
+    
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+
+def job_paths(input_video, work_dir, output_video=None):
+    """
+    Các đường dẫn của một video, tất cả nằm trong work_dir riêng
+    
+    Cùng bố cục với main.py (audio/, subtitles/) nhưng không dùng chung
+    giữa các video.
+    """
+    work_dir = Path(work_dir)
+    audio_dir = work_dir / config.AUDIO_DIR
+    subtitles_dir = work_dir / config.SUBTITLES_DIR
+    return {
+        "input_video": Path(input_video),
+        "output_video": Path(output_video) if output_video else work_dir / f"{Path(input_video).stem}_vi.mp4",
+        "work_dir": work_dir,
+        "original_audio": audio_dir / "original.wav",
+        "vi_full_audio": audio_dir / "vi_full.wav",
+        "vi_segments_dir": audio_dir / "vi_segments",
+        "en_json": subtitles_dir / "en.json",
+        "vi_json": subtitles_dir / "vi.json",
+        "segments_db": subtitles_dir / "segments.sqlite"
+    }
+
+
+def extract_job_audio(paths):
+    """
+    Tách audio gốc của một video
+    
+    Với config.AUDIO_IN_MEMORY, audio được giữ trong paths["audio"] để các
+    bước sau dùng chung (WAV chỉ ghi khi KEEP_INTERMEDIATE_FILES).
+    """
+    if not config.AUDIO_IN_MEMORY:
+        return extract_audio(str(paths["input_video"]), str(paths["original_audio"]))
+    buffer = extract_audio_buffer(
+        str(paths["input_video"]),
+        str(paths["original_audio"]) if config.KEEP_INTERMEDIATE_FILES else None
+    )
+    paths["audio"] = buffer
+    return buffer is not None
+
+
+def original_audio(paths):
+    """Audio gốc cho các bước sau: AudioBuffer nếu có, ngược lại file WAV"""
+    return paths.get("audio") or str(paths["original_audio"])
+
+
+def job_segments(paths, json_key):
+    """
+    Segments của một video cho các bước
+    
+    Với config.SEGMENT_STORE_ENABLED, mọi bước dùng chung một SegmentStore
+    (mỗi bước chỉ đọc/cập nhật cột của mình, không ghi lại cả file JSON);
+    en.json/vi.json được export khi video xong. Ngược lại là file JSON.
+    """
+    if not config.SEGMENT_STORE_ENABLED:
+        return str(paths[json_key])
+    if "segments" not in paths:
+        paths["segments"] = SegmentStore(paths["segments_db"])
+    return paths["segments"]
+
+
+def export_job_segments(paths):
+    """Export store ra en.json/vi.json (định dạng cũ) và đóng store"""
+    store = paths.pop("segments", None)
+    if store is None:
+        return
+    try:
+        if store.count():
+            store.export_json(paths["en_json"], columns=["id", "start", "end", "text", "vi_text"] + VOICE_FIELDS)
+            store.export_json(paths["vi_json"])
+    except OSError as e:
+        print(f"⚠️ Không export được segments: {e}")
+    finally:
+        store.close()
+
+
+def build_stages(model_size):
+    """
+    Các bước của pipeline: (key, tên, hàm(paths) -> bool, bắt buộc)
+    
+    Bước không bắt buộc lỗi thì vẫn đi tiếp (giống main.py).
+    """
+    stages = [
+        ("extract", "Tách audio", extract_job_audio, True),
+        ("asr", "Nhận dạng giọng nói",
+         lambda p: transcribe(original_audio(p), job_segments(p, "en_json"), model_size=model_size), True),
+        ("analyze", "Phân tích giọng nói",
+         lambda p: analyze_all_segments(original_audio(p), job_segments(p, "en_json")), False),
+        ("translate", "Dịch sang tiếng Việt",
+         lambda p: translate_segments(job_segments(p, "en_json"), job_segments(p, "vi_json")), True),
+        ("tts", "Tổng hợp giọng nói",
+         lambda p: tts_segments_advanced(job_segments(p, "vi_json"), original_audio(p), str(p["vi_segments_dir"]),
+                                         auto_voice=True, enable_mixing=True), True),
+        ("merge", "Ghép audio segments",
+         lambda p: merge_segments(job_segments(p, "vi_json"), str(p["vi_full_audio"])), True),
+        ("mux", "Ghép audio vào video",
+         lambda p: merge_video(str(p["input_video"]), str(p["vi_full_audio"]), str(p["output_video"])), True)
+    ]
+    if config.MUX_STREAMING:
+        # Ghép audio thẳng vào ffmpeg, không ghi vi_full.wav
+        stages[-2:] = [
+            ("mux", "Ghép audio segments và ghép vào video",
+             lambda p: merge_segments_to_video(job_segments(p, "vi_json"), str(p["input_video"]),
+                                               str(p["output_video"])), True)
+        ]
+    return stages
+
+
+def load_manifest(source):
+    """
+    Danh sách video cần xử lý
+    
+    Args:
+        source: Thư mục (lấy mọi file video, sắp xếp theo tên), file .txt
+                (mỗi dòng một đường dẫn, # là comment) hoặc .json (list
+                đường dẫn hoặc {"input": ..., "output": ...})
+    
+    Returns:
+        List (input_video, output_video hoặc None)
+    """
+    source = Path(source)
+    if source.is_dir():
+        return [(p, None) for p in sorted(source.iterdir())
+                if p.is_file() and p.suffix.lower() in VIDEO_EXTENSIONS]
+    
+    base = source.parent
+    if source.suffix.lower() == ".json":
+        with open(source, encoding="utf-8") as f:
+            entries = json.load(f)
+        videos = []
+        for entry in entries:
+            if isinstance(entry, str):
+                videos.append((base / entry, None))
+            else:
+                output = entry.get("output")
+                videos.append((base / entry["input"], base / output if output else None))
+        return videos
+    
+    with open(source, encoding="utf-8") as f:
+        lines = [line.strip() for line in f]
+    return [(base / line, None) for line in lines if line and not line.startswith("#")]
+
+
+def plan_jobs(videos, output_dir):
+    """Gán thư mục làm việc riêng cho từng video (tên trùng thì thêm hậu tố)"""
+    jobs = []
+    used = set()
+    for input_video, output_video in videos:
+        name = Path(input_video).stem
+        k = 2
+        while name in used:
+            name = f"{Path(input_video).stem}_{k}"
+            k += 1
+        used.add(name)
+        jobs.append({
+            "name": name,
+            "paths": job_paths(input_video, Path(output_dir) / name, output_video),
+            "status": "pending",
+            "failed_stage": None,
+            "stage_seconds": {}
+        })
+    return jobs
+
+
+def run_job(order, job, stages, gates):
+    """Chạy lần lượt các bước của một video, mỗi bước chờ gate của bước đó"""
+    paths = job["paths"]
+    if not paths["input_video"].exists():
+        print(f"❌ [{job['name']}] Không tìm thấy video: {paths['input_video']}")
+        job["status"] = "failed"
+        return job
+    
+    for key, name, func, required in stages:
+        gates[key].acquire(order)
+        try:
+            print(f"\n▶️ [{job['name']}] {name}")
+            t0 = time.perf_counter()
+            try:
+                with labels(video=job["name"]):
+                    ok = func(paths)
+            except Exception as e:
+                print(f"❌ [{job['name']}] Lỗi {name}: {e}")
+                ok = False
+            job["stage_seconds"][key] = round(time.perf_counter() - t0, 3)
+        finally:
+            gates[key].release()
+        
+        if key == "tts":
+            paths.pop("audio", None)  # Các bước sau không cần audio gốc, giải phóng bộ nhớ
+        if key in ("merge", "mux"):
+            export_job_segments(paths)  # Bước ghép video không cần segments
+        
+        if not ok:
+            if required:
+                paths.pop("audio", None)
+                export_job_segments(paths)
+                job["status"] = "failed"
+                job["failed_stage"] = key
+                print(f"❌ [{job['name']}] Dừng tại bước: {name}")
+                return job
+            print(f"⚠️ [{job['name']}] Lỗi {name}, tiếp tục")
+    
+    job["status"] = "done"
+    print(f"✅ [{job['name']}] Hoàn thành: {paths['output_video']}")
+    return job
+
+
+def run_batch(videos, output_dir, model_size=None, max_in_flight=None, stage_limits=None):
+    """
+    Lồng tiếng nhiều video theo dây chuyền
+    
+    Args:
+        videos: List (input_video, output_video hoặc None) từ load_manifest
+        output_dir: Thư mục chứa thư mục làm việc của từng video
+        model_size: Whisper model (mặc định: config.WHISPER_MODEL_SIZE)
+        max_in_flight: Số video xử lý cùng lúc (mặc định: config.BATCH_MAX_IN_FLIGHT)
+        stage_limits: dict bước -> số video đồng thời (mặc định: config.BATCH_STAGE_CONCURRENCY)
+    
+    Returns:
+        List kết quả từng video (name, status, failed_stage, stage_seconds, ...)
+    """
+    model_size = model_size or config.WHISPER_MODEL_SIZE
+    max_in_flight = max_in_flight or config.BATCH_MAX_IN_FLIGHT
+    limits = dict(config.BATCH_STAGE_CONCURRENCY, **(stage_limits or {}))
+    
+    stages = build_stages(model_size)
+    gates = {key: StageGate(limits.get(key, 1)) for key, _, _, _ in stages}
+    jobs = plan_jobs(videos, output_dir)
+    
+    print(f"🎬 Lồng tiếng {len(jobs)} video, tối đa {max_in_flight} video cùng lúc")
+    print("📊 Giới hạn mỗi bước: " + ", ".join(f"{key}={gates[key].limit}" for key in gates))
+    
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        futures = [pool.submit(run_job, order, job, stages, gates) for order, job in enumerate(jobs)]
+        for future in futures:
+            future.result()
+    elapsed = time.perf_counter() - t0
+    
+    done = sum(1 for job in jobs if job["status"] == "done")
+    print("\n" + "=" * 60)
+    print(f"🎉 Xong {done}/{len(jobs)} video trong {format_time(elapsed)}")
+    for job in jobs:
+        mark = "✅" if job["status"] == "done" else "❌"
+        total = sum(job["stage_seconds"].values())
+        print(f"   {mark} {job['name']}: {total:.1f}s" +
+              (f" (lỗi ở bước {job['failed_stage']})" if job["failed_stage"] else ""))
+    for key, stats in get_registry().stats().items():
+        print(f"   📦 {key}: load {stats['loads']} lần ({stats['load_seconds']:.1f}s), dùng lại {stats['hits']} lần")
+    
+    # Báo cáo
+    report = [
+        {
+            "name": job["name"],
+            "input_video": str(job["paths"]["input_video"]),
+            "output_video": str(job["paths"]["output_video"]),
+            "status": job["status"],
+            "failed_stage": job["failed_stage"],
+            "stage_seconds": job["stage_seconds"]
+        }
+        for job in jobs
+    ]
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    report_path = Path(output_dir) / "batch_report.json"
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"📄 Báo cáo: {report_path}")
+    
+    return report
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(
+        description='🎬 Lồng tiếng hàng loạt - Vietnamese Auto Dubbing (batch)'
+    )
+    
+    parser.add_argument(
+        'source',
+        help='Thư mục chứa video, hoặc manifest (.txt mỗi dòng một video, .json)'
+    )
+    
+    parser.add_argument(
+        '-o', '--output-dir',
+        help='Thư mục output, mỗi video một thư mục con (mặc định: output/batch)'
+    )
+    
+    parser.add_argument(
+        '-m', '--model',
+        choices=['tiny', 'base', 'small', 'medium', 'large'],
+        default=config.WHISPER_MODEL_SIZE,
+        help=f'Kích thước Whisper model (mặc định: {config.WHISPER_MODEL_SIZE})'
+    )
+    
+    parser.add_argument(
+        '-j', '--in-flight',
+        type=int,
+        default=config.BATCH_MAX_IN_FLIGHT,
+        help=f'Số video xử lý cùng lúc (mặc định: {config.BATCH_MAX_IN_FLIGHT})'
+    )
+    
+    parser.add_argument(
+        '--limit',
+        action='append',
+        default=[],
+        metavar='BƯỚC=N',
+        help='Giới hạn đồng thời của một bước, vd: --limit tts=4 --limit asr=1'
+    )
+    
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    
+    stage_limits = {}
+    for item in args.limit:
+        key, _, value = item.partition("=")
+        if key not in config.BATCH_STAGE_CONCURRENCY or not value.isdigit():
+            print(f"❌ Giới hạn không hợp lệ: {item} (các bước: {', '.join(config.BATCH_STAGE_CONCURRENCY)})")
+            return False
+        stage_limits[key] = int(value)
+    
+    videos = load_manifest(args.source)
+    if not videos:
+        print(f"❌ Không tìm thấy video nào trong: {args.source}")
+        return False
+    
+    output_dir = Path(args.output_dir) if args.output_dir else Path(__file__).parent.parent / config.OUTPUT_DIR / "batch"
+    report = run_batch(videos, output_dir, args.model, args.in_flight, stage_limits)
+    return all(job["status"] == "done" for job in report)
+
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
@@ -0,0 +1,517 @@
+"""
+Bộ micro-benchmark cho các đoạn xử lý audio/text chạy nhiều nhất
+Tự sinh input giả lập (WAV sine/noise, JSON hàng nghìn segment, clip TTS
+giả), đo từng kernel ở nhiều quy mô, so với baseline đã lưu
+
+Chạy hoàn toàn offline, không tải model. Kernel cần ffmpeg (xuất mp3) tự
+bỏ qua nếu máy không có ffmpeg.
+
+Chạy:
+    python bench_suite.py --save-baseline          # đo và lưu baseline
+    python bench_suite.py                          # đo và so với baseline
+    python bench_suite.py --scales small medium --threshold 0.3 -k merge
+
+Thoát với mã 1 nếu có kernel chậm hơn baseline quá ngưỡng.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import wave
+from pathlib import Path
+
+import numpy as np
+from pydub import AudioSegment
+
+import config
+
+
+SCALES = ["small", "medium", "large"]
+
+# Thời lượng audio (giây) và số segment/dòng text của từng quy mô
+AUDIO_SECONDS = {"small": 5, "medium": 60, "large": 600}
+SEGMENT_COUNTS = {"small": 50, "medium": 500, "large": 3000}
+TEXT_LINES = {"small": 1000, "medium": 10000, "large": 100000}
+
+DEFAULT_BASELINE = Path(__file__).parent.parent / "bench_baseline.json"
+
+# Số clip TTS giả khác nhau (các segment dùng lại theo vòng)
+N_FAKE_CLIPS = 24
+
+
+def write_wav(path, y, sr):
+    """Ghi mảng float [-1, 1] ra WAV 16-bit mono"""
+    with wave.open(str(path), "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(sr)
+        wf.writeframes((np.clip(y, -1, 1) * 32767).astype(np.int16).tobytes())
+
+
+def make_signal(seconds, sr=16000, kind="voice", seed=0):
+    """
+    Tín hiệu giả lập
+    
+    Args:
+        kind: "sine" (một tần số), "noise" (white noise) hoặc "voice"
+              (chuỗi hài âm đổi f0 mỗi 2s + noise, gần giọng nói hơn)
+    """
+    rng = np.random.default_rng(seed)
+    n = int(seconds * sr)
+    t = np.arange(n) / sr
+    if kind == "sine":
+        return 0.3 * np.sin(2 * np.pi * 220 * t)
+    if kind == "noise":
+        return 0.1 * rng.standard_normal(n)
+    f0 = np.repeat(rng.uniform(90, 260, size=n // (2 * sr) + 1), 2 * sr)[:n]
+    phase = 2 * np.pi * np.cumsum(f0) / sr
+    y = sum(np.sin(h * phase) / h for h in range(1, 4)) * 0.2
+    return y + 0.01 * rng.standard_normal(n)
+
+
+def make_audio_segment(seconds, sr=24000, kind="voice", seed=0):
+    y = make_signal(seconds, sr, kind, seed)
+    return AudioSegment(
+        data=(np.clip(y, -1, 1) * 32767).astype(np.int16).tobytes(),
+        sample_width=2,
+        frame_rate=sr,
+        channels=1
+    )
+
+
+def make_fake_clips(clip_dir, n=N_FAKE_CLIPS, sr=24000):
+    """Clip TTS giả (WAV 1-2.5s), trả về list đường dẫn"""
+    os.makedirs(clip_dir, exist_ok=True)
+    paths = []
+    for k in range(n):
+        path = os.path.join(clip_dir, f"clip_{k:03d}.wav")
+        write_wav(path, make_signal(1.0 + 1.5 * k / n, sr, "voice", seed=k), sr)
+        paths.append(path)
+    return paths
+
+
+def make_segments(n, clips=None, gap=2.0, seed=0):
+    """
+    n segment giả lập (timing, text EN/VI, voice info, audio path)
+    
+    Độ dài segment ngẫu nhiên nên một phần clip sẽ dài/ngắn hơn timing
+    (để merge_segments_v2 phải co giãn).
+    """
+    rng = np.random.default_rng(seed)
+    segments = []
+    for i in range(n):
+        start = i * gap
+        segments.append({
+            "id": i,
+            "start": start,
+            "end": start + rng.uniform(0.8, gap - 0.1),
+            "text": f"This is synthetic sentence number {i}, with 3 numbers & symbols!",
+            "vi_text": f"Đây là câu giả lập số {i}, có 3 con số & ký hiệu!",
+            "voice_gender": "male" if i % 2 else "female",
+            "voice_emotion": "neutral",
+            "vi_audio_path": clips[i % len(clips)] if clips else None
+        })
+    return segments
+
+
+def make_texts(n, seed=0):
+    """Dòng text giả lập có số, ký hiệu, viết tắt, khoảng trắng thừa"""
+    rng = np.random.default_rng(seed)
+    templates = [
+        "Đây là câu số {i}   với  khoảng trắng thừa...",
+        "Giá là {i}$ (khoảng {j}%) - rẻ hơn 50% so với năm 2020!!!",
+        "Email: user{i}@example.com, gọi 0901-{j:06d} trước 9h30",
+        "Dr. Smith & Mr. Nguyễn đã nói: \"OK, {i} lần\"; thật sao?",
+        "…{i}… ♪ ♫ → ← emoji 😀 và ký tự lạ ©®",
+    ]
+    return [templates[k % len(templates)].format(i=k, j=int(rng.integers(0, 999999)))
+            for k in range(n)]
+
+
+class Kernel:
+    """
+    Một kernel cần đo
+    
+    Args:
+        name: Tên (khóa trong baseline)
+        setup: Hàm (scale, tmp_dir) -> (hàm không tham số cần đo, số đơn vị xử lý)
+        unit: Đơn vị để tính throughput (vd: "segment", "giây audio")
+        needs_ffmpeg: Bỏ qua khi không có ffmpeg
+    """
+    
+    def __init__(self, name, setup, unit, needs_ffmpeg=False):
+        self.name = name
+        self.setup = setup
+        self.unit = unit
+        self.needs_ffmpeg = needs_ffmpeg
+
+
+def _setup_merge(scale, tmp, **kwargs):
+    from merge_audio import merge_segments
+    clips = make_fake_clips(os.path.join(tmp, "clips"))
+    n = SEGMENT_COUNTS[scale]
+    segments_json = os.path.join(tmp, f"merge_{scale}.json")
+    with open(segments_json, "w", encoding="utf-8") as f:
+        json.dump(make_segments(n, clips), f, ensure_ascii=False)
+    out_wav = os.path.join(tmp, f"merge_{scale}.wav")
+    # incremental=False: lần đo sau không được dùng lại kết quả lần trước
+    return lambda: merge_segments(segments_json, out_wav, incremental=False, **kwargs), n
+
+
+def setup_merge_segments(scale, tmp):
+    return _setup_merge(scale, tmp, streaming=False)
+
+
+def setup_merge_segments_streaming(scale, tmp):
+    return _setup_merge(scale, tmp, streaming=True)
+
+
+def setup_merge_segments_bank(scale, tmp):
+    # Cùng clip nhưng nằm trong SegmentBank (PCM float32, đọc qua memory map)
+    from segment_bank import SegmentBank
+    from merge_audio import merge_segments
+    with SegmentBank(os.path.join(tmp, "clips.bank")) as bank:
+        clips = [
+            bank.put(f"{k:03d}", make_signal(1.0 + 1.5 * k / N_FAKE_CLIPS, 24000, seed=k).reshape(-1, 1), 24000)
+            for k in range(N_FAKE_CLIPS)
+        ]
+    n = SEGMENT_COUNTS[scale]
+    segments_json = os.path.join(tmp, f"merge_bank_{scale}.json")
+    with open(segments_json, "w", encoding="utf-8") as f:
+        json.dump(make_segments(n, clips), f, ensure_ascii=False)
+    out_wav = os.path.join(tmp, f"merge_bank_{scale}.wav")
+    return lambda: merge_segments(segments_json, out_wav, incremental=False, streaming=False), n
+
+
+def setup_merge_segments_v2(scale, tmp):
+    from merge_audio_v2 import merge_segments_v2
+    clips = make_fake_clips(os.path.join(tmp, "clips"))
+    n = SEGMENT_COUNTS[scale]
+    segments_json = os.path.join(tmp, f"merge_v2_{scale}.json")
+    with open(segments_json, "w", encoding="utf-8") as f:
+        json.dump(make_segments(n, clips), f, ensure_ascii=False)
+    out_wav = os.path.join(tmp, f"merge_v2_{scale}.wav")
+    return lambda: merge_segments_v2(segments_json, out_wav), n
+
+
+def setup_speed_change(scale, tmp):
+    from utils import speed_change
+    seconds = AUDIO_SECONDS[scale]
+    audio = make_audio_segment(seconds)
+    return lambda: speed_change(audio, 1.3), seconds
+
+
+def setup_normalize_audio(scale, tmp):
+    from utils import normalize_audio
+    seconds = AUDIO_SECONDS[scale]
+    audio = make_audio_segment(seconds, kind="noise")
+    return lambda: normalize_audio(audio), seconds
+
+
+def setup_analyze_audio_segment(scale, tmp):
+    from voice_analysis import analyze_audio_segment
+    seconds = AUDIO_SECONDS[scale]
+    wav = os.path.join(tmp, f"analyze_{scale}.wav")
+    write_wav(wav, make_signal(seconds), 16000)
+    # Một segment 2s ở giữa file (chỉ decode đúng đoạn đó)
+    middle = seconds / 2
+    return lambda: analyze_audio_segment(wav, middle - 1, middle + 1), 1
+
+
+def setup_analyze_all_segments(scale, tmp):
+    from voice_analysis import analyze_all_segments
+    seconds = AUDIO_SECONDS[scale]
+    wav = os.path.join(tmp, f"analyze_all_{scale}.wav")
+    write_wav(wav, make_signal(seconds), 16000)
+    segments = make_segments(int(seconds / 2.0))
+    segments_json = os.path.join(tmp, f"analyze_all_{scale}.json")
+    with open(segments_json, "w", encoding="utf-8") as f:
+        json.dump(segments, f, ensure_ascii=False)
+    out_json = os.path.join(tmp, f"analyze_all_{scale}_out.json")
+    return (lambda: analyze_all_segments(wav, segments_json, precompute=False, workers=1, out_json=out_json),
+            len(segments))
+
+
+def setup_mix_audio_segments(scale, tmp):
+    from tts_advanced import mix_audio_segments
+    seconds = min(AUDIO_SECONDS[scale], 30)  # một câu TTS không dài hơn vài chục giây
+    original = make_audio_segment(seconds, kind="noise")
+    tts_path = os.path.join(tmp, f"mix_tts_{scale}.wav")
+    write_wav(tts_path, make_signal(seconds, 24000), 24000)
+    out_path = os.path.join(tmp, f"mix_{scale}.mp3")
+    return lambda: mix_audio_segments(original, tts_path, out_path), seconds
+
+
+def setup_clean_text(scale, tmp):
+    from text_cleaner import clean_text_for_tts
+    texts = make_texts(TEXT_LINES[scale])
+    return lambda: [clean_text_for_tts(text) for text in texts], len(texts)
+
+
+def setup_validate_text(scale, tmp):
+    from text_cleaner import validate_text
+    texts = make_texts(TEXT_LINES[scale])
+    return lambda: [validate_text(text) for text in texts], len(texts)
+
+
+def setup_text_normalizer(scale, tmp, expand=True):
+    from text_cleaner import TextNormalizer
+    texts = make_texts(TEXT_LINES[scale])
+    normalizer = TextNormalizer(expand=expand)
+    return lambda: normalizer.normalize_many(texts), len(texts)
+
+
+def setup_text_normalizer_clean(scale, tmp):
+    return setup_text_normalizer(scale, tmp, expand=False)
+
+
+def setup_segment_table(scale, tmp):
+    from segment_table import SegmentTable
+    # Transcript rất dài (livestream nhiều giờ): cùng số lượng với số dòng text
+    segments = make_segments(TEXT_LINES[scale])
+    
+    def run():
+        table = SegmentTable.from_segments(segments, fields=["vi_audio_path"])
+        table.sample_bounds(16000)
+        table.overlaps()
+        table.in_window(0.0, table.end_time() / 2)
+        return table.total_duration()
+    return run, len(segments)
+
+
+KERNELS = [
+    Kernel("merge_segments", setup_merge_segments, "segment"),
+    Kernel("merge_segments_streaming", setup_merge_segments_streaming, "segment"),
+    Kernel("merge_segments_bank", setup_merge_segments_bank, "segment"),
+    Kernel("merge_segments_v2", setup_merge_segments_v2, "segment"),
+    Kernel("speed_change", setup_speed_change, "giây audio"),
+    Kernel("normalize_audio", setup_normalize_audio, "giây audio"),
+    Kernel("analyze_audio_segment", setup_analyze_audio_segment, "segment"),
+    Kernel("analyze_all_segments", setup_analyze_all_segments, "segment"),
+    Kernel("mix_audio_segments", setup_mix_audio_segments, "giây audio", needs_ffmpeg=True),
+    Kernel("clean_text_for_tts", setup_clean_text, "dòng"),
+    Kernel("validate_text", setup_validate_text, "dòng"),
+    Kernel("text_normalizer", setup_text_normalizer, "dòng"),
+    Kernel("text_normalizer_clean", setup_text_normalizer_clean, "dòng"),
+    Kernel("segment_table", setup_segment_table, "segment"),
+]
+
+
+class KernelFailed(Exception):
+    """Kernel trả về False/None (các hàm bước nuốt exception và trả về False)"""
+
+
+def _check_result(result, output):
+    if result is None or result is False:
+        lines = [line for line in output.getvalue().splitlines() if line.strip()]
+        raise KernelFailed(lines[-1].strip() if lines else f"kết quả {result!r}")
+
+
+def time_kernel(func, repeats, min_seconds=0.2):
+    """
+    Đo func: chạy 1 lần khởi động rồi lặp ít nhất `repeats` lần và đủ min_seconds
+    
+    Returns:
+        List thời gian từng lần (giây)
+    
+    Raises:
+        KernelFailed: func trả về False hoặc None (lỗi đã bị nuốt bên trong)
+    """
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        _check_result(func(), output)  # warm-up (import, cache của librosa/numpy)
+        times = []
+        start = time.perf_counter()
+        while len(times) < repeats or (time.perf_counter() - start < min_seconds and len(times) < 100):
+            t0 = time.perf_counter()
+            result = func()
+            times.append(time.perf_counter() - t0)
+            _check_result(result, output)
+    return times
+
+
+def environment():
+    """Thông tin máy đo (baseline chỉ nên so trên cùng môi trường)"""
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count()
+    }
+
+
+def run_suite(kernels, scales, repeats=3):
+    """
+    Chạy các kernel ở các quy mô
+    
+    Returns:
+        dict "kernel@scale" -> {min, median, repeats, units, throughput},
+        {skipped: lý do} hoặc {failed: lỗi}
+    """
+    has_ffmpeg = shutil.which("ffmpeg") is not None
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for kernel in kernels:
+            for scale in scales:
+                key = f"{kernel.name}@{scale}"
+                if kernel.needs_ffmpeg and not has_ffmpeg:
+                    results[key] = {"skipped": "không có ffmpeg"}
+                    print(f"   ⏭️ {key:40s} bỏ qua (không có ffmpeg)")
+                    continue
+                try:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        func, units = kernel.setup(scale, tmp)
+                    times = time_kernel(func, repeats)
+                except Exception as e:
+                    results[key] = {"failed": str(e)}
+                    print(f"   ❌ {key:40s} lỗi: {e}")
+                    continue
+                best = min(times)
+                results[key] = {
+                    "min": round(best, 6),
+                    "median": round(statistics.median(times), 6),
+                    "repeats": len(times),
+                    "units": units,
+                    "unit": kernel.unit,
+                    "throughput": round(units / best, 3) if best > 0 else None
+                }
+                print(f"   ⏱️ {key:40s} {best * 1000:10.2f} ms  "
+                      f"({units / best:,.0f} {kernel.unit}/s, {len(times)} lần)")
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    So kết quả với baseline theo thời gian nhỏ nhất
+    
+    Returns:
+        List (key, baseline_s, current_s, ratio) của các kernel chậm hơn ngưỡng
+    """
+    regressions = []
+    print(f"\n📊 So với baseline (ngưỡng +{threshold:.0%}):")
+    for key, result in results.items():
+        base = baseline.get("results", {}).get(key)
+        if "min" not in result or not base or "min" not in base:
+            continue
+        ratio = result["min"] / base["min"] if base["min"] > 0 else 1.0
+        mark = "❌" if ratio > 1 + threshold else ("✅" if ratio < 1 - threshold else "  ")
+        print(f"   {mark} {key:40s} {base['min'] * 1000:10.2f} → {result['min'] * 1000:10.2f} ms ({ratio:.2f}x)")
+        if ratio > 1 + threshold:
+            regressions.append((key, base["min"], result["min"], ratio))
+    return regressions
+
+
+def parse_args():
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(
+        description='⏱️ Micro-benchmark các kernel audio/text (offline)'
+    )
+    parser.add_argument(
+        '-k', '--kernel',
+        action='append',
+        default=[],
+        help='Chỉ chạy kernel có tên chứa chuỗi này (lặp lại được)'
+    )
+    parser.add_argument(
+        '--scales',
+        nargs='+',
+        choices=SCALES,
+        default=['small', 'medium'],
+        help='Các quy mô cần đo (mặc định: small medium)'
+    )
+    parser.add_argument(
+        '--repeats',
+        type=int,
+        default=3,
+        help='Số lần đo tối thiểu mỗi kernel (mặc định: 3)'
+    )
+    parser.add_argument(
+        '--baseline',
+        default=str(DEFAULT_BASELINE),
+        help=f'File baseline JSON (mặc định: {DEFAULT_BASELINE.name} ở thư mục gốc project)'
+    )
+    parser.add_argument(
+        '--save-baseline',
+        action='store_true',
+        help='Ghi kết quả lần này làm baseline (gộp với baseline cũ)'
+    )
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=0.25,
+        help='Báo lỗi khi chậm hơn baseline quá tỉ lệ này (mặc định: 0.25 = 25%%)'
+    )
+    parser.add_argument(
+        '-o', '--output',
+        help='Ghi kết quả lần này ra file JSON'
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # Đo kernel, không ghi metrics của pipeline
+    config.METRICS_ENABLED = False
+    
+    kernels = [k for k in KERNELS if not args.kernel or any(name in k.name for name in args.kernel)]
+    if not kernels:
+        print(f"❌ Không có kernel nào khớp: {args.kernel}")
+        return False
+    
+    print(f"⏱️ Benchmark {len(kernels)} kernel, quy mô: {', '.join(args.scales)}")
+    results = run_suite(kernels, args.scales, args.repeats)
+    # Kernel lỗi không có thời gian để so, nhưng lần chạy vẫn tính là thất bại
+    failed = [key for key, result in results.items() if "failed" in result]
+    if failed:
+        print(f"\n❌ {len(failed)} kernel lỗi: {', '.join(failed)}")
+    report = {"environment": environment(), "created_at": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results}
+    
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"📄 Kết quả: {args.output}")
+    
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    
+    if args.save_baseline:
+        merged = dict(baseline.get("results", {}) if baseline else {})
+        merged.update({key: value for key, value in results.items() if "min" in value})
+        report["results"] = merged
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"💾 Đã lưu baseline: {args.baseline}")
+        return not failed
+    
+    if baseline is None:
+        print(f"⚠️ Chưa có baseline ({args.baseline}), chạy với --save-baseline để tạo")
+        return not failed
+    
+    if baseline.get("environment") != environment():
+        print("⚠️ Baseline được đo trên môi trường khác, so sánh chỉ mang tính tham khảo")
+    
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"\n❌ {len(regressions)} kernel chậm hơn baseline quá {args.threshold:.0%}:")
+        for key, base, current, ratio in regressions:
+            print(f"   - {key}: {ratio:.2f}x")
+    if failed or regressions:
+        return False
+    print("\n✅ Không có kernel nào chậm hơn ngưỡng")
+    return True
+
+
+if __name__ == "__main__":
+    success = main()
+    sys.exit(0 if success else 1)
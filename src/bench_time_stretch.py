@@ -0,0 +1,103 @@
+"""
+Benchmark co giãn thời gian
+So sánh speed_change cũ (đổi frame_rate + resample của pydub) với phase
+vocoder vector hóa (time_stretch.py) về tốc độ xử lý, độ chính xác thời
+lượng output và độ lệch cao độ
+
+Chạy: python bench_time_stretch.py [số_segment] [sample_rate]
+"""
+import sys
+import time
+
+import numpy as np
+from pydub import AudioSegment
+
+from time_stretch import audio_segment_to_float, stretch_audio_segments
+
+
+def legacy_speed_change(audio_segment, speed=1.0):
+    """Cách cũ: đổi frame_rate rồi convert về sample rate gốc (đổi cả cao độ)"""
+    sound_with_altered_frame_rate = audio_segment._spawn(
+        audio_segment.raw_data,
+        overrides={"frame_rate": int(audio_segment.frame_rate * speed)}
+    )
+    return sound_with_altered_frame_rate.set_frame_rate(audio_segment.frame_rate)
+
+
+def make_segments(n, sr=24000, seed=0):
+    """
+    Tạo n segment giả lập câu nói (0.5–6s, chuỗi hài âm) và tốc độ cần
+    điều chỉnh nằm ngoài khoảng 0.9–1.1 như trong merge_segments_v2
+    
+    Returns:
+        (list AudioSegment, list speed, list f0)
+    """
+    rng = np.random.default_rng(seed)
+    segments, speeds, f0s = [], [], []
+    for _ in range(n):
+        seconds = rng.uniform(0.5, 6.0)
+        t = np.arange(int(seconds * sr)) / sr
+        f0 = rng.uniform(100, 250)
+        y = sum(np.sin(2 * np.pi * f0 * h * t) / h for h in range(1, 4)) * 0.2
+        segments.append(AudioSegment(
+            data=(y * 32767).astype(np.int16).tobytes(),
+            sample_width=2,
+            frame_rate=sr,
+            channels=1
+        ))
+        speed = rng.uniform(1.1, 1.8) if rng.random() < 0.7 else rng.uniform(0.6, 0.9)
+        speeds.append(speed)
+        f0s.append(f0)
+    return segments, speeds, f0s
+
+
+def dominant_frequency(audio_segment):
+    """Tần số có biên độ lớn nhất (Hz)"""
+    y = audio_segment_to_float(audio_segment)[:, 0]
+    spectrum = np.abs(np.fft.rfft(y * np.hanning(len(y))))
+    return np.argmax(spectrum) * audio_segment.frame_rate / len(y)
+
+
+def report(name, elapsed, segments, outputs, speeds, f0s, audio_seconds):
+    duration_errors = [
+        abs(len(out) - len(seg) / speed)
+        for seg, out, speed in zip(segments, outputs, speeds)
+    ]
+    pitch_ratios = [dominant_frequency(out) / f0 for out, f0 in zip(outputs, f0s)]
+    pitch_error = np.mean([abs(r - 1) for r in pitch_ratios]) * 100
+    print(f"   {name}")
+    print(f"      Thời gian:          {elapsed:.2f}s ({audio_seconds / elapsed:.0f}x realtime)")
+    print(f"      Lệch thời lượng:    TB {np.mean(duration_errors):.2f}ms, tối đa {np.max(duration_errors):.2f}ms")
+    print(f"      Lệch cao độ:        TB {pitch_error:.1f}%")
+    return pitch_error
+
+
+def run(n=300, sr=24000):
+    print(f"🎵 Đang tạo {n} segments ({sr} Hz)...")
+    segments, speeds, f0s = make_segments(n, sr)
+    audio_seconds = sum(len(seg) for seg in segments) / 1000
+    print(f"📊 Tổng {audio_seconds / 60:.1f} phút audio")
+    
+    # Cách cũ
+    t0 = time.perf_counter()
+    legacy = [legacy_speed_change(seg, speed) for seg, speed in zip(segments, speeds)]
+    legacy_time = time.perf_counter() - t0
+    
+    # Cách mới (batch)
+    t0 = time.perf_counter()
+    stretched = stretch_audio_segments(segments, speeds)
+    new_time = time.perf_counter() - t0
+    
+    print()
+    report("Cũ (speed_change)", legacy_time, segments, legacy, speeds, f0s, audio_seconds)
+    new_pitch_error = report("Mới (phase vocoder, batch)", new_time, segments, stretched, speeds, f0s, audio_seconds)
+    print(f"   Tăng tốc: {legacy_time / new_time:.1f}x")
+    
+    # Phase vocoder phải giữ cao độ (sai số chỉ do độ phân giải FFT)
+    return new_pitch_error < 1.0
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    sr = int(sys.argv[2]) if len(sys.argv) > 2 else 24000
+    sys.exit(0 if run(n, sr) else 1)
@@ -0,0 +1,80 @@
+"""
+Benchmark TTS offline
+So sánh TTS tuần tự và đồng thời bằng backend giả lập có độ trễ mạng
+(không cần kết nối Edge TTS)
+
+Chạy: python bench_tts.py [số_câu] [độ_trễ_giây] [concurrency]
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+from tts_advanced import tts_segments_advanced
+
+
+def make_fake_backend(latency=0.2):
+    """
+    Tạo backend TTS giả lập: chờ `latency` giây rồi ghi file nhỏ
+    
+    Cùng signature với tts_advanced._tts_with_ssml nên truyền thẳng
+    vào tts_segments_advanced(tts_backend=...).
+    """
+    async def fake_tts(text, output_path, voice="female", rate="+0%", pitch="+0Hz", volume="+0%"):
+        await asyncio.sleep(latency)
+        with open(output_path, "wb") as f:
+            f.write(f"{voice}|{rate}|{pitch}|{volume}|{text}".encode("utf-8"))
+    
+    return fake_tts
+
+
+def make_segments(n):
+    """Tạo n segments tiếng Việt giả lập"""
+    return [
+        {
+            "id": i,
+            "start": i * 2.0,
+            "end": i * 2.0 + 1.8,
+            "text": f"Sentence number {i}",
+            "vi_text": f"Đây là câu số {i}"
+        }
+        for i in range(n)
+    ]
+
+
+def run_once(n, latency, concurrency):
+    """Chạy TTS với backend giả lập, trả về thời gian (giây)"""
+    with tempfile.TemporaryDirectory() as tmp:
+        segments_json = os.path.join(tmp, "vi.json")
+        with open(segments_json, "w", encoding="utf-8") as f:
+            json.dump(make_segments(n), f, ensure_ascii=False)
+        
+        t0 = time.perf_counter()
+        tts_segments_advanced(
+            segments_json,
+            None,
+            os.path.join(tmp, "vi_segments"),
+            auto_voice=False,
+            concurrency=concurrency,
+            tts_backend=make_fake_backend(latency),
+            use_cache=False,  # lần chạy trước không được làm cache hit cho lần sau
+            use_bank=False  # audio giả không decode được, chỉ đo request đồng thời
+        )
+        return time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    
+    serial = run_once(n, latency, 1)
+    concurrent = run_once(n, latency, concurrency)
+    
+    print()
+    print(f"📊 {n} câu, độ trễ {latency}s/câu")
+    print(f"   Tuần tự:            {serial:.2f}s")
+    print(f"   Đồng thời (x{concurrency}): {concurrent:.2f}s")
+    print(f"   Tăng tốc:           {serial / concurrent:.1f}x")
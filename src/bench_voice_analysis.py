@@ -0,0 +1,122 @@
+"""
+Benchmark phân tích giọng nói
+So sánh cách cũ (librosa.load từng segment + vòng lặp pitch Python) với
+cách mới (decode một lần + argmax vector hóa) trên file audio tổng hợp
+
+Chạy: python bench_voice_analysis.py [số_phút] [độ_dài_segment_giây] [số_worker]
+"""
+import os
+import sys
+import tempfile
+import time
+import wave
+
+import librosa
+import numpy as np
+
+from voice_analysis import load_audio, slice_segment, analyze_samples, analyze_samples_parallel
+
+
+def write_synthetic_wav(path, minutes=60, sr=16000, seg_seconds=2.4, seed=0):
+    """
+    Ghi file WAV giả lập giọng nói: mỗi segment là chuỗi hài âm với f0,
+    biên độ khác nhau, cộng thêm noise
+    
+    Returns:
+        List segments dạng {"start", "end"} tương ứng
+    """
+    rng = np.random.default_rng(seed)
+    seg_len = int(seg_seconds * sr)
+    n_segments = int(minutes * 60 / seg_seconds)
+    t = np.arange(seg_len) / sr
+    segments = []
+    
+    with wave.open(path, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(sr)
+        for k in range(n_segments):
+            f0 = rng.uniform(90, 260)
+            amp = rng.uniform(0.02, 0.3)
+            vibrato = 1 + 0.03 * np.sin(2 * np.pi * rng.uniform(2, 6) * t)
+            y = sum(np.sin(2 * np.pi * f0 * h * vibrato * t) / h for h in range(1, 5))
+            y = amp * y / 2 + rng.normal(0, 0.01, seg_len)
+            wf.writeframes((np.clip(y, -1, 1) * 32767).astype(np.int16).tobytes())
+            start = k * seg_seconds
+            # Segment ngắn hơn khoảng trống một chút, giống output Whisper
+            segments.append({"start": round(start + 0.1, 2), "end": round(start + seg_seconds - 0.1, 2)})
+    
+    return segments
+
+
+def legacy_analyze_segment(audio_path, start_time, end_time, sr=16000):
+    """Cách cũ: load riêng từng segment, chọn pitch từng frame bằng Python"""
+    y, sr = librosa.load(audio_path, sr=sr, offset=start_time, duration=end_time-start_time)
+    pitches, magnitudes = librosa.piptrack(y=y, sr=sr, fmin=50, fmax=400)
+    
+    pitch_values = []
+    for t in range(pitches.shape[1]):
+        index = magnitudes[:, t].argmax()
+        pitch = pitches[index, t]
+        if pitch > 0:
+            pitch_values.append(pitch)
+    
+    avg_pitch = np.mean(pitch_values) if pitch_values else 180
+    pitch_std = np.std(pitch_values) if pitch_values else 20
+    energy = np.mean(librosa.feature.rms(y=y)[0])
+    speech_rate = np.mean(librosa.feature.zero_crossing_rate(y)[0])
+    return float(avg_pitch), float(pitch_std), float(energy), float(speech_rate)
+
+
+def run(minutes=60, seg_seconds=2.4, workers=1):
+    with tempfile.TemporaryDirectory() as tmp:
+        audio_path = os.path.join(tmp, "synthetic.wav")
+        print(f"🎵 Đang tạo audio tổng hợp {minutes} phút...")
+        segments = write_synthetic_wav(audio_path, minutes=minutes, seg_seconds=seg_seconds)
+        print(f"📊 {len(segments)} segments")
+        
+        # Chạy thử một lần để loại thời gian JIT (numba) khỏi kết quả đo
+        legacy_analyze_segment(audio_path, segments[0]["start"], segments[0]["end"])
+        
+        # Cách cũ
+        t0 = time.perf_counter()
+        legacy = [legacy_analyze_segment(audio_path, s["start"], s["end"]) for s in segments]
+        legacy_time = time.perf_counter() - t0
+        
+        # Cách mới
+        t0 = time.perf_counter()
+        y, sr = load_audio(audio_path)
+        new = [analyze_samples(slice_segment(y, sr, s["start"], s["end"]), sr) for s in segments]
+        new_time = time.perf_counter() - t0
+        
+        # Song song nhiều process (audio trong shared memory)
+        if workers > 1:
+            t0 = time.perf_counter()
+            parallel = analyze_samples_parallel(y, sr, segments, workers)
+            parallel_time = time.perf_counter() - t0
+    
+    # Kiểm tra kết quả trùng khớp
+    mismatches = sum(
+        1 for old, res in zip(legacy, new)
+        if old != (res["pitch_avg"], res["pitch_std"], res["energy"], res["speech_rate"])
+    )
+    
+    print()
+    print(f"   Cũ (load từng segment): {legacy_time:.2f}s")
+    print(f"   Mới (decode một lần):   {new_time:.2f}s")
+    print(f"   Tăng tốc:               {legacy_time / new_time:.1f}x")
+    print(f"   Kết quả khác nhau:      {mismatches}/{len(segments)}")
+    if workers > 1:
+        print(f"   Song song ({workers} workers): {parallel_time:.2f}s "
+              f"({new_time / parallel_time:.1f}x so với 1 process)")
+        if parallel != new:
+            print("   ⚠️ Kết quả song song khác tuần tự")
+            return False
+    return mismatches == 0
+
+
+if __name__ == "__main__":
+    minutes = float(sys.argv[1]) if len(sys.argv) > 1 else 60
+    seg_seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 2.4
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count() or 1
+    sys.exit(0 if run(minutes, seg_seconds, workers) else 1)
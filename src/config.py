@@ -5,19 +5,38 @@ File cấu hình cho tool
 # Whisper settings
 WHISPER_MODEL_SIZE = "small"  # tiny, base, small, medium, large
 WHISPER_LANGUAGE = "en"  # auto-detect nếu để None
+ASR_WORKERS = 1  # Số process nhận dạng audio dài, mỗi process một model (1 = tuần tự)
+ASR_LONG_FORM_MIN_SECONDS = 600  # Chỉ chia audio dài hơn ngưỡng này (giây)
+ASR_CHUNK_SECONDS = 120  # Độ dài mong muốn mỗi đoạn, cắt tại khoảng lặng gần nhất (giây)
 
 # Translation settings
 TRANSLATION_MODEL = "Helsinki-NLP/opus-mt-en-vi"
 MAX_TRANSLATION_LENGTH = 512
+TRANSLATION_CACHE_ENABLED = True  # Cache bản dịch trên đĩa (dùng lại giữa các video)
+TRANSLATION_CACHE_MAX_ENTRIES = 200000  # Số bản dịch tối đa, vượt quá thì xóa theo LRU
 
 # TTS settings
 TTS_MODEL = "tts_models/vi/vivos/vits"
 TTS_SPEED = 1.0  # Tốc độ nói (0.5-2.0)
+TTS_CONCURRENCY = 8  # Số request Edge TTS chạy đồng thời (1 = tuần tự)
+TTS_TIMEOUT = 30  # Timeout mỗi request TTS (giây)
+TTS_RETRIES = 2  # Số lần thử lại khi request TTS lỗi
+TTS_CACHE_ENABLED = True  # Cache audio TTS theo nội dung (text, giọng, prosody)
+TTS_CACHE_MAX_MB = 2048  # Dung lượng tối đa cache audio, vượt quá thì xóa theo LRU
+TTS_SPOKEN_EXPANSION = False  # Viết số, ngày, giờ, đơn vị, viết tắt thành lời tiếng Việt trước khi TTS
+TTS_AUDIO_BANK = False  # Audio TTS decode một lần, mix bằng NumPy và lưu PCM float32 vào một file bank (memory map) thay cho MP3 từng câu (vi_audio_path thành "<bank>#<key>", không phải đường dẫn file)
 
 # Audio settings
 AUDIO_SAMPLE_RATE = 16000
 AUDIO_NORMALIZE = True  # Chuẩn hóa âm lượng
 AUDIO_NOISE_REDUCTION = False  # Giảm noise (experimental)
+AUDIO_IN_MEMORY = False  # Tách audio gốc thẳng vào bộ nhớ (ffmpeg → NumPy), các bước dùng chung không decode lại; WAV chỉ ghi khi KEEP_INTERMEDIATE_FILES
+VOICE_ANALYSIS_PRECOMPUTE = False  # Tính đặc trưng giọng một lần cho cả file, lưu sidecar .npy
+VOICE_ANALYSIS_WORKERS = 1  # Số process phân tích giọng song song (1 = tuần tự)
+MERGE_STREAMING = False  # Ghép audio theo từng cửa sổ, bộ nhớ không phụ thuộc độ dài video
+MERGE_WINDOW_SECONDS = 10  # Độ dài mỗi cửa sổ khi ghép streaming (giây)
+MERGE_INCREMENTAL = False  # Chạy lại chỉ ghép lại các cửa sổ có segment thay đổi (ghép streaming, ưu tiên hơn MERGE_STREAMING, ghi <out_wav>.merge.json)
+MUX_STREAMING = False  # Ghép audio và ghép video trong một lượt: PCM đẩy thẳng vào stdin ffmpeg, không ghi vi_full.wav (không dùng được merge incremental)
 
 # Video settings
 VIDEO_CODEC = "copy"  # copy hoặc libx264
@@ -25,12 +44,35 @@ AUDIO_CODEC = "aac"
 AUDIO_BITRATE = "192k"
 
 # Processing settings
-BATCH_SIZE = 10  # Số câu xử lý cùng lúc cho TTS
+BATCH_SIZE = 10  # Số câu xử lý cùng lúc (batch dịch, TTS)
 KEEP_INTERMEDIATE_FILES = True  # Giữ file trung gian
 ENABLE_PROGRESS_BAR = True  # Hiển thị thanh tiến trình
+SEGMENT_JOURNAL_ENABLED = False  # Lưu tiến độ dịch/TTS theo từng câu, chạy lại chỉ làm câu còn thiếu
+INCREMENTAL_REDUB = False  # Chạy lại chỉ làm các bước/câu có input thay đổi (giữ chỉnh sửa tay trong vi.json)
+SEGMENT_STORE_ENABLED = False  # batch_dub: lưu segments trong SQLite, mỗi bước chỉ cập nhật field của mình; en.json/vi.json export khi xong
+MODEL_CACHE_MAX_MODELS = 2  # Số model (Whisper, dịch) giữ trong RAM để dùng lại, 0 = không giới hạn
+MODEL_CACHE_MAX_MB = 0  # Dung lượng tối đa các model giữ lại, 0 = không giới hạn
+
+# Metrics settings
+METRICS_ENABLED = False  # Đo thời gian, CPU, RAM, I/O, cache của từng bước (bật khi cần, ghi vào METRICS_FILE)
+METRICS_FILE = "output/metrics.jsonl"  # Mỗi bước một dòng JSON (tương đối so với thư mục gốc project)
+METRICS_PROMETHEUS_FILE = None  # Ghi thêm Prometheus textfile, vd: "/var/lib/node_exporter/textfile/dubbing.prom"
 
 # Paths (relative to project root)
 INPUT_DIR = "input"
 OUTPUT_DIR = "output"
 AUDIO_DIR = "audio"
 SUBTITLES_DIR = "subtitles"
+CACHE_DIR = "cache"
+
+# Batch settings (batch_dub.py)
+BATCH_MAX_IN_FLIGHT = 3  # Số video xử lý cùng lúc trong dây chuyền
+BATCH_STAGE_CONCURRENCY = {  # Số video chạy đồng thời trong từng bước
+    "extract": 2,  # ffmpeg, I/O
+    "asr": 1,  # Whisper, CPU
+    "analyze": 1,  # librosa, CPU
+    "translate": 1,  # transformers, CPU
+    "tts": 2,  # Edge TTS, chờ mạng
+    "merge": 2,  # ghép audio, I/O
+    "mux": 2  # ffmpeg, I/O
+}
@@ -1,7 +1,73 @@
 import subprocess
 import os
+import hashlib
+import wave
 
+import numpy as np
 
+from metrics import instrument, record
+
+
+# Thông số audio gốc dùng cho cả pipeline (tốt cho Whisper)
+EXTRACT_SAMPLE_RATE = 16000
+
+
+class AudioBuffer:
+    """
+    Audio gốc đã decode trong bộ nhớ (mono, float32 trong [-1, 1))
+    
+    Được decode một lần từ PCM 16-bit của ffmpeg (chia 32768, giống
+    whisper.load_audio và librosa khi đọc WAV 16-bit) nên Whisper, phân
+    tích giọng và TTS mixing dùng chung mà không phải đọc/decode lại file.
+    """
+    
+    def __init__(self, samples, sample_rate, path=None):
+        """
+        Args:
+            samples: np.ndarray float32 1 chiều
+            sample_rate: Sample rate
+            path: File WAV đã ghi kèm (None nếu chỉ có trong bộ nhớ)
+        """
+        self.samples = samples
+        self.sample_rate = sample_rate
+        self.path = path
+        self._fingerprint = None
+    
+    @classmethod
+    def from_pcm16(cls, pcm, sample_rate, path=None):
+        """Tạo từ mảng int16 (hoặc bytes PCM s16le)"""
+        if isinstance(pcm, (bytes, bytearray)):
+            pcm = np.frombuffer(pcm, dtype="<i2")
+        return cls(pcm.astype(np.float32) / 32768.0, sample_rate, path)
+    
+    @property
+    def duration(self):
+        """Độ dài (giây)"""
+        return len(self.samples) / self.sample_rate
+    
+    def to_pcm16(self, start=0, end=None):
+        """Đoạn [start, end) (chỉ số sample) dưới dạng int16, chuyển ngược chính xác"""
+        return (self.samples[start:end] * 32768.0).astype("<i2")
+    
+    def fingerprint(self):
+        """Hash nội dung audio (thay cho file_fingerprint khi không có file)"""
+        if self._fingerprint is None:
+            digest = hashlib.sha256(self.samples.tobytes())
+            digest.update(str(self.sample_rate).encode())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+    
+    def write_wav(self, out_audio):
+        """Ghi ra WAV PCM 16-bit mono (cùng định dạng extract_audio)"""
+        with wave.open(out_audio, "wb") as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(2)
+            wf.setframerate(self.sample_rate)
+            wf.writeframes(self.to_pcm16().tobytes())
+        self.path = out_audio
+
+
+@instrument("extract")
 def extract_audio(video_path, out_audio):
     """
     Tách audio từ video bằng ffmpeg
@@ -21,7 +87,7 @@ def extract_audio(video_path, out_audio):
             "-i", video_path,
             "-vn",  # Không video
             "-acodec", "pcm_s16le",  # PCM 16-bit
-            "-ar", "16000",  # Sample rate 16kHz (tốt cho Whisper)
+            "-ar", str(EXTRACT_SAMPLE_RATE),  # Sample rate 16kHz (tốt cho Whisper)
             "-ac", "1",  # Mono channel
             out_audio
         ], check=True, capture_output=True, text=True)
@@ -30,11 +96,12 @@ def extract_audio(video_path, out_audio):
         if os.path.exists(out_audio) and os.path.getsize(out_audio) > 0:
             print(f"✅ Tách audio thành công: {out_audio}")
             print(f"📁 Kích thước: {os.path.getsize(out_audio) / (1024*1024):.2f} MB")
+            record(bytes_written=os.path.getsize(out_audio))
             return True
         else:
             print(f"❌ File audio không được tạo hoặc rỗng")
             return False
-            
+    
     except subprocess.CalledProcessError as e:
         print(f"❌ Lỗi khi tách audio:")
         print(f"   Error code: {e.returncode}")
@@ -47,6 +114,63 @@ def extract_audio(video_path, out_audio):
         return False
 
 
+@instrument("extract")
+def extract_audio_buffer(video_path, out_audio=None):
+    """
+    Tách audio từ video thẳng vào bộ nhớ (ffmpeg ghi PCM ra stdout)
+    
+    Không có file tạm: các bước sau nhận AudioBuffer thay cho đường dẫn
+    WAV. Chỉ ghi WAV khi cần (debug, KEEP_INTERMEDIATE_FILES).
+    
+    Args:
+        video_path: Đường dẫn video input
+        out_audio: Ghi thêm WAV ra đường dẫn này (mặc định: không ghi)
+    
+    Returns:
+        AudioBuffer, hoặc None nếu lỗi
+    """
+    print(f"🎵 Đang tách audio từ video (vào bộ nhớ): {video_path}")
+    
+    try:
+        result = subprocess.run([
+            "ffmpeg",
+            "-i", video_path,
+            "-vn",  # Không video
+            "-f", "s16le",  # PCM 16-bit thô, không header
+            "-acodec", "pcm_s16le",
+            "-ar", str(EXTRACT_SAMPLE_RATE),
+            "-ac", "1",  # Mono channel
+            "pipe:1"
+        ], check=True, capture_output=True)
+    except subprocess.CalledProcessError as e:
+        print(f"❌ Lỗi khi tách audio:")
+        print(f"   Error code: {e.returncode}")
+        if e.stderr:
+            print(f"   FFmpeg error: {e.stderr[-500:].decode(errors='replace')}")
+        return None
+    except FileNotFoundError:
+        print("❌ Không tìm thấy ffmpeg. Vui lòng cài đặt ffmpeg.")
+        print("   Tải tại: https://ffmpeg.org/download.html")
+        return None
+    
+    if not result.stdout:
+        print(f"❌ Video không có audio hoặc audio rỗng")
+        return None
+    
+    audio = AudioBuffer.from_pcm16(result.stdout, EXTRACT_SAMPLE_RATE)
+    print(f"✅ Tách audio thành công: {audio.duration:.1f}s "
+          f"({audio.samples.nbytes / (1024*1024):.1f} MB trong bộ nhớ)")
+    record(audio_seconds=round(audio.duration, 3), buffer_bytes=audio.samples.nbytes)
+    
+    if out_audio:
+        os.makedirs(os.path.dirname(out_audio) or ".", exist_ok=True)
+        audio.write_wav(out_audio)
+        print(f"💾 Đã ghi kèm WAV: {out_audio}")
+        record(bytes_written=os.path.getsize(out_audio))
+    
+    return audio
+
+
 if __name__ == "__main__":
     # Test
     extract_audio("../input/video.mp4", "../audio/original.wav")
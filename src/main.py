@@ -12,13 +12,17 @@ import json
 from pathlib import Path
 
 # Import các module
-from extract_audio import extract_audio
+from extract_audio import extract_audio, extract_audio_buffer
 from asr_whisper import transcribe
-from voice_analysis import analyze_all_segments
+from voice_analysis import analyze_all_segments, VOICE_FIELDS
 from translate import translate_segments
 from tts_advanced import tts_segments_advanced
 from merge_audio import merge_segments
-from merge_video import merge_video
+from merge_video import merge_video, merge_segments_to_video
+from stage_dag import Stage, run_stages
+from utils import merge_segment_fields
+from metrics import labels
+import config
 
 
 def main():
@@ -51,58 +55,85 @@ def main():
     print(f"\n📹 Video input: {input_video.name}")
     print(f"📁 Kích thước: {input_video.stat().st_size / (1024*1024):.2f} MB")
     
-    try:
-        # Bước 1: Tách audio
-        print("\n" + "="*60)
-        print("BƯỚC 1/6: TÁCH AUDIO TỪ VIDEO")
-        print("="*60)
-        if not extract_audio(str(input_video), str(original_audio)):
-            raise Exception("Lỗi tách audio")
-        
-        # Bước 2: Nhận dạng giọng nói (ASR)
-        print("\n" + "="*60)
-        print("BƯỚC 2/7: NHẬN DẠNG GIỌNG NÓI (WHISPER)")
-        print("="*60)
-        if not transcribe(str(original_audio), str(en_json), model_size="small"):
-            raise Exception("Lỗi nhận dạng giọng nói")
-        
-        # Bước 3: Phân tích giọng nói (Gender & Emotion)
-        print("\n" + "="*60)
-        print("BƯỚC 3/7: PHÂN TÍCH GIỌNG NÓI (GENDER & EMOTION)")
-        print("="*60)
-        if not analyze_all_segments(str(original_audio), str(en_json)):
-            print("⚠️ Lỗi phân tích giọng, tiếp tục với giọng mặc định")
-        
-        # Bước 4: Dịch sang tiếng Việt
-        print("\n" + "="*60)
-        print("BƯỚC 4/7: DỊCH SANG TIẾNG VIỆT")
-        print("="*60)
-        if not translate_segments(str(en_json), str(vi_json)):
-            raise Exception("Lỗi dịch")
-        
-        # Bước 5: Text-to-Speech tiếng Việt (với auto voice selection & mixing)
-        print("\n" + "="*60)
-        print("BƯỚC 5/7: TỔNG HỢP GIỌNG NÓI TIẾNG VIỆT (ADVANCED TTS)")
-        print("="*60)
+    voice_json = subtitles_dir / "voice.json"
+    audio = {}  # Audio gốc đã tách vào bộ nhớ (AudioBuffer)
+    
+    def extract():
+        if not config.AUDIO_IN_MEMORY:
+            return extract_audio(str(input_video), str(original_audio))
+        # Chỉ ghi original.wav khi giữ file trung gian (debug, chạy lại incremental)
+        buffer = extract_audio_buffer(
+            str(input_video), str(original_audio) if config.KEEP_INTERMEDIATE_FILES else None
+        )
+        if buffer is None:
+            return False
+        audio["original"] = buffer
+        return True
+    
+    def original():
+        # Dùng audio trong bộ nhớ nếu vừa tách, ngược lại đọc file (bước tách được bỏ qua)
+        return audio.get("original") or str(original_audio)
+    
+    def analyze_voice():
+        # Xóa kết quả cũ để lần chạy lỗi không ghép nhầm thông tin giọng cũ
+        if voice_json.exists():
+            voice_json.unlink()
+        return analyze_all_segments(original(), str(en_json), out_json=str(voice_json))
+    
+    def join_voice_fields():
+        # Thêm voice_* vào bản dịch, không đụng tới các field của bước dịch
+        merged = merge_segment_fields(str(vi_json), str(voice_json), str(vi_json), fields=VOICE_FIELDS)
+        print(f"✅ Đã ghép thông tin giọng nói cho {merged} câu")
+        return True
+    
+    # Các bước và file vào/ra của từng bước: phân tích giọng (librosa) và
+    # dịch chỉ cùng đọc en.json nên chạy song song, sau đó mới ghép kết quả
+    stages = [
+        Stage("extract", extract,
+              inputs=[input_video], outputs=[original_audio],
+              title="Tách audio từ video"),
+        Stage("asr", lambda: transcribe(original(), str(en_json), model_size="small"),
+              inputs=[original_audio], outputs=[en_json],
+              title="Nhận dạng giọng nói (Whisper)"),
+        Stage("analyze", analyze_voice,
+              inputs=[original_audio, en_json], outputs=[voice_json],
+              title="Phân tích giọng nói (Gender & Emotion)", required=False),
+        Stage("translate", lambda: translate_segments(str(en_json), str(vi_json)),
+              inputs=[en_json], outputs=[vi_json],
+              title="Dịch sang tiếng Việt"),
+        Stage("voice_fields", join_voice_fields,
+              inputs=[vi_json, voice_json], outputs=[vi_json],
+              title="Ghép thông tin giọng nói vào bản dịch"),
         # enable_mixing=True để mix audio gốc (20% volume) với TTS, giữ cảm xúc tốt hơn
         # Set False nếu audio gốc có nhiều noise hoặc không muốn mix
-        if not tts_segments_advanced(str(vi_json), str(original_audio), str(vi_segments_dir), 
-                                     auto_voice=True, enable_mixing=True):
-            raise Exception("Lỗi TTS")
-        
-        # Bước 6: Ghép audio segments
-        print("\n" + "="*60)
-        print("BƯỚC 6/7: GHÉP AUDIO SEGMENTS")
-        print("="*60)
-        if not merge_segments(str(vi_json), str(vi_full_audio)):
-            raise Exception("Lỗi ghép audio")
-        
-        # Bước 7: Ghép audio vào video
-        print("\n" + "="*60)
-        print("BƯỚC 7/7: GHÉP AUDIO VÀO VIDEO")
-        print("="*60)
-        if not merge_video(str(input_video), str(vi_full_audio), str(output_video)):
-            raise Exception("Lỗi ghép video")
+        Stage("tts", lambda: tts_segments_advanced(str(vi_json), original(), str(vi_segments_dir),
+                                                   auto_voice=True, enable_mixing=True),
+              inputs=[vi_json, original_audio], outputs=[vi_json, vi_segments_dir],
+              title="Tổng hợp giọng nói tiếng Việt (Advanced TTS)"),
+        Stage("merge", lambda: merge_segments(str(vi_json), str(vi_full_audio)),
+              inputs=[vi_json, vi_segments_dir], outputs=[vi_full_audio],
+              title="Ghép audio segments"),
+        Stage("mux", lambda: merge_video(str(input_video), str(vi_full_audio), str(output_video)),
+              inputs=[input_video, vi_full_audio], outputs=[output_video],
+              title="Ghép audio vào video")
+    ]
+    if config.MUX_STREAMING:
+        # Ghép audio và video trong một bước, timeline không ghi ra vi_full.wav
+        stages[-2:] = [
+            Stage("mux", lambda: merge_segments_to_video(str(vi_json), str(input_video), str(output_video)),
+                  inputs=[input_video, vi_json, vi_segments_dir], outputs=[output_video],
+                  title="Ghép audio segments và ghép vào video")
+        ]
+    
+    try:
+        # Lưu trạng thái để lần chạy sau (vd: sau khi sửa tay vi.json) chỉ chạy lại bước bị ảnh hưởng
+        state_path = base_dir / config.CACHE_DIR / "main_stages.json" if config.INCREMENTAL_REDUB else None
+        with labels(video=input_video.name):
+            results = run_stages(stages, state_path=state_path)
+        failed = [stage.title for stage in stages
+                  if stage.required and results[stage.name]["status"] != "done"]
+        if failed:
+            raise Exception(f"Lỗi tại bước: {failed[0]}")
         
         # Hoàn thành
         print("\n" + "="*60)
@@ -113,10 +144,11 @@ def main():
         print(f"\n📊 Các file trung gian:")
         print(f"   - Transcript EN: {en_json}")
         print(f"   - Transcript VI: {vi_json}")
-        print(f"   - Audio VI: {vi_full_audio}")
+        if not config.MUX_STREAMING:
+            print(f"   - Audio VI: {vi_full_audio}")
         
         return True
-        
+    
     except Exception as e:
         print(f"\n❌ LỖI: {e}")
         return False
@@ -17,7 +17,7 @@ from tqdm import tqdm
 from extract_audio import extract_audio
 from asr_whisper import transcribe
 from translate import translate_segments
-from tts_vi import tts_segments
+from tts_advanced import tts_segments_advanced
 from merge_audio_v2 import merge_segments_v2
 from merge_video import merge_video
 from utils import validate_video_file, get_video_duration, format_time, save_checkpoint, load_checkpoint
@@ -51,7 +51,7 @@ def parse_args():
     parser.add_argument(
         '--resume',
         action='store_true',
-        help='Tiếp tục từ checkpoint (nếu có)'
+        help='Tiếp tục từ checkpoint (nếu có), không cần xác nhận'
     )
     
     parser.add_argument(
@@ -123,11 +123,13 @@ def main():
     if args.resume:
         checkpoint = load_checkpoint(str(checkpoint_file))
         if checkpoint:
+            # --resume đã là xác nhận, không hỏi lại để chạy được không cần người trực
             print(f"\n♻️ Tìm thấy checkpoint tại bước: {checkpoint['step']}")
-            response = input("Tiếp tục từ checkpoint? (y/n): ")
-            if response.lower() == 'y':
-                start_step = checkpoint.get('data', {}).get('step_number', 1) + 1
-                print(f"▶️ Tiếp tục từ bước {start_step}")
+            start_step = checkpoint.get('data', {}).get('step_number', 1) + 1
+            print(f"▶️ Tiếp tục từ bước {start_step}")
+        else:
+            print("\nℹ️ Không có checkpoint, chạy từ đầu")
+        print("   Bước dịch và TTS tự bỏ qua các câu đã xong ở lần chạy trước")
     
     try:
         # Các bước xử lý
@@ -135,7 +137,7 @@ def main():
             ("Tách audio", lambda: extract_audio(str(input_video), str(original_audio))),
             ("Nhận dạng giọng nói", lambda: transcribe(str(original_audio), str(en_json), model_size=args.model)),
             ("Dịch sang tiếng Việt", lambda: translate_segments(str(en_json), str(vi_json))),
-            ("Tổng hợp giọng nói", lambda: tts_segments(str(vi_json), str(vi_segments_dir))),
+            ("Tổng hợp giọng nói", lambda: tts_segments_advanced(str(vi_json), str(original_audio), str(vi_segments_dir))),
             ("Ghép audio segments", lambda: merge_segments_v2(str(vi_json), str(vi_full_audio), normalize=config.AUDIO_NORMALIZE)),
             ("Ghép audio vào video", lambda: merge_video(str(input_video), str(vi_full_audio), str(output_video)))
         ]
@@ -191,9 +193,10 @@ def main():
             try:
                 os.remove(str(original_audio))
                 os.remove(str(vi_full_audio))
-                # Xóa vi_segments
-                for f in vi_segments_dir.glob("*.wav"):
-                    f.unlink()
+                # Xóa vi_segments (kể cả SegmentBank)
+                for pattern in ("*.wav", "segments.bank*"):
+                    for f in vi_segments_dir.glob(pattern):
+                        f.unlink()
                 print("✅ Đã xóa file trung gian")
             except Exception as e:
                 print(f"⚠️ Lỗi khi xóa: {e}")
@@ -1,80 +1,388 @@
 from pydub import AudioSegment
 import json
 import os
+import numpy as np
+import config
+from timeline_mixer import TimelineMixer, StreamingTimelineWriter, negotiate_format
+from progress_journal import input_hash, write_json_atomic
+from segment_bank import split_ref, load_bank_audio, bank_audio_format, audio_fingerprint
+from segment_table import SegmentTable
+from audio_source import parse_wav_header, WAVE_FORMAT_PCM
+from metrics import instrument, record
 
 
-def merge_segments(segments_json, out_wav):
+def load_segment_audio(audio_path):
+    """
+    Load audio segment (hỗ trợ MP3, WAV và tham chiếu SegmentBank "<bank>#<key>")
+    
+    Args:
+        audio_path: Đường dẫn file audio hoặc tham chiếu bank
+    
+    Returns:
+        pydub AudioSegment
+    """
+    # Audio trong bank: đọc PCM qua memory map, không cần ffmpeg
+    # (float32 → int16 tại đây vì timeline ghép là PCM 16 bit)
+    if split_ref(audio_path):
+        return load_bank_audio(audio_path)
+    
+    # Tự động detect format từ extension
+    if audio_path.lower().endswith('.mp3'):
+        return AudioSegment.from_mp3(audio_path)
+    elif audio_path.lower().endswith('.wav'):
+        return AudioSegment.from_wav(audio_path)
+    else:
+        # Fallback: để pydub tự detect
+        return AudioSegment.from_file(audio_path)
+
+
+# Sample rate của frame MP3 theo version ID (3: MPEG-1, 2: MPEG-2, 0: MPEG-2.5)
+_MP3_FRAME_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def _mp3_format(path, scan_bytes=64 * 1024):
+    """(frame_rate, channels) từ header frame MP3 đầu tiên (bỏ qua tag ID3v2), None nếu không tìm thấy"""
+    with open(path, "rb") as f:
+        head = f.read(10)
+        if head[:3] == b"ID3" and len(head) == 10:
+            size = (head[6] & 0x7F) << 21 | (head[7] & 0x7F) << 14 | (head[8] & 0x7F) << 7 | (head[9] & 0x7F)
+            f.seek(10 + size + (10 if head[5] & 0x10 else 0))
+        else:
+            f.seek(0)
+        data = f.read(scan_bytes)
+    
+    for i in range(len(data) - 3):
+        if data[i] != 0xFF or data[i + 1] & 0xE0 != 0xE0:
+            continue
+        version = (data[i + 1] >> 3) & 3
+        layer = (data[i + 1] >> 1) & 3
+        bitrate = data[i + 2] >> 4
+        rate = (data[i + 2] >> 2) & 3
+        if version == 1 or layer == 0 or bitrate in (0, 15) or rate == 3:
+            continue
+        return _MP3_FRAME_RATES[version][rate], 1 if data[i + 3] >> 6 == 3 else 2
+    return None
+
+
+def probe_audio_format(audio_path):
+    """
+    Định dạng của audio segment khi load bằng load_segment_audio, không decode
+    và không chạy thêm process
+    
+    Bank đọc từ index, WAV đọc header (24-bit được pydub đổi sang 32-bit),
+    MP3 đọc header frame đầu (pydub decode MP3 ra 16 bit). Định dạng khác
+    hoặc header không đọc được thì decode hẳn segment.
+    
+    Returns:
+        (frame_rate, channels, sample_width)
+    """
+    if split_ref(audio_path):
+        return bank_audio_format(audio_path)
+    
+    lower = audio_path.lower()
+    if lower.endswith('.wav'):
+        info = parse_wav_header(audio_path)
+        if info and info["format_tag"] == WAVE_FORMAT_PCM and info["sample_width"] in (1, 2, 3, 4):
+            return info["frame_rate"], info["channels"], 4 if info["sample_width"] == 3 else info["sample_width"]
+    elif lower.endswith('.mp3'):
+        fmt = _mp3_format(audio_path)
+        if fmt:
+            return fmt[0], fmt[1], 2
+    
+    audio_seg = load_segment_audio(audio_path)
+    return audio_seg.frame_rate, audio_seg.channels, audio_seg.sample_width
+
+
+def streaming_timeline(segments, total_duration_ms, window_seconds):
+    """
+    Chuẩn bị ghép theo từng cửa sổ thời gian, chỉ decode segment chồng lên cửa sổ
+    
+    Định dạng output thỏa thuận giống TimelineMixer (định dạng cơ sở nâng
+    theo segment cao nhất, đọc từ header bằng probe_audio_format) nên cùng
+    sample rate, số kênh, sample width và độ dài với cách ghép trong bộ nhớ.
+    Sample chỉ trùng khi mọi segment cùng định dạng: TimelineMixer resample
+    cả timeline đã trộn mỗi lần nâng định dạng, còn ở đây mỗi segment được
+    chuyển thẳng sang định dạng cuối (một lần resample, ít sai số hơn).
+    
+    Args:
+        segments: SegmentTable có field vi_audio_path
+        total_duration_ms: Độ dài timeline (ms)
+        window_seconds: Độ dài mỗi cửa sổ (giây)
+    
+    Returns:
+        (writer, items) để ghi bằng writer.write_wav/write_raw,
+        (None, None) nếu không có segment nào load được
+    """
+    # Sắp xếp theo thời gian bắt đầu
+    order = segments.order(segments.has_audio()).tolist()
+    paths = segments.column("vi_audio_path")
+    
+    def make_loader(i):
+        def load():
+            seg = segments[i]
+            try:
+                audio_seg = load_segment_audio(paths[i])
+                print(f"  [{i+1}/{len(segments)}] ✅ {seg.start:.1f}s - {seg.end:.1f}s")
+                return audio_seg
+            except Exception as e:
+                print(f"  ⚠️ Lỗi ghép segment {i+1}: {e}")
+                return None
+        return load
+    
+    formats = []
+    for i in order:
+        try:
+            formats.append(probe_audio_format(paths[i]))
+        except Exception:
+            continue  # Lỗi sẽ được báo khi ghép segment này
+    
+    if not formats:
+        return None, None
+    fmt = negotiate_format(formats)
+    
+    writer = StreamingTimelineWriter(
+        total_duration_ms,
+        frame_rate=fmt[0],
+        channels=fmt[1],
+        sample_width=fmt[2],
+        window_ms=int(window_seconds * 1000)
+    )
+    start_ms = segments.start_ms
+    items = ((int(start_ms[i]), make_loader(i)) for i in order)
+    return writer, items
+
+
+def _merge_streaming(segments, out_wav, total_duration_ms, window_seconds):
+    """
+    Ghép theo từng cửa sổ thời gian và ghi thẳng ra file WAV
+    
+    Returns:
+        StreamingTimelineWriter đã dùng (writer.spans là vị trí từng segment),
+        None nếu không có segment nào
+    """
+    writer, items = streaming_timeline(segments, total_duration_ms, window_seconds)
+    if writer is None:
+        # Không có segment nào: xuất timeline im lặng như cách thường
+        TimelineMixer(total_duration_ms).export(out_wav)
+        return None
+    writer.write_wav(items, out_wav)
+    return writer
+
+
+def _segment_hash(seg):
+    """Hash input của một segment trên timeline: file audio và vị trí bắt đầu"""
+    return input_hash(audio=audio_fingerprint(seg["vi_audio_path"]), start_ms=seg.start_ms)
+
+
+def _merge_incremental(segments, out_wav, total_duration_ms, window_seconds):
+    """
+    Ghép lại chỉ các cửa sổ thời gian có segment thay đổi
+    
+    Lần ghép trước được ghi vào <out_wav>.merge.json (định dạng, độ dài
+    timeline, hash và vị trí từng segment). Khi chạy lại, segment có hash
+    mới hoặc bị xóa đánh dấu các cửa sổ nó chiếm là "bẩn"; chỉ các cửa sổ
+    đó được render lại và ghi đè tại chỗ vào out_wav. Nếu không dùng lại
+    được (chưa có manifest, đổi độ dài/định dạng) thì ghép toàn bộ bằng
+    streaming và ghi manifest mới.
+    """
+    manifest_path = out_wav + ".merge.json"
+    window_ms = int(window_seconds * 1000)
+    order = segments.order(segments.has_audio()).tolist()
+    hashes = {i: _segment_hash(segments[i]) for i in order}
+    
+    manifest = None
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path, encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = None
+    
+    writer = None
+    if manifest and manifest.get("total_duration_ms") == total_duration_ms \
+            and manifest.get("window_ms") == window_ms:
+        frame_rate, channels, sample_width = manifest["format"]
+        writer = StreamingTimelineWriter(
+            total_duration_ms, frame_rate=frame_rate, channels=channels,
+            sample_width=sample_width, window_ms=window_ms
+        )
+        if not writer.matches_wav(out_wav):
+            writer = None
+    
+    if writer is None:
+        # Ghép toàn bộ, ghi lại vị trí từng segment cho lần sau
+        writer = _merge_streaming(segments, out_wav, total_duration_ms, window_seconds)
+        if writer is None:
+            return
+        entries = [
+            {"hash": hashes[i], "span": list(span)}
+            for i, span in zip(order, writer.spans) if span is not None
+        ]
+        write_json_atomic(manifest_path, {
+            "total_duration_ms": total_duration_ms,
+            "window_ms": window_ms,
+            "format": [writer.frame_rate, writer.channels, writer.sample_width],
+            "segments": entries
+        })
+        return
+    
+    old_spans = {}
+    for entry in manifest["segments"]:
+        old_spans.setdefault(entry["hash"], []).append(tuple(entry["span"]))
+    
+    # Segment không đổi dùng lại vị trí cũ, segment mới/đổi phải decode để biết độ dài
+    spans = {}
+    decoded = {}
+    dirty = []
+    for i in order:
+        kept = old_spans.get(hashes[i])
+        if kept:
+            spans[i] = kept.pop()
+            continue
+        seg = segments[i]
+        try:
+            samples = writer.to_samples(load_segment_audio(seg["vi_audio_path"]))
+        except Exception as e:
+            print(f"  ⚠️ Lỗi ghép segment {i+1}: {e}")
+            continue
+        start = writer.frame_index(seg.start_ms)
+        spans[i] = (start, start + len(samples))
+        decoded[i] = samples
+        dirty.append(spans[i])
+        print(f"  [{i+1}/{len(segments)}] ✏️ {seg.start:.1f}s - {seg.end:.1f}s")
+    # Segment cũ không còn (bị sửa hoặc xóa) cũng làm bẩn vùng nó từng chiếm
+    for removed in old_spans.values():
+        dirty.extend(removed)
+    
+    windows = sorted({
+        k
+        for start, end in dirty
+        for k in range(start // writer.window_frames, (min(end, writer.n_frames) - 1) // writer.window_frames + 1)
+        if start < writer.n_frames and end > start
+    })
+    
+    if windows:
+        print(f"♻️ Ghép lại {len(windows)}/{-(-writer.n_frames // writer.window_frames)} cửa sổ "
+              f"({len(decoded)} segment thay đổi)")
+        
+        def render():
+            for k in windows:
+                w0, w1 = writer.window_bounds(k)
+                placed = []
+                for i, (start, end) in spans.items():
+                    if start >= w1 or end <= w0:
+                        continue
+                    if i not in decoded:
+                        try:
+                            decoded[i] = writer.to_samples(load_segment_audio(segments[i]["vi_audio_path"]))
+                        except Exception as e:
+                            print(f"  ⚠️ Lỗi ghép segment {i+1}: {e}")
+                            continue
+                    placed.append((start, decoded[i]))
+                yield w0, writer.mix_window(w0, w1, placed)
+                # Bỏ các segment đã nằm hẳn trước cửa sổ sau để giới hạn bộ nhớ
+                for i in [i for i in decoded if spans[i][1] <= w1]:
+                    del decoded[i]
+        
+        writer.patch_wav(out_wav, render())
+    else:
+        print("✅ Không có segment nào thay đổi, giữ nguyên audio đã ghép")
+    
+    write_json_atomic(manifest_path, dict(manifest, segments=[
+        {"hash": hashes[i], "span": list(spans[i])} for i in order if i in spans
+    ]))
+
+
+@instrument("merge")
+def merge_segments(segments_json, out_wav, streaming=None, window_seconds=None, incremental=None):
     """
     Ghép các audio segments thành một file audio hoàn chỉnh
     Giữ nguyên timing theo timestamp gốc
     
+    Các segment được cộng vào một bộ đệm NumPy duy nhất (TimelineMixer),
+    kết quả trùng với overlay của pydub trừ khi tổng bị clipping
+    (xem timeline_mixer.py).
+    
+    Chế độ streaming render từng cửa sổ window_seconds và ghi ngay ra file,
+    bộ nhớ chỉ phụ thuộc độ dài cửa sổ và segment dài nhất.
+    
+    Chế độ incremental (dựa trên streaming) nhớ hash từng segment của lần
+    ghép trước; khi chạy lại chỉ render lại các cửa sổ có segment thay đổi.
+    
+    Thứ tự ưu tiên: incremental > streaming > trong bộ nhớ. Bật incremental
+    là ghép theo cửa sổ (và ghi <out_wav>.merge.json) bất kể streaming.
+    
     Args:
-        segments_json: JSON chứa segments với timing và audio paths
+        segments_json: JSON chứa segments với timing và audio paths (hoặc SegmentStore)
         out_wav: Đường dẫn file audio output
+        streaming: Ghép theo cửa sổ (mặc định: config.MERGE_STREAMING)
+        window_seconds: Độ dài cửa sổ (mặc định: config.MERGE_WINDOW_SECONDS)
+        incremental: Chỉ ghép lại phần thay đổi so với lần trước (mặc định: config.MERGE_INCREMENTAL)
     """
+    if streaming is None:
+        streaming = config.MERGE_STREAMING
+    if incremental is None:
+        incremental = config.MERGE_INCREMENTAL
+    window_seconds = window_seconds or config.MERGE_WINDOW_SECONDS
+    
     print("🎵 Đang ghép audio segments...")
     
     try:
         # Load segments
-        with open(segments_json, encoding="utf-8") as f:
-            segments = json.load(f)
+        segments = SegmentTable.load(segments_json, fields=["vi_audio_path"])
         
         # Tính tổng thời lượng
-        max_end_time = max(seg["end"] for seg in segments)
+        max_end_time = segments.end_time()
         total_duration_ms = int(max_end_time * 1000)
         
-        # Tạo audio trống với độ dài tổng
-        final_audio = AudioSegment.silent(duration=total_duration_ms)
-        
         print(f"📊 Tổng thời lượng: {max_end_time:.2f}s")
         
-        # Ghép từng segment vào đúng vị trí
-        for i, seg in enumerate(segments):
-            if seg.get("vi_audio_path") and os.path.exists(seg["vi_audio_path"]):
+        out_dir = os.path.dirname(out_wav)
+        if out_dir:  # Tạo thư mục nếu path có chứa directory
+            os.makedirs(out_dir, exist_ok=True)
+        
+        # incremental dựng trên streaming nên được xét trước streaming
+        if incremental:
+            print(f"💾 Đang ghép (chỉ phần thay đổi, cửa sổ {window_seconds}s): {out_wav}")
+            _merge_incremental(segments, out_wav, total_duration_ms, window_seconds)
+        elif streaming:
+            print(f"💾 Đang ghép và ghi theo cửa sổ {window_seconds}s: {out_wav}")
+            _merge_streaming(segments, out_wav, total_duration_ms, window_seconds)
+        else:
+            # Tạo timeline trống với độ dài tổng
+            mixer = TimelineMixer(total_duration_ms)
+            
+            # Ghép từng segment vào đúng vị trí
+            for i in np.flatnonzero(segments.has_audio()):
+                seg = segments[i]
                 try:
-                    # Load audio segment (hỗ trợ cả MP3 và WAV)
-                    audio_path = seg["vi_audio_path"]
-                    
-                    # Tự động detect format từ extension
-                    if audio_path.lower().endswith('.mp3'):
-                        audio_seg = AudioSegment.from_mp3(audio_path)
-                    elif audio_path.lower().endswith('.wav'):
-                        audio_seg = AudioSegment.from_wav(audio_path)
-                    else:
-                        # Fallback: để pydub tự detect
-                        audio_seg = AudioSegment.from_file(audio_path)
+                    audio_seg = load_segment_audio(seg["vi_audio_path"])
                     
-                    # Vị trí bắt đầu (ms)
-                    start_ms = int(seg["start"] * 1000)
-                    
-                    # Overlay audio vào đúng vị trí
-                    final_audio = final_audio.overlay(audio_seg, position=start_ms)
-                    
-                    print(f"  [{i+1}/{len(segments)}] ✅ {seg['start']:.1f}s - {seg['end']:.1f}s")
+                    # Cộng audio vào đúng vị trí (ms)
+                    mixer.add(audio_seg, seg.start_ms)
                     
+                    print(f"  [{i+1}/{len(segments)}] ✅ {seg.start:.1f}s - {seg.end:.1f}s")
+                
                 except Exception as e:
                     print(f"  ⚠️ Lỗi ghép segment {i+1}: {e}")
                     # Bỏ qua segment lỗi, tiếp tục các segment khác
-        
-        # Xuất file
-        out_dir = os.path.dirname(out_wav)
-        if out_dir:  # Tạo thư mục nếu path có chứa directory
-            os.makedirs(out_dir, exist_ok=True)
-        
-        print(f"💾 Đang xuất file audio: {out_wav}")
-        final_audio.export(out_wav, format="wav", bitrate="192k")
+            
+            print(f"💾 Đang xuất file audio: {out_wav}")
+            mixer.export(out_wav)
         
         # Kiểm tra file đã tạo
         if os.path.exists(out_wav):
             file_size = os.path.getsize(out_wav) / (1024*1024)
             print(f"✅ Ghép audio hoàn tất: {out_wav}")
             print(f"📁 Kích thước: {file_size:.2f} MB")
+            record(segments=len(segments), bytes_written=os.path.getsize(out_wav),
+                   mode="incremental" if incremental else "streaming" if streaming else "memory")
         else:
             print(f"❌ File không được tạo: {out_wav}")
             return False
         
         return True
-        
+    
     except Exception as e:
         print(f"❌ Lỗi ghép audio: {e}")
         import traceback
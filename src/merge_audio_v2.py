@@ -4,18 +4,24 @@ Xử lý tốc độ nói và timing tốt hơn
 """
 
 from pydub import AudioSegment
-import json
 import os
-from utils import normalize_audio, speed_change
+import numpy as np
+from utils import normalize_audio
+from time_stretch import stretch_audio_segments
+from timeline_mixer import TimelineMixer
+from merge_audio import load_segment_audio
+from segment_table import SegmentTable
+from metrics import instrument, record
 
 
+@instrument("merge")
 def merge_segments_v2(segments_json, out_wav, normalize=True):
     """
     Ghép các audio segments thành một file audio hoàn chỉnh
     Tự động điều chỉnh tốc độ nói để khớp với timing gốc
     
     Args:
-        segments_json: JSON chứa segments với timing và audio paths
+        segments_json: JSON chứa segments với timing và audio paths (hoặc SegmentStore)
         out_wav: Đường dẫn file audio output
         normalize: Chuẩn hóa âm lượng
     """
@@ -23,61 +29,76 @@ def merge_segments_v2(segments_json, out_wav, normalize=True):
     
     try:
         # Load segments
-        with open(segments_json, encoding="utf-8") as f:
-            segments = json.load(f)
+        segments = SegmentTable.load(segments_json, fields=["vi_audio_path"])
         
         # Tính tổng thời lượng
-        max_end_time = max(seg["end"] for seg in segments)
+        max_end_time = segments.end_time()
         total_duration_ms = int(max_end_time * 1000)
         
-        # Tạo audio trống
-        final_audio = AudioSegment.silent(duration=total_duration_ms)
+        # Tạo timeline trống (một bộ đệm NumPy, xem timeline_mixer.py)
+        mixer = TimelineMixer(total_duration_ms)
         
         print(f"📊 Tổng thời lượng: {max_end_time:.2f}s")
         print(f"📊 Số segments: {len(segments)}")
         
-        # Ghép từng segment với speed adjustment
-        for i, seg in enumerate(segments):
-            if seg.get("vi_audio_path") and os.path.exists(seg["vi_audio_path"]):
-                try:
-                    # Load audio segment
-                    audio_seg = AudioSegment.from_wav(seg["vi_audio_path"])
-                    
-                    # Normalize volume nếu cần
-                    if normalize:
-                        audio_seg = normalize_audio(audio_seg)
-                    
-                    # Tính timing
-                    start_ms = int(seg["start"] * 1000)
-                    end_ms = int(seg["end"] * 1000)
-                    target_duration_ms = end_ms - start_ms
-                    actual_duration_ms = len(audio_seg)
-                    
-                    # Điều chỉnh tốc độ nếu chênh lệch > 10%
-                    duration_ratio = actual_duration_ms / target_duration_ms
-                    
-                    if duration_ratio > 1.1 or duration_ratio < 0.9:
-                        # Cần điều chỉnh tốc độ
-                        speed_factor = duration_ratio
-                        audio_seg = speed_change(audio_seg, speed=speed_factor)
-                        
-                        print(f"  [{i+1}/{len(segments)}] ⚡ Speed: {speed_factor:.2f}x | {seg['start']:.1f}s-{seg['end']:.1f}s")
-                    else:
-                        print(f"  [{i+1}/{len(segments)}] ✅ {seg['start']:.1f}s-{seg['end']:.1f}s")
-                    
-                    # Overlay audio vào đúng vị trí
-                    final_audio = final_audio.overlay(audio_seg, position=start_ms)
-                    
-                except Exception as e:
-                    print(f"  ⚠️ Lỗi ghép segment {i+1}: {e}")
+        # Load từng segment, tính tốc độ cần điều chỉnh
+        loaded = []  # (index, start_ms, audio_seg, speed)
+        paths = segments.column("vi_audio_path")
+        start_ms_all = segments.start_ms.tolist()
+        target_ms_all = (segments.end_ms - segments.start_ms).tolist()
+        for i in np.flatnonzero(segments.has_audio()).tolist():
+            try:
+                # Load audio segment
+                audio_seg = load_segment_audio(paths[i])
+                
+                # Normalize volume nếu cần
+                if normalize:
+                    audio_seg = normalize_audio(audio_seg)
+                
+                # Timing (ms) tính sẵn trong SegmentTable
+                start_ms = start_ms_all[i]
+                target_duration_ms = target_ms_all[i]
+                actual_duration_ms = len(audio_seg)
+                
+                # Điều chỉnh tốc độ nếu chênh lệch > 10%
+                duration_ratio = actual_duration_ms / target_duration_ms
+                speed = duration_ratio if duration_ratio > 1.1 or duration_ratio < 0.9 else 1.0
+                
+                loaded.append((i, start_ms, audio_seg, speed))
+            
+            except Exception as e:
+                print(f"  ⚠️ Lỗi ghép segment {i+1}: {e}")
+        
+        # Co giãn tất cả segment cần điều chỉnh trong một lần (giữ nguyên cao độ)
+        to_stretch = [k for k, item in enumerate(loaded) if item[3] != 1.0]
+        if to_stretch:
+            stretched = stretch_audio_segments(
+                [loaded[k][2] for k in to_stretch],
+                [loaded[k][3] for k in to_stretch]
+            )
+            for k, audio_seg in zip(to_stretch, stretched):
+                i, start_ms, _, speed = loaded[k]
+                loaded[k] = (i, start_ms, audio_seg, speed)
+        
+        # Ghép từng segment vào đúng vị trí
+        for i, start_ms, audio_seg, speed in loaded:
+            seg = segments[i]
+            if speed != 1.0:
+                print(f"  [{i+1}/{len(segments)}] ⚡ Speed: {speed:.2f}x | {seg.start:.1f}s-{seg.end:.1f}s")
+            else:
+                print(f"  [{i+1}/{len(segments)}] ✅ {seg.start:.1f}s-{seg.end:.1f}s")
+            
+            # Cộng audio vào đúng vị trí
+            mixer.add(audio_seg, start_ms)
         
         # Xuất file
         os.makedirs(os.path.dirname(out_wav), exist_ok=True)
-        final_audio.export(out_wav, format="wav")
+        mixer.export(out_wav)
         
         print(f"✅ Ghép audio hoàn tất: {out_wav}")
+        record(segments=len(loaded), stretched=len(to_stretch), bytes_written=os.path.getsize(out_wav))
         return True
-        
+    
     except Exception as e:
         print(f"❌ Lỗi ghép audio: {e}")
         return False
@@ -1,7 +1,42 @@
 import subprocess
 import os
+import tempfile
 
+import config
+from merge_audio import streaming_timeline
+from segment_table import SegmentTable
+from timeline_mixer import StreamingTimelineWriter, BASE_FRAME_RATE, BASE_CHANNELS, BASE_SAMPLE_WIDTH
+from metrics import instrument, record
 
+
+# Định dạng PCM thô của ffmpeg theo sample width (khớp SAMPLE_DTYPES của timeline_mixer)
+PCM_FORMATS = {1: "s8", 2: "s16le", 4: "s32le"}  # 8-bit: dạng có dấu trong bộ nhớ, không phải u8 của WAV
+
+
+def _mux_command(video_path, audio_input, out_video):
+    """
+    Lệnh FFmpeg: THAY THẾ audio gốc bằng audio VI
+    
+    Args:
+        video_path: Video gốc
+        audio_input: Các tham số input audio (["-i", file] hoặc PCM từ pipe:0)
+        out_video: Video output
+    """
+    return [
+        "ffmpeg", "-y",
+        "-i", video_path,      # Input video (có audio gốc)
+        *audio_input,          # Input audio tiếng Việt
+        "-map", "0:v:0",       # Chọn video stream từ input 0
+        "-map", "1:a:0",       # Chọn audio stream từ input 1 (THAY THẾ audio gốc)
+        "-c:v", config.VIDEO_CODEC,    # copy: không encode lại video
+        "-c:a", config.AUDIO_CODEC,    # Encode audio sang AAC
+        "-b:a", config.AUDIO_BITRATE,  # Audio bitrate
+        "-shortest",           # Cắt theo input ngắn nhất
+        out_video
+    ]
+
+
+@instrument("mux")
 def merge_video(video_path, audio_path, out_video):
     """
     Ghép audio tiếng Việt vào video gốc (THAY THẾ audio gốc)
@@ -19,24 +54,13 @@ def merge_video(video_path, audio_path, out_video):
     os.makedirs(os.path.dirname(out_video), exist_ok=True)
     
     try:
-        # Lệnh FFmpeg: THAY THẾ audio gốc bằng audio VI
-        cmd = [
-            "ffmpeg", "-y",
-            "-i", video_path,      # Input video (có audio gốc)
-            "-i", audio_path,      # Input audio tiếng Việt
-            "-map", "0:v:0",       # Chọn video stream từ input 0
-            "-map", "1:a:0",       # Chọn audio stream từ input 1 (THAY THẾ audio gốc)
-            "-c:v", "copy",        # Copy video codec (không encode lại)
-            "-c:a", "aac",         # Encode audio sang AAC
-            "-b:a", "192k",        # Audio bitrate
-            "-shortest",           # Cắt theo input ngắn nhất
-            out_video
-        ]
+        cmd = _mux_command(video_path, ["-i", audio_path], out_video)
         
         result = subprocess.run(cmd, check=True, capture_output=True, text=True)
         
         print(f"✅ Ghép video thành công: {out_video}")
         print(f"📁 Kích thước: {os.path.getsize(out_video) / (1024*1024):.2f} MB")
+        record(bytes_written=os.path.getsize(out_video))
         return True
         
     except subprocess.CalledProcessError as e:
@@ -54,6 +78,105 @@ def merge_video(video_path, audio_path, out_video):
         return False
 
 
+def _pipe_pcm(cmd, writer, items):
+    """
+    Chạy ffmpeg và ghi timeline vào stdin của nó trong lúc ffmpeg encode
+    
+    stderr ghi ra file tạm thay vì pipe: ffmpeg không bị chặn khi log dài
+    trong lúc process này còn đang ghi stdin.
+    
+    Raises:
+        subprocess.CalledProcessError: ffmpeg trả về mã lỗi (kèm stderr)
+    """
+    with tempfile.TemporaryFile() as log:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                stderr=log, bufsize=0)
+        try:
+            writer.write_raw(items, proc.stdin)
+        except BrokenPipeError:
+            pass  # ffmpeg đã thoát giữa chừng, lỗi lấy từ stderr bên dưới
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            proc.stdin.close()
+            returncode = proc.wait()
+        
+        if returncode != 0:
+            log.seek(0)
+            raise subprocess.CalledProcessError(returncode, cmd, stderr=log.read().decode(errors="replace"))
+
+
+@instrument("mux")
+def merge_segments_to_video(segments_json, video_path, out_video, window_seconds=None):
+    """
+    Ghép audio segments và ghép vào video trong một lượt, không ghi vi_full.wav
+    
+    Timeline được render theo cửa sổ (như merge_segments streaming) và ghi
+    PCM thô thẳng vào stdin của ffmpeg; ffmpeg copy video stream và encode
+    AAC trong cùng process nên trộn audio chạy song song với encode, trên
+    đĩa chỉ có video output. Audio trùng từng sample với vi_full.wav của
+    merge_segments chế độ streaming.
+    
+    Args:
+        segments_json: JSON chứa segments với timing và audio paths (hoặc SegmentStore)
+        video_path: Đường dẫn video gốc
+        out_video: Đường dẫn video output
+        window_seconds: Độ dài cửa sổ (mặc định: config.MERGE_WINDOW_SECONDS)
+    """
+    window_seconds = window_seconds or config.MERGE_WINDOW_SECONDS
+    
+    print(f"🎬 Đang ghép audio segments và ghép vào video (một lượt, không file WAV)...")
+    print(f"   📹 Video: {os.path.basename(video_path)}")
+    
+    try:
+        segments = SegmentTable.load(segments_json, fields=["vi_audio_path"])
+        max_end_time = segments.end_time()
+        total_duration_ms = int(max_end_time * 1000)
+        print(f"📊 Tổng thời lượng: {max_end_time:.2f}s")
+        
+        writer, items = streaming_timeline(segments, total_duration_ms, window_seconds)
+        if writer is None:
+            # Không có segment nào: timeline im lặng cùng định dạng TimelineMixer
+            writer = StreamingTimelineWriter(
+                total_duration_ms, frame_rate=BASE_FRAME_RATE, channels=BASE_CHANNELS,
+                sample_width=BASE_SAMPLE_WIDTH, window_ms=int(window_seconds * 1000)
+            )
+            items = []
+        
+        os.makedirs(os.path.dirname(out_video) or ".", exist_ok=True)
+        cmd = _mux_command(video_path, [
+            "-f", PCM_FORMATS[writer.sample_width],
+            "-ar", str(writer.frame_rate),
+            "-ac", str(writer.channels),
+            "-i", "pipe:0"
+        ], out_video)
+        _pipe_pcm(cmd, writer, items)
+        
+        print(f"✅ Ghép video thành công: {out_video}")
+        print(f"📁 Kích thước: {os.path.getsize(out_video) / (1024*1024):.2f} MB")
+        record(segments=len(segments), bytes_written=os.path.getsize(out_video),
+               pcm_bytes=writer.n_frames * writer.channels * writer.sample_width)
+        return True
+    
+    except subprocess.CalledProcessError as e:
+        print(f"❌ Lỗi khi ghép video:")
+        print(f"   Return code: {e.returncode}")
+        if e.stderr:
+            print(f"   FFmpeg error: {e.stderr[-500:]}")  # In 500 ký tự cuối
+        return False
+    except FileNotFoundError as e:
+        if e.filename != "ffmpeg":
+            print(f"❌ Lỗi ghép audio/video: {e}")
+            return False
+        print("❌ Không tìm thấy ffmpeg. Vui lòng cài đặt ffmpeg.")
+        print("   Download: https://ffmpeg.org/download.html")
+        return False
+    except Exception as e:
+        print(f"❌ Lỗi ghép audio/video: {e}")
+        return False
+
+
 if __name__ == "__main__":
     # Test
     merge_video("../input/video.mp4", "../audio/vi_full.wav", "../output/video_vi.mp4")
@@ -0,0 +1,254 @@
+"""
+Stage Metrics
+Đo từng bước của pipeline (thời gian, CPU, RAM, I/O, số câu, cache) và ghi
+ra file JSON-lines, tùy chọn thêm Prometheus textfile
+
+Mỗi hàm bước được bọc bằng @instrument("tên"). Trong hàm, record()/count()
+gắn thêm số liệu (số câu, byte ghi, thống kê cache) vào bước đang chạy; gọi
+ngoài bước thì không làm gì. Các dòng print cũ vẫn giữ nguyên, cuối mỗi
+bước in thêm một dòng tóm tắt từ chính bản ghi được lưu.
+
+Ghi chú: CPU time, RSS và I/O lấy theo cả process; khi nhiều bước chạy song
+song (stage_dag, batch_dub) số liệu của chúng chồng lên nhau.
+"""
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import config
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Định danh lần chạy (mỗi process một id)
+RUN_ID = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+
+_current = contextvars.ContextVar("metrics_stage", default=None)
+_labels = contextvars.ContextVar("metrics_labels", default={})
+_write_lock = threading.Lock()
+_latest = {}  # (stage, labels) -> bản ghi gần nhất, cho Prometheus
+
+# Các field số được xuất sang Prometheus: field -> (tên metric, mô tả)
+PROMETHEUS_FIELDS = {
+    "wall_seconds": ("dubbing_stage_wall_seconds", "Thời gian chạy của bước"),
+    "cpu_seconds": ("dubbing_stage_cpu_seconds", "CPU time của process trong bước"),
+    "children_cpu_seconds": ("dubbing_stage_children_cpu_seconds", "CPU time của process con (ffmpeg, worker)"),
+    "peak_rss_mb": ("dubbing_stage_peak_rss_megabytes", "RSS cao nhất của process tới cuối bước"),
+    "io_read_bytes": ("dubbing_stage_io_read_bytes", "Byte process đọc trong bước"),
+    "io_write_bytes": ("dubbing_stage_io_write_bytes", "Byte process ghi trong bước"),
+    "segments": ("dubbing_stage_segments", "Số câu bước đã xử lý"),
+    "segments_per_sec": ("dubbing_stage_segments_per_second", "Số câu mỗi giây"),
+    "cache_hit_rate": ("dubbing_stage_cache_hit_rate", "Tỉ lệ hit cache của bước"),
+    "ok": ("dubbing_stage_success", "1 nếu bước thành công")
+}
+
+
+def default_metrics_path():
+    """File metrics mặc định (config.METRICS_FILE, tương đối so với thư mục gốc project)"""
+    path = Path(config.METRICS_FILE)
+    if not path.is_absolute():
+        path = Path(__file__).parent.parent / path
+    return str(path)
+
+
+def _peak_rss_mb():
+    """RSS cao nhất của process (và process con) tính tới hiện tại"""
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux trả về KB, macOS trả về byte
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _children_cpu():
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _io_counters():
+    """(byte đọc, byte ghi) của process từ /proc/self/io, None nếu không có"""
+    try:
+        with open("/proc/self/io") as f:
+            values = dict(line.split(":") for line in f if ":" in line)
+        return int(values["rchar"]), int(values["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+class StageRecord:
+    """Số liệu của một lần chạy bước, các hàm trong bước gắn thêm qua record()/count()"""
+    
+    def __init__(self, stage):
+        self.stage = stage
+        self.fields = {}
+    
+    def set(self, **fields):
+        self.fields.update(fields)
+    
+    def add(self, **counts):
+        for key, value in counts.items():
+            self.fields[key] = self.fields.get(key, 0) + value
+
+
+def record(**fields):
+    """Gán số liệu cho bước đang chạy (vd: bytes_written=...)"""
+    stage = _current.get()
+    if stage is not None:
+        stage.set(**fields)
+
+
+def count(**counts):
+    """Cộng dồn số liệu cho bước đang chạy (vd: segments=1)"""
+    stage = _current.get()
+    if stage is not None:
+        stage.add(**counts)
+
+
+def record_cache(stats):
+    """Gắn thống kê cache (dict hits/misses từ AudioCache/TranslationCache.stats())"""
+    lookups = stats["hits"] + stats["misses"]
+    record(
+        cache_hits=stats["hits"],
+        cache_misses=stats["misses"],
+        cache_hit_rate=round(stats["hits"] / lookups, 4) if lookups else None
+    )
+
+
+@contextlib.contextmanager
+def labels(**values):
+    """Gắn nhãn (vd: video=...) cho mọi bước chạy bên trong"""
+    token = _labels.set(dict(_labels.get(), **values))
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+def _summary(entry):
+    """Dòng tóm tắt dễ đọc của một bản ghi"""
+    parts = [f"{entry['wall_seconds']:.1f}s", f"CPU {entry['cpu_seconds']:.1f}s"]
+    if entry.get("children_cpu_seconds"):
+        parts.append(f"process con {entry['children_cpu_seconds']:.1f}s")
+    if entry.get("segments") is not None:
+        rate = entry.get("segments_per_sec")
+        parts.append(f"{entry['segments']} câu" + (f" ({rate:.1f} câu/s)" if rate else ""))
+    if entry.get("cache_hit_rate") is not None:
+        parts.append(f"cache {entry['cache_hit_rate']:.0%} hit")
+    if entry.get("peak_rss_mb") is not None:
+        parts.append(f"RSS đỉnh {entry['peak_rss_mb']:.0f} MB")
+    return f"⏱️ [{entry['stage']}] " + ", ".join(parts)
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _prometheus_text():
+    lines = []
+    for field, (name, description) in PROMETHEUS_FIELDS.items():
+        samples = [(key, entry[field]) for key, entry in _latest.items()
+                   if isinstance(entry.get(field), (int, float))]
+        if not samples:
+            continue
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} gauge")
+        for (stage, label_items), value in samples:
+            label_text = ",".join(
+                f'{key}="{_escape_label(val)}"'
+                for key, val in (("stage", stage),) + label_items
+            )
+            lines.append(f"{name}{{{label_text}}} {float(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def emit(entry, metrics_path=None, prometheus_path=None):
+    """
+    Lưu một bản ghi: thêm một dòng JSON, cập nhật Prometheus textfile (nếu bật)
+    
+    Lỗi ghi metrics chỉ in cảnh báo, không làm hỏng bước đang chạy.
+    """
+    metrics_path = metrics_path or default_metrics_path()
+    prometheus_path = prometheus_path or config.METRICS_PROMETHEUS_FILE
+    with _write_lock:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(metrics_path)), exist_ok=True)
+            with open(metrics_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            
+            if prometheus_path:
+                key = (entry["stage"], tuple(sorted(entry["labels"].items())))
+                _latest[key] = entry
+                # Ghi qua file tạm để node_exporter không đọc phải file ghi dở
+                tmp_path = f"{prometheus_path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.write(_prometheus_text())
+                os.replace(tmp_path, prometheus_path)
+        except OSError as e:
+            print(f"⚠️ Không ghi được metrics: {e}")
+
+
+def instrument(stage):
+    """
+    Decorator đo một hàm bước pipeline
+    
+    Hàm trả về False (hoặc raise) được ghi ok=false. Tắt bằng config.METRICS_ENABLED.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not config.METRICS_ENABLED:
+                return func(*args, **kwargs)
+            
+            current = StageRecord(stage)
+            token = _current.set(current)
+            read0, write0 = _io_counters()
+            children0 = _children_cpu()
+            cpu0 = time.process_time()
+            t0 = time.perf_counter()
+            started = time.time()
+            result = None
+            error = None
+            try:
+                result = func(*args, **kwargs)
+                return result
+            except BaseException as e:
+                error = repr(e)
+                raise
+            finally:
+                _current.reset(token)
+                wall = time.perf_counter() - t0
+                read1, write1 = _io_counters()
+                entry = {
+                    "run_id": RUN_ID,
+                    "stage": stage,
+                    "labels": _labels.get(),
+                    "started_at": round(started, 3),
+                    "wall_seconds": round(wall, 4),
+                    "cpu_seconds": round(time.process_time() - cpu0, 4),
+                    "children_cpu_seconds": round(_children_cpu() - children0, 4),
+                    "peak_rss_mb": _peak_rss_mb(),
+                    "io_read_bytes": read1 - read0 if read0 is not None else None,
+                    "io_write_bytes": write1 - write0 if write0 is not None else None,
+                    "ok": error is None and result is not False and result is not None,
+                    "error": error
+                }
+                entry.update(current.fields)
+                if entry.get("segments") and wall > 0:
+                    entry["segments_per_sec"] = round(entry["segments"] / wall, 3)
+                emit(entry)
+                print(_summary(entry))
+        return wrapper
+    return decorator
@@ -0,0 +1,207 @@
+"""
+Model Registry
+Load model một lần và dùng lại trong cùng process (Whisper theo kích
+thước, pipeline dịch theo tên model)
+
+Khi lồng tiếng nhiều video trong một process, mỗi model chỉ load ở lần
+dùng đầu tiên. Số model giữ trong RAM bị giới hạn (theo số lượng và dung
+lượng ước tính), vượt quá thì bỏ model ít được dùng nhất (LRU).
+"""
+import gc
+import threading
+import time
+from collections import OrderedDict
+
+import config
+
+
+def model_nbytes(model):
+    """
+    Ước tính dung lượng RAM của model (tổng parameters + buffers của torch)
+    
+    Returns:
+        Số byte, 0 nếu không ước tính được
+    """
+    # transformers pipeline giữ model torch trong .model
+    module = getattr(model, "model", model)
+    total = 0
+    for attr in ("parameters", "buffers"):
+        tensors = getattr(module, attr, None)
+        if not callable(tensors):
+            continue
+        try:
+            total += sum(t.numel() * t.element_size() for t in tensors())
+        except Exception:
+            pass
+    return total
+
+
+class ModelRegistry:
+    """
+    Cache model dùng chung trong process
+    
+    - Load lazy: chỉ load khi get() lần đầu, thread-safe (mỗi key load một lần)
+    - Giới hạn max_models model và max_bytes dung lượng, bỏ theo LRU
+    - Ghi lại thời gian load, số lần hit/load/evict của từng model
+    """
+    
+    def __init__(self, max_models=None, max_bytes=None):
+        """
+        Args:
+            max_models: Số model tối đa (mặc định: config.MODEL_CACHE_MAX_MODELS, 0 = không giới hạn)
+            max_bytes: Dung lượng tối đa (mặc định: config.MODEL_CACHE_MAX_MB, 0 = không giới hạn)
+        """
+        self.max_models = max_models if max_models is not None else config.MODEL_CACHE_MAX_MODELS
+        self.max_bytes = max_bytes if max_bytes is not None else config.MODEL_CACHE_MAX_MB * 1024 * 1024
+        self._models = OrderedDict()  # key -> model, cuối = dùng gần nhất
+        self._sizes = {}
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._loading = {}  # key -> lock, để hai thread không load cùng model
+    
+    def _metric(self, key):
+        return self._metrics.setdefault(key, {
+            "loads": 0,
+            "hits": 0,
+            "evictions": 0,
+            "load_seconds": 0.0,
+            "last_load_seconds": 0.0,
+            "bytes": 0
+        })
+    
+    def get(self, key, loader):
+        """
+        Lấy model theo key, gọi loader() để load nếu chưa có
+        
+        Args:
+            key: Key định danh model (vd: ("whisper", "small"))
+            loader: Hàm không tham số trả về model
+        
+        Returns:
+            Model đã load
+        """
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                self._metric(key)["hits"] += 1
+                return self._models[key]
+            key_lock = self._loading.setdefault(key, threading.Lock())
+        
+        with key_lock:
+            # Thread khác có thể vừa load xong trong lúc chờ
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    self._metric(key)["hits"] += 1
+                    return self._models[key]
+            
+            t0 = time.perf_counter()
+            model = loader()
+            elapsed = time.perf_counter() - t0
+            size = model_nbytes(model)
+            
+            with self._lock:
+                self._models[key] = model
+                self._sizes[key] = size
+                metric = self._metric(key)
+                metric["loads"] += 1
+                metric["load_seconds"] += elapsed
+                metric["last_load_seconds"] = elapsed
+                metric["bytes"] = size
+                self._evict_over_limit(keep=key)
+        
+        print(f"📦 Đã load model {'/'.join(key)} trong {elapsed:.1f}s ({size / (1024*1024):.0f} MB)")
+        return model
+    
+    def _evict_over_limit(self, keep):
+        """Bỏ model ít dùng nhất đến khi dưới giới hạn (không bỏ model vừa load)"""
+        while len(self._models) > 1:
+            over_count = self.max_models and len(self._models) > self.max_models
+            over_bytes = self.max_bytes and sum(self._sizes.values()) > self.max_bytes
+            if not (over_count or over_bytes):
+                break
+            key = next(k for k in self._models if k != keep)
+            self._drop(key)
+            print(f"♻️ Giải phóng model {'/'.join(key)}")
+        gc.collect()
+    
+    def _drop(self, key):
+        del self._models[key]
+        self._sizes.pop(key, None)
+        self._metric(key)["evictions"] += 1
+    
+    def evict(self, key=None):
+        """
+        Giải phóng một model (hoặc tất cả nếu key=None)
+        
+        Returns:
+            Số model đã giải phóng
+        """
+        with self._lock:
+            keys = list(self._models) if key is None else [k for k in [key] if k in self._models]
+            for k in keys:
+                self._drop(k)
+        gc.collect()
+        return len(keys)
+    
+    def loaded(self):
+        """Danh sách key của các model đang giữ trong RAM (cũ → mới)"""
+        with self._lock:
+            return list(self._models)
+    
+    def stats(self):
+        """
+        Thống kê theo model
+        
+        Returns:
+            dict key (dạng "loại/tên") -> loads, hits, evictions,
+            load_seconds, last_load_seconds, bytes, loaded
+        """
+        with self._lock:
+            return {
+                "/".join(key): dict(metric, loaded=key in self._models)
+                for key, metric in self._metrics.items()
+            }
+    
+    def get_whisper(self, model_size="small"):
+        """Whisper model theo kích thước (tiny, base, small, medium, large)"""
+        def load():
+            import whisper
+            return whisper.load_model(model_size)
+        return self.get(("whisper", model_size), load)
+    
+    def get_translator(self, model_name=None):
+        """transformers translation pipeline (mặc định: config.TRANSLATION_MODEL)"""
+        model_name = model_name or config.TRANSLATION_MODEL
+        
+        def load():
+            from transformers import pipeline
+            return pipeline(
+                "translation",
+                model=model_name,
+                device=-1  # CPU mode
+            )
+        return self.get(("translation", model_name), load)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """Registry dùng chung của process (tạo khi dùng lần đầu)"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ModelRegistry()
+        return _registry
+
+
+def get_whisper_model(model_size="small"):
+    """Whisper model từ registry dùng chung"""
+    return get_registry().get_whisper(model_size)
+
+
+def get_translator(model_name=None):
+    """Pipeline dịch từ registry dùng chung"""
+    return get_registry().get_translator(model_name)
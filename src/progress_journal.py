@@ -0,0 +1,123 @@
+"""
+Progress Journal
+Ghi tiến độ theo từng segment vào file JSONL chỉ-ghi-thêm (append-only)
+
+Mỗi segment xử lý xong được ghi một dòng {"key", "hash", ...kết quả} và
+flush ngay, nên khi bị dừng giữa chừng (crash, Ctrl+C) lần chạy sau chỉ
+làm lại các segment chưa có trong journal hoặc có input đã thay đổi
+(hash khác).
+"""
+import hashlib
+import json
+import os
+
+
+def input_hash(**fields):
+    """
+    Hash các input quyết định kết quả của một segment
+    
+    Returns:
+        SHA-256 hex digest
+    """
+    payload = json.dumps(fields, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def file_fingerprint(path):
+    """Định danh rẻ của file (đường dẫn, kích thước, mtime) để đưa vào input hash"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+
+class ProgressJournal:
+    """
+    Journal tiến độ dạng JSONL
+    
+    - Đọc lại journal cũ khi mở, bản ghi sau cùng của mỗi key được dùng
+    - Dòng cuối bị ghi dở (crash giữa lúc ghi) được bỏ qua
+    - Khi đóng, journal được gộp lại (mỗi key một dòng) nếu có nhiều dòng cũ
+    """
+    
+    def __init__(self, path, fsync_every=50):
+        """
+        Args:
+            path: File journal (.jsonl)
+            fsync_every: fsync sau mỗi N bản ghi (flush luôn được gọi sau mỗi bản ghi)
+        """
+        self.path = path
+        self.fsync_every = fsync_every
+        self._records = {}
+        self._lines = 0
+        self._pending = 0
+        
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # dòng ghi dở
+                    self._records[record["key"]] = record
+                    self._lines += 1
+        
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+        # Dòng ghi dở không có "\n": xuống dòng để bản ghi mới không dính vào nó
+        if self._file.tell() > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._file.write("\n")
+    
+    def get(self, key, hash_value):
+        """
+        Bản ghi của key nếu input không đổi (hash khớp), ngược lại None
+        """
+        record = self._records.get(str(key))
+        if record is None or record.get("hash") != hash_value:
+            return None
+        return record
+    
+    def record(self, key, hash_value, **fields):
+        """Ghi kết quả của một segment và flush ngay"""
+        record = dict(fields, key=str(key), hash=hash_value)
+        self._records[record["key"]] = record
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self._lines += 1
+        self._pending += 1
+        if self._pending >= self.fsync_every:
+            os.fsync(self._file.fileno())
+            self._pending = 0
+    
+    def close(self):
+        """Đóng journal, gộp các dòng cũ nếu journal đã phình to"""
+        if self._file.closed:
+            return
+        if self._pending:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        
+        if self._lines > 2 * len(self._records):
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for record in self._records.values():
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.path)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_json_atomic(path, data):
+    """Ghi JSON qua file tạm + os.replace để không bao giờ để lại file ghi dở"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
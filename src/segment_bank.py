@@ -0,0 +1,307 @@
+"""
+Segment Bank
+Audio của mọi segment (PCM float32) trong một file duy nhất, đọc qua memory map
+
+TTS decode MP3 của Edge TTS đúng một lần, mix với audio gốc bằng NumPy rồi
+ghi PCM float32 vào bank; merge đọc thẳng từ bank qua memory map. Giữa các
+bước không còn encode MP3 lại (mất chất lượng mỗi lần) và không còn mỗi
+segment một process ffmpeg để decode; chỉ bước ghép video cuối cùng encode.
+
+Lưu ý: timeline của merge (TimelineMixer/StreamingTimelineWriter) và
+vi_full.wav là PCM 16 bit, nên khi ghép mỗi segment được lượng tử hóa
+float32 → int16 đúng một lần (load_bank_audio). Float32 giữ tới lúc ghép
+audio, không phải tới lúc ghép video.
+
+Định dạng:
+- <bank> (sau mỗi lần dọn rác: <bank>.1, <bank>.2...): PCM float32
+  little-endian, các segment nối tiếp nhau (chỉ ghi thêm, segment ghi lại
+  thì bản cũ thành rác, được dọn khi rác nhiều hơn dữ liệu)
+- <bank>.json: tên file dữ liệu hiện tại và index key -> offset, số frame,
+  số kênh, sample rate, hash
+
+Segment trỏ tới bank bằng vi_audio_path dạng "<bank>#<key>" (vd:
+audio/vi_segments/segments.bank#0012). Các bước đọc audio dùng
+audio_exists/audio_fingerprint/load_bank_audio thay cho os.path và
+file_fingerprint để nhận cả đường dẫn file thường lẫn tham chiếu bank.
+"""
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from progress_journal import file_fingerprint, write_json_atomic
+from time_stretch import float_to_audio_segment
+
+
+BANK_NAME = "segments.bank"
+BANK_SEPARATOR = "#"
+
+_SAMPLE_DTYPE = np.dtype("<f4")
+
+_banks = {}  # đường dẫn tuyệt đối -> SegmentBank, dùng chung trong process
+_banks_lock = threading.Lock()
+
+
+class SegmentBank:
+    """
+    File PCM float32 chứa audio của nhiều segment, truy cập theo key
+    
+    Ghi: put() nối thêm vào cuối file dữ liệu, index chỉ được ghi ra đĩa
+    khi flush() (ghi qua file tạm) nên bị dừng giữa chừng chỉ mất các
+    segment chưa flush, không làm hỏng segment cũ.
+    Dọn rác: dữ liệu còn dùng được chép sang file dữ liệu mới (<bank>.<n>),
+    index mới trỏ sang file đó; file cũ chỉ bị xóa sau khi index mới đã
+    ghi xong, nên index trên đĩa luôn khớp với file dữ liệu nó trỏ tới.
+    Đọc: get() trả về view trên memory map, không copy. Khi đọc index, hash
+    từng segment được kiểm tra; segment sai hash bị bỏ (coi như chưa có).
+    """
+    
+    def __init__(self, path):
+        """
+        Args:
+            path: File bank (vd: audio/vi_segments/segments.bank), dùng trong tham chiếu
+        """
+        self.path = str(path)
+        self.index_path = self.path + ".json"
+        self.data_path = self.path
+        self.generation = 0
+        self._lock = threading.RLock()
+        self._map = None
+        self._dirty = False
+        self.entries = {}
+        self._index_mtime = None
+        self._load_index()
+    
+    def _load_index(self):
+        """Đọc index, bỏ các entry trỏ ra ngoài file dữ liệu hoặc sai hash"""
+        self.entries = {}
+        self.data_path = self.path
+        self.generation = 0
+        self._index_mtime = None
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                index = json.load(f)
+            self._index_mtime = os.stat(self.index_path).st_mtime_ns
+        except (OSError, ValueError):
+            return
+        self.generation = index.get("generation", 0)
+        self.data_path = os.path.join(os.path.dirname(self.path), index.get("data", os.path.basename(self.path)))
+        try:
+            size = os.path.getsize(self.data_path)
+        except OSError:
+            return
+        
+        data = np.memmap(self.data_path, dtype=np.uint8, mode="r") if size else None
+        for key, entry in index.get("entries", {}).items():
+            end = entry["offset"] + entry["frames"] * entry["channels"] * _SAMPLE_DTYPE.itemsize
+            if end > size:
+                continue
+            raw = data[entry["offset"]:end] if data is not None else b""
+            if hashlib.sha256(raw).hexdigest()[:32] == entry["hash"]:
+                self.entries[key] = entry
+        del data
+    
+    def _reload_if_changed(self):
+        """Process khác (bước TTS chạy riêng) đã ghi index mới thì đọc lại"""
+        if self._dirty:
+            return
+        try:
+            mtime = os.stat(self.index_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime != self._index_mtime:
+            self._map = None
+            self._load_index()
+    
+    def ref(self, key):
+        """Tham chiếu lưu vào vi_audio_path"""
+        return f"{self.path}{BANK_SEPARATOR}{key}"
+    
+    def __contains__(self, key):
+        with self._lock:
+            self._reload_if_changed()
+            return key in self.entries
+    
+    def put(self, key, samples, frame_rate):
+        """
+        Ghi audio của một segment (thay bản cũ nếu key đã có)
+        
+        Args:
+            key: Key segment (vd: "0012")
+            samples: np.ndarray float shape (n_frames, channels)
+            frame_rate: Sample rate
+        
+        Returns:
+            Tham chiếu "<bank>#<key>"
+        """
+        data = np.ascontiguousarray(samples, dtype=_SAMPLE_DTYPE)
+        if data.ndim == 1:
+            data = data.reshape(-1, 1)
+        raw = data.tobytes()
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.data_path, "ab") as f:
+                offset = f.tell()
+                f.write(raw)
+            self.entries[key] = {
+                "offset": offset,
+                "frames": data.shape[0],
+                "channels": data.shape[1],
+                "frame_rate": frame_rate,
+                "hash": hashlib.sha256(raw).hexdigest()[:32]
+            }
+            self._map = None
+            self._dirty = True
+        return self.ref(key)
+    
+    def get(self, key):
+        """
+        Audio của một segment
+        
+        Returns:
+            (samples float32 shape (n_frames, channels), frame_rate); samples
+            là view chỉ đọc trên memory map
+        """
+        with self._lock:
+            self._reload_if_changed()
+            entry = self.entries[key]
+            if entry["frames"] == 0:
+                return np.zeros((0, entry["channels"]), dtype=_SAMPLE_DTYPE), entry["frame_rate"]
+            if self._map is None:
+                self._map = np.memmap(self.data_path, dtype=_SAMPLE_DTYPE, mode="r")
+            start = entry["offset"] // _SAMPLE_DTYPE.itemsize
+            n = entry["frames"] * entry["channels"]
+            samples = self._map[start:start + n].reshape(-1, entry["channels"])
+        return samples, entry["frame_rate"]
+    
+    def audio_segment(self, key, sample_width=2):
+        """Audio của một segment dưới dạng pydub AudioSegment (chuyển trong bộ nhớ, lượng tử hóa về sample_width)"""
+        samples, frame_rate = self.get(key)
+        return float_to_audio_segment(samples, frame_rate, sample_width)
+    
+    def _compact(self):
+        """
+        Chép các segment còn dùng sang file dữ liệu mới khi phần rác lớn hơn dữ liệu
+        
+        Returns:
+            File dữ liệu cũ cần xóa sau khi ghi index mới, None nếu không dọn
+        """
+        live = sum(entry["frames"] * entry["channels"] for entry in self.entries.values()) * _SAMPLE_DTYPE.itemsize
+        try:
+            size = os.path.getsize(self.data_path)
+        except OSError:
+            return None
+        if size - live <= live:
+            return None
+        
+        # Tên theo thế hệ: lần dọn trước bị dừng giữa chừng thì file dở bị ghi đè
+        generation = self.generation + 1
+        new_path = f"{self.path}.{generation}"
+        source = np.memmap(self.data_path, dtype=_SAMPLE_DTYPE, mode="r") if size else None
+        entries = {}
+        with open(new_path, "wb") as f:
+            for key, entry in sorted(self.entries.items(), key=lambda item: item[1]["offset"]):
+                start = entry["offset"] // _SAMPLE_DTYPE.itemsize
+                n = entry["frames"] * entry["channels"]
+                entries[key] = dict(entry, offset=f.tell())
+                f.write(source[start:start + n].tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        del source
+        
+        old_path = self.data_path
+        self._map = None
+        self.data_path = new_path
+        self.generation = generation
+        self.entries = entries
+        return old_path
+    
+    def flush(self):
+        """Ghi index ra đĩa (dọn rác trước nếu cần, file cũ chỉ xóa sau khi index đã ghi)"""
+        with self._lock:
+            if not self._dirty:
+                return
+            old_path = self._compact()
+            write_json_atomic(self.index_path, {
+                "data": os.path.basename(self.data_path),
+                "generation": self.generation,
+                "entries": self.entries
+            })
+            self._index_mtime = os.stat(self.index_path).st_mtime_ns
+            self._dirty = False
+            if old_path:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+    
+    def close(self):
+        """Flush và bỏ memory map"""
+        with self._lock:
+            self.flush()
+            self._map = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_bank(path):
+    """SegmentBank của một file, dùng chung trong process (TTS ghi, merge đọc)"""
+    key = os.path.abspath(str(path))
+    with _banks_lock:
+        bank = _banks.get(key)
+        if bank is None:
+            bank = _banks[key] = SegmentBank(path)
+        return bank
+
+
+def split_ref(path):
+    """(file bank, key) nếu path là tham chiếu bank, ngược lại None"""
+    if not isinstance(path, str) or BANK_SEPARATOR not in path:
+        return None
+    bank_path, key = path.rsplit(BANK_SEPARATOR, 1)
+    if not bank_path.endswith(".bank"):
+        return None
+    return bank_path, key
+
+
+def audio_exists(path):
+    """Audio của segment có tồn tại không (file thường hoặc entry trong bank)"""
+    if not path:
+        return False
+    ref = split_ref(path)
+    if ref is None:
+        return os.path.exists(path)
+    return ref[1] in open_bank(ref[0])
+
+
+def audio_fingerprint(path):
+    """Định danh rẻ của audio segment để đưa vào input hash (thay file_fingerprint)"""
+    ref = split_ref(path)
+    if ref is None:
+        return file_fingerprint(path)
+    bank = open_bank(ref[0])
+    if ref[1] not in bank:
+        return None
+    return [os.path.abspath(ref[0]), ref[1], bank.entries[ref[1]]["hash"]]
+
+
+def bank_audio_format(path, sample_width=2):
+    """(frame_rate, channels, sample_width) của audio load_bank_audio trả về, chỉ đọc index"""
+    bank_path, key = split_ref(path)
+    bank = open_bank(bank_path)
+    if key not in bank:
+        raise KeyError(path)
+    entry = bank.entries[key]
+    return entry["frame_rate"], entry["channels"], sample_width
+
+
+def load_bank_audio(path, sample_width=2):
+    """AudioSegment từ tham chiếu "<bank>#<key>" (không qua ffmpeg)"""
+    bank_path, key = split_ref(path)
+    return open_bank(bank_path).audio_segment(key, sample_width)
@@ -0,0 +1,256 @@
+"""
+Segment Store
+Lưu danh sách segment trong SQLite: mỗi segment một dòng, mỗi field một cột
+
+Các bước pipeline chỉ đọc các cột mình cần và chỉ cập nhật các field mình
+sở hữu (dịch: vi_text, phân tích giọng: voice_*, TTS: audio...), mỗi lần
+cập nhật là một transaction nên bị dừng giữa chừng không làm hỏng dữ liệu.
+Import/export sang đúng định dạng JSON cũ (en.json, vi.json) để tương thích.
+
+Các hàm nhận segments (transcribe, translate_segments, ...) nhận được cả
+đường dẫn JSON lẫn SegmentStore qua load_segments/save_segments.
+"""
+import json
+import os
+import sqlite3
+import threading
+
+from progress_journal import write_json_atomic
+
+
+# Các field có cột riêng (theo thứ tự field trong JSON), field khác nằm trong cột extra
+COLUMNS = {
+    "id": "INTEGER",
+    "start": "REAL",
+    "end": "REAL",
+    "text": "TEXT",
+    "vi_text": "TEXT",
+    "voice_gender": "TEXT",
+    "voice_emotion": "TEXT",
+    "voice_pitch": "REAL",
+    "tts_rate_adjust": "TEXT",
+    "vi_text_cleaned": "TEXT",
+    "vi_audio_path": "TEXT"
+}
+
+
+def _quote(name):
+    # "end" là từ khóa SQL
+    return '"' + name.replace('"', '""') + '"'
+
+
+class SegmentStore:
+    """
+    Danh sách segment trong một file SQLite
+    
+    - Segment được đánh số theo vị trí (0, 1, 2...) giống index trong list JSON
+    - Cột NULL nghĩa là segment không có field đó; field có giá trị None
+      hoặc không có cột riêng được lưu trong cột extra (JSON)
+    - WAL mode + busy timeout: các bước chạy song song cập nhật các cột khác
+      nhau của cùng một store được
+    """
+    
+    def __init__(self, path, timeout=30):
+        """
+        Args:
+            path: File SQLite (vd: subtitles/segments.sqlite)
+            timeout: Thời gian chờ khi store đang bị bước khác ghi (giây)
+        """
+        self.path = str(path)
+        store_dir = os.path.dirname(self.path)
+        if store_dir:
+            os.makedirs(store_dir, exist_ok=True)
+        
+        # Một kết nối dùng chung giữa các thread (batch_dub chạy mỗi bước trên thread khác)
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(self.path, timeout=timeout, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        columns = "".join(f", {_quote(name)} {kind}" for name, kind in COLUMNS.items())
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS segments (idx INTEGER PRIMARY KEY{columns}, extra TEXT)")
+        self._conn.commit()
+    
+    @staticmethod
+    def _split(fields, extra=None):
+        """Tách field thành (giá trị các cột, extra mới hoặc None)"""
+        extra = dict(extra or {})
+        values = {}
+        for key, value in fields.items():
+            if key in COLUMNS:
+                values[key] = value
+                if value is None:
+                    extra[key] = None  # phân biệt "có field, giá trị None" với "không có field"
+                else:
+                    extra.pop(key, None)
+            else:
+                extra[key] = value
+        return values, json.dumps(extra, ensure_ascii=False) if extra else None
+    
+    @staticmethod
+    def _join(names, row, full):
+        """Dựng lại dict segment từ một dòng (các cột names + extra)"""
+        extra = json.loads(row[-1]) if row[-1] else {}
+        seg = {}
+        for name, value in zip(names, row):
+            if value is not None:
+                seg[name] = value
+            elif name in extra:
+                seg[name] = extra[name]
+        if full:
+            seg.update((key, value) for key, value in extra.items() if key not in COLUMNS)
+        return seg
+    
+    def count(self):
+        """Số segment"""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM segments").fetchone()[0]
+    
+    def rows(self, columns=None):
+        """
+        Đọc các segment, chỉ lấy các cột cần thiết
+        
+        Args:
+            columns: List field cần đọc (mặc định: tất cả, đúng định dạng JSON cũ)
+        
+        Returns:
+            List dict theo thứ tự segment, field không có thì không có key
+        """
+        names = list(COLUMNS) if columns is None else list(columns)
+        selected = ", ".join(_quote(name) if name in COLUMNS else "NULL" for name in names)
+        with self._lock:
+            rows = self._conn.execute(f"SELECT {selected}, extra FROM segments ORDER BY idx").fetchall()
+        return [self._join(names, row, columns is None) for row in rows]
+    
+    def column(self, name):
+        """Giá trị một field của mọi segment (None nếu segment không có field đó)"""
+        if name in COLUMNS:
+            # Cột riêng: đọc thẳng giá trị (NULL = không có hoặc None, đều là None)
+            with self._lock:
+                return [row[0] for row in self._conn.execute(f"SELECT {_quote(name)} FROM segments ORDER BY idx")]
+        return [seg.get(name) for seg in self.rows([name])]
+    
+    def replace(self, segments):
+        """Thay toàn bộ segment (vd: sau khi nhận dạng lại) trong một transaction"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM segments")
+            for idx, seg in enumerate(segments):
+                values, extra = self._split(seg)
+                names = ["idx"] + list(values) + ["extra"]
+                self._conn.execute(
+                    f"INSERT INTO segments ({', '.join(map(_quote, names))})"
+                    f" VALUES ({', '.join('?' * len(names))})",
+                    [idx] + list(values.values()) + [extra]
+                )
+    
+    def update_many(self, updates):
+        """
+        Cập nhật một số field của nhiều segment trong một transaction
+        
+        Field không được nhắc tới giữ nguyên, nên hai bước cập nhật các field
+        khác nhau không ghi đè kết quả của nhau.
+        
+        Args:
+            updates: Iterable (index segment, dict field -> giá trị)
+        """
+        updates = [(int(idx), fields) for idx, fields in updates if fields]
+        if not updates:
+            return
+        with self._lock, self._conn:
+            extras = {}
+            indices = [idx for idx, _ in updates]
+            for k in range(0, len(indices), 500):
+                chunk = indices[k:k + 500]
+                extras.update(
+                    (idx, json.loads(extra)) for idx, extra in self._conn.execute(
+                        f"SELECT idx, extra FROM segments WHERE extra IS NOT NULL"
+                        f" AND idx IN ({','.join('?' * len(chunk))})", chunk
+                    )
+                )
+            for idx, fields in updates:
+                values, extra = self._split(fields, extras.get(idx))
+                assignments = ", ".join(f"{_quote(name)} = ?" for name in list(values) + ["extra"])
+                cursor = self._conn.execute(
+                    f"UPDATE segments SET {assignments} WHERE idx = ?",
+                    list(values.values()) + [extra, idx]
+                )
+                if cursor.rowcount == 0:
+                    raise KeyError(f"Không có segment {idx} trong {self.path}")
+    
+    def update(self, idx, **fields):
+        """Cập nhật một segment (một transaction)"""
+        self.update_many([(idx, fields)])
+    
+    def import_json(self, json_path):
+        """Nạp segments từ file JSON (định dạng en.json/vi.json), thay toàn bộ store"""
+        with open(json_path, encoding="utf-8") as f:
+            segments = json.load(f)
+        self.replace(segments)
+        return len(segments)
+    
+    def export_json(self, json_path, columns=None):
+        """Ghi segments ra file JSON (ghi qua file tạm, không bao giờ ghi dở)"""
+        out_dir = os.path.dirname(str(json_path))
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+        segments = self.rows(columns)
+        write_json_atomic(str(json_path), segments)
+        return len(segments)
+    
+    def close(self):
+        """Đóng kết nối SQLite"""
+        with self._lock:
+            self._conn.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+
+
+def segments_path(source):
+    """Đường dẫn file của segments (JSON hoặc file SQLite của store)"""
+    return source.path if isinstance(source, SegmentStore) else str(source)
+
+
+def load_segments(source, columns=None):
+    """
+    Đọc segments từ file JSON hoặc SegmentStore
+    
+    Args:
+        source: Đường dẫn JSON hoặc SegmentStore
+        columns: Với store, chỉ đọc các field này (JSON luôn đọc đủ)
+    
+    Returns:
+        List dict segment
+    """
+    if isinstance(source, SegmentStore):
+        return source.rows(columns)
+    with open(source, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_segments(target, segments, fields=None):
+    """
+    Lưu segments vào file JSON hoặc SegmentStore
+    
+    Args:
+        target: Đường dẫn JSON (ghi lại toàn bộ, qua file tạm) hoặc SegmentStore
+        segments: List dict segment
+        fields: Với store, chỉ cập nhật các field này của từng segment (field
+                bước đang chạy sở hữu); None hoặc số segment khác thì thay toàn bộ
+    """
+    if isinstance(target, SegmentStore):
+        if fields is not None and target.count() == len(segments):
+            target.update_many(
+                (i, {name: seg[name] for name in fields if name in seg})
+                for i, seg in enumerate(segments)
+            )
+        else:
+            target.replace(segments)
+        return
+    
+    out_dir = os.path.dirname(str(target))
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    write_json_atomic(str(target), segments)
@@ -0,0 +1,248 @@
+"""
+Segment Table
+Danh sách segment dạng cột trong bộ nhớ, dùng chung cho merge, phân tích giọng và TTS
+
+Timing (start, end và offset ms) nằm trong một NumPy structured array, các
+field khác là list theo cột. Offset ms và offset sample được tính một lần
+cho cả bảng thay vì mỗi bước tự tính int(seg["start"] * 1000) trong vòng lặp;
+các truy vấn (tổng thời lượng, segment trong cửa sổ, segment chồng nhau) là
+phép toán trên mảng.
+
+Cách làm tròn giữ đúng như code cũ (cắt phần lẻ như int()) để kết quả merge,
+phân tích giọng và hash tiến độ không đổi.
+"""
+import numpy as np
+
+from segment_bank import audio_exists
+from segment_store import SegmentStore, load_segments
+
+
+# Giá trị cột cho segment không có field (khác với field có giá trị None)
+_MISSING = object()
+
+# 16 byte/segment cho start, end + 16 byte cho offset ms
+TIMING_DTYPE = np.dtype([
+    ("start", "f8"),
+    ("end", "f8"),
+    ("start_ms", "i8"),
+    ("end_ms", "i8")
+])
+
+
+class Segment:
+    """
+    Một dòng của SegmentTable (chỉ đọc, không copy dữ liệu)
+    
+    Đọc timing qua thuộc tính (seg.start, seg.end_ms...), field khác qua
+    seg["vi_audio_path"] hoặc seg.get(...) như dict cũ.
+    """
+    __slots__ = ("table", "index")
+    
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+    
+    @property
+    def start(self):
+        return float(self.table.timing["start"][self.index])
+    
+    @property
+    def end(self):
+        return float(self.table.timing["end"][self.index])
+    
+    @property
+    def start_ms(self):
+        return int(self.table.timing["start_ms"][self.index])
+    
+    @property
+    def end_ms(self):
+        return int(self.table.timing["end_ms"][self.index])
+    
+    @property
+    def duration(self):
+        return self.end - self.start
+    
+    def get(self, name, default=None):
+        column = self.table.fields.get(name)
+        if column is None:
+            return getattr(self, name) if name in TIMING_DTYPE.names else default
+        value = column[self.index]
+        return default if value is _MISSING else value
+    
+    def __getitem__(self, name):
+        if name in TIMING_DTYPE.names:
+            return getattr(self, name)
+        value = self.get(name, _MISSING)
+        if value is _MISSING:
+            raise KeyError(name)
+        return value
+    
+    def __repr__(self):
+        return f"Segment({self.index}, {self.start:.2f}s - {self.end:.2f}s)"
+
+
+class SegmentTable:
+    """
+    Bảng segment: timing trong structured array, field khác theo cột
+    
+    Thứ tự dòng giữ đúng thứ tự segment trong JSON/SegmentStore nên chỉ số
+    dòng dùng được làm index segment (tên file 0001.mp3, journal...).
+    """
+    
+    def __init__(self, timing, fields=None):
+        """
+        Args:
+            timing: Mảng TIMING_DTYPE
+            fields: dict tên field -> list giá trị (_MISSING nếu segment không có)
+        """
+        self.timing = timing
+        self.fields = fields or {}
+        self._sample_bounds = {}  # sample rate -> (start, end)
+    
+    @classmethod
+    def from_segments(cls, segments, fields=()):
+        """
+        Tạo từ list dict segment
+        
+        Args:
+            segments: List dict có start, end
+            fields: Các field khác cần giữ lại theo cột (vd: ["vi_audio_path"])
+        """
+        return cls.from_columns(
+            [seg["start"] for seg in segments],
+            [seg["end"] for seg in segments],
+            {name: [seg.get(name, _MISSING) for seg in segments] for name in fields}
+        )
+    
+    @classmethod
+    def from_columns(cls, start, end, fields=None):
+        """
+        Tạo từ các cột (không qua dict segment)
+        
+        Args:
+            start, end: Dãy thời điểm bắt đầu/kết thúc (giây)
+            fields: dict tên field -> list giá trị
+        """
+        timing = np.empty(len(start), dtype=TIMING_DTYPE)
+        timing["start"] = start
+        timing["end"] = end
+        # astype cắt phần lẻ giống int(seg["start"] * 1000)
+        timing["start_ms"] = (timing["start"] * 1000).astype(np.int64)
+        timing["end_ms"] = (timing["end"] * 1000).astype(np.int64)
+        return cls(timing, fields)
+    
+    @classmethod
+    def load(cls, source, fields=()):
+        """
+        Đọc từ file JSON hoặc SegmentStore
+        
+        Với store, timing đọc thẳng từng cột SQLite vào structured array, không
+        tạo dict segment. Với JSON, list dict của json.load chỉ sống trong lúc
+        chép sang bảng (đỉnh bộ nhớ lúc load vẫn gồm cả list đó), bảng giữ lại
+        không tham chiếu tới dict nào.
+        """
+        fields = list(fields)
+        if isinstance(source, SegmentStore):
+            return cls.from_columns(source.column("start"), source.column("end"), {
+                name: [seg.get(name, _MISSING) for seg in source.rows([name])] for name in fields
+            })
+        return cls.from_segments(load_segments(source), fields)
+    
+    def __len__(self):
+        return len(self.timing)
+    
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return Segment(self, index)
+    
+    def __iter__(self):
+        return (Segment(self, i) for i in range(len(self)))
+    
+    @property
+    def start(self):
+        return self.timing["start"]
+    
+    @property
+    def end(self):
+        return self.timing["end"]
+    
+    @property
+    def start_ms(self):
+        return self.timing["start_ms"]
+    
+    @property
+    def end_ms(self):
+        return self.timing["end_ms"]
+    
+    @property
+    def duration(self):
+        return self.timing["end"] - self.timing["start"]
+    
+    def column(self, name):
+        """List giá trị của một field (None nếu segment không có)"""
+        if name in TIMING_DTYPE.names:
+            return self.timing[name].tolist()
+        return [None if value is _MISSING else value for value in self.fields[name]]
+    
+    def end_time(self):
+        """Thời điểm kết thúc muộn nhất (độ dài timeline, giây)"""
+        return float(self.timing["end"].max())
+    
+    def total_duration(self):
+        """Tổng thời lượng các segment (giây, phần chồng nhau tính nhiều lần)"""
+        return float(self.duration.sum())
+    
+    def has_audio(self):
+        """Mask các segment có vi_audio_path tồn tại (file hoặc entry trong SegmentBank)"""
+        paths = self.column("vi_audio_path")
+        return np.fromiter((audio_exists(path) for path in paths),
+                           dtype=bool, count=len(paths))
+    
+    def order(self, mask=None):
+        """
+        Chỉ số segment sắp theo thời gian bắt đầu
+        
+        Sắp xếp ổn định: segment cùng start giữ thứ tự gốc (giống sorted()).
+        
+        Args:
+            mask: Chỉ lấy các segment có mask True (mặc định: tất cả)
+        """
+        indices = np.arange(len(self)) if mask is None else np.flatnonzero(mask)
+        return indices[np.argsort(self.timing["start"][indices], kind="stable")]
+    
+    def in_window(self, t0, t1):
+        """Chỉ số các segment chồng lên cửa sổ [t0, t1) (giây)"""
+        return np.flatnonzero((self.timing["start"] < t1) & (self.timing["end"] > t0))
+    
+    def overlaps(self):
+        """
+        Chỉ số các segment bắt đầu trước khi một segment trước đó kết thúc
+        
+        Returns:
+            Mảng chỉ số (theo thứ tự start), rỗng nếu timeline không chồng nhau
+        """
+        order = self.order()
+        if len(order) < 2:
+            return order[:0]
+        ends = np.maximum.accumulate(self.timing["end"][order])
+        return order[1:][self.timing["start"][order[1:]] < ends[:-1]]
+    
+    def sample_bounds(self, sr):
+        """
+        Khoảng sample [start, end) của từng segment tại sample rate sr
+        
+        Tính giống slice_segment (start = int(start * sr), độ dài int(duration * sr))
+        và được cache theo sr.
+        
+        Returns:
+            (start, end) hai mảng int64, chưa cắt về 0
+        """
+        bounds = self._sample_bounds.get(sr)
+        if bounds is None:
+            start = (self.timing["start"] * sr).astype(np.int64)
+            end = start + (self.duration * sr).astype(np.int64)
+            bounds = self._sample_bounds[sr] = (start, end)
+        return bounds
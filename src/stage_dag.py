@@ -0,0 +1,197 @@
+"""
+Stage DAG
+Bộ lập lịch các bước xử lý theo đồ thị phụ thuộc: mỗi bước khai báo file
+đầu vào/đầu ra, các bước không phụ thuộc nhau chạy song song trên thread
+
+Phụ thuộc được suy ra từ thứ tự khai báo và các file:
+- Đọc file mà bước trước ghi → chờ bước ghi gần nhất (read-after-write)
+- Ghi file mà bước trước đã ghi → chờ bước đó (write-after-write)
+- Ghi file mà bước trước đang đọc → chờ các bước đọc (write-after-read)
+Nhờ vậy hai bước chạy song song không bao giờ ghi cùng một file.
+
+Nếu truyền state_path, trạng thái các file sau mỗi bước được lưu lại; lần
+chạy sau bỏ qua bước đã xong mà input không đổi (giống make), ví dụ sửa
+tay vi.json chỉ chạy lại các bước đọc vi.json trở đi.
+"""
+import contextvars
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+from progress_journal import file_fingerprint, write_json_atomic
+
+
+class Stage:
+    """
+    Một bước trong pipeline
+    
+    Args:
+        name: Tên ngắn, duy nhất (vd: "translate")
+        func: Hàm không tham số, trả về True nếu thành công
+        inputs: Các file/thư mục bước này đọc
+        outputs: Các file/thư mục bước này ghi (có thể trùng inputs nếu cập nhật tại chỗ)
+        title: Tên hiển thị
+        required: False nếu lỗi vẫn cho các bước sau chạy tiếp
+    """
+    
+    def __init__(self, name, func, inputs=(), outputs=(), title=None, required=True):
+        self.name = name
+        self.func = func
+        self.inputs = [str(Path(p)) for p in inputs]
+        self.outputs = [str(Path(p)) for p in outputs]
+        self.title = title or name
+        self.required = required
+
+
+def resolve_dependencies(stages):
+    """
+    Tính các bước mà mỗi bước phải chờ
+    
+    Returns:
+        dict tên bước -> set tên các bước phụ thuộc trực tiếp
+    """
+    names = [stage.name for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError("Tên bước bị trùng")
+    
+    writer = {}   # file -> bước ghi gần nhất
+    readers = {}  # file -> các bước đọc kể từ lần ghi gần nhất
+    deps = {}
+    for stage in stages:
+        needs = set()
+        for path in stage.inputs:
+            if path in writer:
+                needs.add(writer[path])
+        for path in stage.outputs:
+            if path in writer:
+                needs.add(writer[path])
+            needs.update(readers.get(path, ()))
+        needs.discard(stage.name)
+        deps[stage.name] = needs
+        
+        for path in stage.inputs:
+            readers.setdefault(path, set()).add(stage.name)
+        for path in stage.outputs:
+            writer[path] = stage.name
+            readers[path] = set()
+    return deps
+
+
+def _load_state(state_path):
+    if state_path and os.path.exists(state_path):
+        try:
+            with open(state_path, encoding="utf-8") as f:
+                state = json.load(f)
+            return {"files": state.get("files", {}), "done": set(state.get("done", []))}
+        except (OSError, ValueError):
+            pass
+    return {"files": {}, "done": set()}
+
+
+def _is_fresh(stage, state, deps, results):
+    """Bước đã xong ở lần trước, output còn đủ, input không đổi và không bước nào trước nó chạy lại"""
+    if stage.name not in state["done"]:
+        return False
+    if any(results[dep].get("fresh") is not True for dep in deps[stage.name]):
+        return False
+    if not all(os.path.exists(path) for path in stage.outputs):
+        return False
+    return all(
+        file_fingerprint(path) == state["files"].get(path)
+        for path in stage.inputs
+    )
+
+
+def _run_stage(stage, index, total):
+    # In header bằng một lệnh print để không lẫn với bước đang chạy song song
+    print("\n" + "=" * 60 + f"\nBƯỚC {index}/{total}: {stage.title.upper()}\n" + "=" * 60)
+    t0 = time.perf_counter()
+    try:
+        ok = bool(stage.func())
+    except Exception as e:
+        print(f"❌ Lỗi bước {stage.title}: {e}")
+        ok = False
+    return ok, time.perf_counter() - t0
+
+
+def run_stages(stages, max_workers=None, state_path=None):
+    """
+    Chạy các bước theo đồ thị phụ thuộc
+    
+    Bước bắt buộc lỗi thì mọi bước phụ thuộc (trực tiếp hoặc gián tiếp) bị
+    bỏ qua; các nhánh độc lập vẫn chạy hết.
+    
+    Args:
+        stages: List Stage theo thứ tự khai báo (bước sau chỉ phụ thuộc bước trước)
+        max_workers: Số bước chạy cùng lúc tối đa (mặc định: không giới hạn)
+        state_path: File JSON lưu trạng thái để bỏ qua bước không đổi khi chạy lại
+                    (mặc định: không lưu, luôn chạy mọi bước)
+    
+    Returns:
+        dict tên bước -> {"status": done/failed/skipped, "seconds": float,
+                          "fresh": True nếu bỏ qua vì không đổi}
+    """
+    deps = resolve_dependencies(stages)
+    by_name = {stage.name: stage for stage in stages}
+    index = {stage.name: i for i, stage in enumerate(stages, start=1)}
+    results = {stage.name: {"status": "pending", "seconds": 0.0} for stage in stages}
+    state = _load_state(state_path)
+    
+    def save_state(stage, ok):
+        if not state_path:
+            return
+        if ok:
+            state["done"].add(stage.name)
+            for path in stage.inputs + stage.outputs:
+                state["files"][path] = file_fingerprint(path)
+        else:
+            state["done"].discard(stage.name)
+        os.makedirs(os.path.dirname(os.path.abspath(state_path)), exist_ok=True)
+        write_json_atomic(state_path, {"files": state["files"], "done": sorted(state["done"])})
+    
+    def blocked_by_failure(name):
+        for dep in deps[name]:
+            status = results[dep]["status"]
+            if status == "skipped" or (status == "failed" and by_name[dep].required):
+                return dep
+        return None
+    
+    with ThreadPoolExecutor(max_workers=max_workers or len(stages) or 1) as pool:
+        running = {}
+        while True:
+            # Khởi động mọi bước đã đủ điều kiện (deps luôn đứng trước nên duyệt một lượt là đủ)
+            for stage in stages:
+                result = results[stage.name]
+                if result["status"] != "pending":
+                    continue
+                if any(results[dep]["status"] in ("pending", "running") for dep in deps[stage.name]):
+                    continue
+                failed_dep = blocked_by_failure(stage.name)
+                if failed_dep:
+                    result["status"] = "skipped"
+                    print(f"⏭️ Bỏ qua {stage.title} (do lỗi ở bước {by_name[failed_dep].title})")
+                    continue
+                if state_path and _is_fresh(stage, state, deps, results):
+                    results[stage.name] = {"status": "done", "seconds": 0.0, "fresh": True}
+                    print(f"⏩ {stage.title}: input không đổi, dùng kết quả lần trước")
+                    continue
+                result["status"] = "running"
+                # Chạy trong bản sao context hiện tại để bước giữ các nhãn metrics của lần chạy
+                running[pool.submit(contextvars.copy_context().run, _run_stage,
+                                    stage, index[stage.name], len(stages))] = stage
+            
+            if not running:
+                break
+            
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                ok, seconds = future.result()
+                results[stage.name] = {"status": "done" if ok else "failed", "seconds": seconds}
+                save_state(stage, ok)
+                if not ok and not stage.required:
+                    print(f"⚠️ Lỗi {stage.title}, tiếp tục")
+    
+    return results
@@ -1,10 +1,282 @@
 """
 Text Cleaning Utilities
 Loại bỏ URLs, ký tự đặc biệt, và clean text trước khi TTS
+
+TextNormalizer làm thêm bước đọc thành lời tiếng Việt (số, ngày, giờ, đơn
+vị, viết tắt) và xử lý cả danh sách câu một lần. Các regex được compile
+sẵn ở mức module, không build lại mỗi câu.
 """
+import functools
 import re
 
 
+# Ký tự được giữ lại: a-z, A-Z, 0-9, tiếng Việt, dấu câu cơ bản
+VIETNAMESE_CHARS = (
+    "àáạảãâầấậẩẫăằắặẳẵèéẹẻẽêềếệểễìíịỉĩòóọỏõôồốộổỗơờớợởỡùúụủũưừứựửữỳýỵỷỹđ"
+    "ÀÁẠẢÃÂẦẤẬẨẪĂẰẮẶẲẴÈÉẸẺẼÊỀẾỆỂỄÌÍỊỈĨÒÓỌỎÕÔỒỐỘỔỖƠỜỚỢỞỠÙÚỤỦŨƯỪỨỰỬỮỲÝỴỶỸĐ"
+)
+
+_URL_RE = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+_WWW_RE = re.compile(r'www\.(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),])+')
+_EMAIL_RE = re.compile(r'\S+@\S+')
+_HTML_RE = re.compile(r'<[^>]+>')
+_MD_LINK_RE = re.compile(r'\[([^\]]+)\]\([^\)]+\)')
+_SPECIAL_RE = re.compile(r'[^\w\s' + VIETNAMESE_CHARS + r'.,!?;:\'"()-]')
+
+# Viết tắt / ký hiệu → cách đọc (khớp đúng chữ hoa/thường)
+SPOKEN_ABBREVIATIONS = {
+    "TP.HCM": "thành phố Hồ Chí Minh",
+    "TPHCM": "thành phố Hồ Chí Minh",
+    "TP.": "thành phố",
+    "UBND": "ủy ban nhân dân",
+    "THPT": "trung học phổ thông",
+    "THCS": "trung học cơ sở",
+    "ĐH": "đại học",
+    "GS.": "giáo sư",
+    "PGS.": "phó giáo sư",
+    "TS.": "tiến sĩ",
+    "ThS.": "thạc sĩ",
+    "BS.": "bác sĩ",
+    "Dr.": "tiến sĩ",
+    "Mr.": "ông",
+    "Mrs.": "bà",
+    "Ms.": "cô",
+    "No.": "số",
+    "v.v.": "vân vân",
+    "v.v": "vân vân",
+    "etc.": "vân vân",
+    "e.g.": "ví dụ",
+    "i.e.": "tức là",
+    "&": "và"
+}
+
+# Đơn vị đứng sau số → cách đọc
+SPOKEN_UNITS = {
+    "%": "phần trăm",
+    "km/h": "ki lô mét trên giờ",
+    "km²": "ki lô mét vuông",
+    "m²": "mét vuông",
+    "m³": "mét khối",
+    "km": "ki lô mét",
+    "cm": "xen ti mét",
+    "mm": "mi li mét",
+    "m": "mét",
+    "kg": "ki lô gam",
+    "mg": "mi li gam",
+    "g": "gam",
+    "ml": "mi li lít",
+    "l": "lít",
+    "°C": "độ C",
+    "°F": "độ F",
+    "°": "độ",
+    "GB": "gi ga bai",
+    "MB": "mê ga bai",
+    "$": "đô la",
+    "USD": "đô la Mỹ",
+    "VND": "đồng",
+    "VNĐ": "đồng",
+    "đ": "đồng",
+    "tr": "triệu",
+    "k": "nghìn"
+}
+
+DIGIT_WORDS = ["không", "một", "hai", "ba", "bốn", "năm", "sáu", "bảy", "tám", "chín"]
+
+
+def _alternation(keys):
+    """Regex khớp một trong các key (key dài thử trước), không khớp giữa chữ"""
+    parts = []
+    for key in sorted(keys, key=len, reverse=True):
+        part = re.escape(key)
+        if re.match(r"\w", key[-1]):
+            part += r"(?!\w)"
+        parts.append(part)
+    return "(?:" + "|".join(parts) + ")"
+
+
+def _first_chars(keys):
+    """Lookahead lọc nhanh vị trí bắt đầu (regex bắt đầu bằng lookbehind không tự lọc được)"""
+    return "(?=[" + re.escape("".join(sorted({key[0] for key in keys}))) + "])"
+
+
+# Nhóm nghìn kiểu Việt Nam (1.000.000,5) và kiểu tiếng Anh còn sót lại sau khi dịch (1,000,000.5)
+_THOUSANDS = r"\d{1,3}(?:\.\d{3})+(?:,\d+)?"
+_THOUSANDS_RE = re.compile(_THOUSANDS)
+_THOUSANDS_EN = r"\d{1,3}(?:,\d{3})+(?:\.\d+)?"
+_THOUSANDS_EN_RE = re.compile(_THOUSANDS_EN)
+# Không đọc số nhiều phần (phiên bản 3.10.2, địa chỉ IP): không nhánh nào khớp
+# khi ngay sau còn dấu chấm/phẩy + chữ số, và không bắt đầu giữa các phần đó
+_NUMBER = r"(?:" + _THOUSANDS + "|" + _THOUSANDS_EN + r"|\d+(?:[.,]\d+)?)(?![.,]?\d)"
+_ABBREVIATION_RE = re.compile(_first_chars(SPOKEN_ABBREVIATIONS) + r"(?<!\w)" + _alternation(SPOKEN_ABBREVIATIONS))
+# Một regex cho mọi dạng số để mỗi câu chỉ quét một lần; nhánh trước được ưu tiên
+_SPOKEN_RE = re.compile(
+    r"(?=[\d+$])"
+    r"(?<![\w+])(?P<phone>\+84[-.]?\d{9}|(?:\+84[-.]?|0)\d{2,4}(?:[-.]\d{2,4}){1,3})(?![\w.-]\d)"
+    r"|(?<![\w/])(?P<day>\d{1,2})/(?P<month>\d{1,2})(?:/(?P<year>\d{4}|\d{2}))?(?![\d/])"
+    r"|(?<!\w)(?P<hour>\d{1,2})(?:h(?P<hour_min>\d{2})?|:(?P<colon_min>\d{2}))(?![\w:])"
+    r"|\$\s?(?P<dollars>" + _NUMBER + r")"
+    r"|(?<!\w)(?<!\d[.,])(?P<number>" + _NUMBER + r")(?:\s?(?P<unit>" + _alternation(SPOKEN_UNITS) + r"))?"
+)
+
+
+def _read_triple(n, full):
+    """Đọc số 0-999; full=True đọc cả "không trăm", "linh" (nhóm không đứng đầu)"""
+    hundreds, rest = divmod(n, 100)
+    tens, units = divmod(rest, 10)
+    words = []
+    if hundreds or full:
+        words += [DIGIT_WORDS[hundreds], "trăm"]
+    if tens == 0:
+        if units and words:
+            words.append("linh")
+    elif tens == 1:
+        words.append("mười")
+    else:
+        words += [DIGIT_WORDS[tens], "mươi"]
+    if units:
+        if units == 1 and tens > 1:
+            words.append("mốt")
+        elif units == 5 and tens > 0:
+            words.append("lăm")
+        elif units == 4 and tens > 1:
+            words.append("tư")
+        else:
+            words.append(DIGIT_WORDS[units])
+    return " ".join(words)
+
+
+@functools.lru_cache(maxsize=4096)
+def number_to_words(n):
+    """
+    Đọc số nguyên thành chữ tiếng Việt
+    
+    Args:
+        n: Số nguyên
+    
+    Returns:
+        vd: 2024 → "hai nghìn không trăm hai mươi tư"
+    """
+    if n < 0:
+        return "âm " + number_to_words(-n)
+    if n == 0:
+        return DIGIT_WORDS[0]
+    if n >= 10 ** 9:
+        high, low = divmod(n, 10 ** 9)
+        words = number_to_words(high) + " tỷ"
+        return words + " " + _below_billion(low, full=True) if low else words
+    return _below_billion(n, full=False)
+
+
+def _below_billion(n, full):
+    parts = []
+    for scale, unit in ((10 ** 6, " triệu"), (10 ** 3, " nghìn"), (1, "")):
+        group, n = divmod(n, scale)
+        if group:
+            parts.append(_read_triple(group, full) + unit)
+            full = True
+    return " ".join(parts)
+
+
+def read_digits(digits):
+    """Đọc từng chữ số (số điện thoại, mã số), vd: 0901 → không chín không một"""
+    return " ".join(DIGIT_WORDS[int(d)] for d in digits)
+
+
+def _read_integer(digits):
+    # Số có 0 đứng đầu hoặc quá dài là mã số/số điện thoại, đọc từng chữ số
+    if (len(digits) > 1 and digits[0] == "0") or len(digits) > 15:
+        return read_digits(digits)
+    return number_to_words(int(digits))
+
+
+@functools.lru_cache(maxsize=4096)
+def read_number(text):
+    """
+    Đọc một số viết theo kiểu Việt Nam thành chữ
+    
+    Dấu chấm ngăn nhóm nghìn ("1.000.000"), dấu phẩy là phần thập phân
+    ("3,5"); "3.5" (không đủ nhóm 3 chữ số) cũng được đọc là thập phân.
+    Nhóm nghìn bằng dấu phẩy kiểu tiếng Anh ("1,000", "2,500.75") cũng
+    được nhận, khi đó dấu chấm là phần thập phân.
+    
+    Args:
+        text: Chuỗi số khớp _NUMBER
+    
+    Returns:
+        Chuỗi đọc thành lời
+    """
+    if _THOUSANDS_RE.fullmatch(text):
+        text = text.replace(".", "")
+    elif _THOUSANDS_EN_RE.fullmatch(text):
+        text = text.replace(",", "")
+    integer, sep, fraction = text.replace(".", ",").partition(",")
+    words = _read_integer(integer)
+    if sep:
+        fraction_words = read_digits(fraction) if fraction[0] == "0" or len(fraction) > 3 else number_to_words(int(fraction))
+        words += " phẩy " + fraction_words
+    return words
+
+
+def _spoken(match):
+    """Callback của _SPOKEN_RE: thay một số/ngày/giờ bằng cách đọc"""
+    groups = match.groupdict()
+    
+    if groups["phone"] is not None:
+        phone = groups["phone"]
+        prefix = "cộng " if phone.startswith("+") else ""
+        return prefix + read_digits(re.sub(r"\D", "", phone))
+    
+    if groups["day"] is not None:
+        day, month = int(groups["day"]), int(groups["month"])
+        # Chỉ đọc là ngày khi có năm hoặc đứng sau "ngày" (3/4, 1/2 thường là phân số)
+        after_day = match.string.endswith(("ngày ", "Ngày "), 0, match.start())
+        if 1 <= day <= 31 and 1 <= month <= 12 and (groups["year"] or after_day):
+            # Không lặp "ngày" nếu câu đã viết "ngày 30/4"
+            prefix = "" if after_day else "ngày "
+            words = f"{prefix}{number_to_words(day)} tháng {'tư' if month == 4 else number_to_words(month)}"
+            if groups["year"]:
+                words += f" năm {number_to_words(int(groups['year']))}"
+            return words
+        # Không phải ngày (vd: phân số 3/4, tỉ số 50/50): đọc từng số
+        return _SPOKEN_RE.sub(_spoken, match.group(0).replace("/", " trên "))
+    
+    if groups["hour"] is not None:
+        hour = int(groups["hour"])
+        minute = groups["hour_min"] or groups["colon_min"]
+        # "25h" là khoảng thời gian, vẫn đọc "giờ"; "25:10" thì không phải giờ
+        if (groups["colon_min"] is None or hour <= 24) and (minute is None or int(minute) < 60):
+            words = f"{number_to_words(hour)} giờ"
+            if minute and int(minute):
+                words += f" {number_to_words(int(minute))} phút"
+            return words
+        return " ".join(_read_integer(part) for part in re.findall(r"\d+", match.group(0)))
+    
+    if groups["dollars"] is not None:
+        return f"{read_number(groups['dollars'])} đô la"
+    
+    words = read_number(groups["number"])
+    if groups["unit"]:
+        words += " " + SPOKEN_UNITS[groups["unit"]]
+    return words
+
+
+def _strip_markup(text):
+    """Bước 1-4 của clean_text_for_tts, trả về (text, số URL/email đã bỏ)"""
+    text, n_urls = _URL_RE.subn('', text)
+    text, n_www = _WWW_RE.subn('', text)
+    text, n_emails = _EMAIL_RE.subn('', text)
+    text = _HTML_RE.sub('', text)
+    text = _MD_LINK_RE.sub(r'\1', text)
+    return text, n_urls + n_www + n_emails
+
+
+def _finish(text):
+    """Bước 5-7 của clean_text_for_tts: bỏ ký tự đặc biệt, gộp khoảng trắng, trim"""
+    text = _SPECIAL_RE.sub(' ', text)
+    # split() cắt theo cùng tập khoảng trắng với \s, nhanh hơn re.sub(r"\s+", " ") + strip
+    return " ".join(text.split())
+
+
 def clean_text_for_tts(text):
     """
     Clean text trước khi gửi vào TTS
@@ -19,30 +291,96 @@ def clean_text_for_tts(text):
     if not text or not isinstance(text, str):
         return ""
     
-    # 1. Loại bỏ URLs (http://, https://, www.)
-    text = re.sub(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+', '', text)
-    text = re.sub(r'www\.(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),])+', '', text)
+    # 1-4. Loại bỏ URLs, email, HTML tags, markdown links [text](url)
+    text, _ = _strip_markup(text)
     
-    # 2. Loại bỏ email
-    text = re.sub(r'\S+@\S+', '', text)
+    # 5-7. Loại bỏ ký tự đặc biệt nhưng giữ dấu câu tiếng Việt, gộp spaces, trim
+    return _finish(text)
+
+
+def expand_spoken(text):
+    """
+    Viết các số, ngày, giờ, đơn vị, viết tắt thành lời tiếng Việt
     
-    # 3. Loại bỏ HTML tags
-    text = re.sub(r'<[^>]+>', '', text)
+    Args:
+        text: Text (đã bỏ URL/email)
     
-    # 4. Loại bỏ markdown links [text](url)
-    text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'\1', text)
+    Returns:
+        vd: "Giảm 50% từ ngày 30/4" → "Giảm năm mươi phần trăm từ ngày ba mươi tháng tư"
+    """
+    text = _ABBREVIATION_RE.sub(lambda m: SPOKEN_ABBREVIATIONS[m.group(0)], text)
+    return _SPOKEN_RE.sub(_spoken, text)
+
+
+class TextNormalizer:
+    """
+    Chuẩn hóa text cho TTS theo lô: clean + đọc thành lời + validate trong
+    một lần duyệt mỗi câu
     
-    # 5. Loại bỏ ký tự đặc biệt nhưng giữ dấu câu tiếng Việt
-    # Giữ: a-z, A-Z, 0-9, tiếng Việt, dấu câu cơ bản
-    text = re.sub(r'[^\w\sàáạảãâầấậẩẫăằắặẳẵèéẹẻẽêềếệểễìíịỉĩòóọỏõôồốộổỗơờớợởỡùúụủũưừứựửữỳýỵỷỹđÀÁẠẢÃÂẦẤẬẨẪĂẰẮẶẲẴÈÉẸẺẼÊỀẾỆỂỄÌÍỊỈĨÒÓỌỎÕÔỒỐỘỔỖƠỜỚỢỞỠÙÚỤỦŨƯỪỨỰỬỮỲÝỴỶỸĐ.,!?;:\'"()-]', ' ', text)
+    Câu trùng nhau trong cùng một lô (vd: "Yeah.", "Okay.") chỉ xử lý một lần.
+    """
     
-    # 6. Loại bỏ nhiều spaces liên tiếp
-    text = re.sub(r'\s+', ' ', text)
+    def __init__(self, expand=True, max_length=500, min_length=3):
+        """
+        Args:
+            expand: Đọc số, ngày, giờ, đơn vị, viết tắt thành lời
+            max_length: Độ dài tối đa, dài hơn thì cắt (kèm cảnh báo)
+            min_length: Ngắn hơn thì coi là nhiễu, bỏ qua
+        """
+        self.expand = expand
+        self.max_length = max_length
+        self.min_length = min_length
     
-    # 7. Trim
-    text = text.strip()
+    def normalize(self, text):
+        """
+        Chuẩn hóa một câu
+        
+        Args:
+            text: Text cần chuẩn hóa
+        
+        Returns:
+            (is_valid, cleaned_text, warnings) với warnings là tuple thông báo
+        """
+        if not text or not isinstance(text, str):
+            return False, "", ("Text rỗng hoặc không hợp lệ",)
+        
+        warnings = ()
+        text, removed = _strip_markup(text)
+        if removed:
+            warnings += (f"Đã bỏ {removed} URL/email",)
+        if self.expand:
+            text = expand_spoken(text)
+        cleaned = _finish(text)
+        
+        if not cleaned:
+            return False, "", warnings + ("Text rỗng sau khi clean",)
+        if len(cleaned) > self.max_length:
+            warnings += (f"Text quá dài, cắt xuống {self.max_length} ký tự",)
+            return True, cleaned[:self.max_length].rstrip(), warnings
+        if len(cleaned) < self.min_length:
+            return False, cleaned, warnings + (f"Text quá ngắn (< {self.min_length} ký tự)",)
+        return True, cleaned, warnings
     
-    return text
+    def normalize_many(self, texts):
+        """
+        Chuẩn hóa cả danh sách câu
+        
+        Args:
+            texts: List text
+        
+        Returns:
+            List (is_valid, cleaned_text, warnings) theo đúng thứ tự texts
+        """
+        done = {}
+        results = []
+        for text in texts:
+            key = text if isinstance(text, str) else None
+            result = done.get(key)
+            if result is None:
+                result = self.normalize(text)
+                done[key] = result
+            results.append(result)
+        return results
 
 
 def validate_text(text, max_length=500):
@@ -86,10 +424,13 @@ if __name__ == "__main__":
         "[Click here](http://example.com)",
         "Normal Vietnamese text: Xin chào, đây là văn bản tiếng Việt.",
         "Text with special chars: @#$%^&*()",
+        "Giảm 50% từ 30/4/2024, gọi 0901-123-456 trước 9h30",
     ]
     
-    for text in test_texts:
+    normalizer = TextNormalizer()
+    for text, (is_valid, spoken, warnings) in zip(test_texts, normalizer.normalize_many(test_texts)):
         print(f"Original: {text}")
         cleaned = clean_text_for_tts(text)
         print(f"Cleaned:  {cleaned}")
+        print(f"Spoken:   {spoken}" + (f"  ⚠️ {'; '.join(warnings)}" if warnings else ""))
         print()
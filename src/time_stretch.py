@@ -0,0 +1,268 @@
+"""
+Time Stretch
+Co giãn thời gian audio mà giữ nguyên cao độ (phase vocoder vector hóa bằng NumPy)
+
+Thay cho utils.speed_change cũ (đổi frame_rate rồi resample) vốn làm
+giọng cao/trầm đi theo tốc độ. Toàn bộ tính toán chạy trên mảng float32:
+STFT, nội suy biên độ, tích lũy pha (cumsum) và overlap-add đều là phép
+toán mảng, không có vòng lặp Python theo từng frame.
+
+Batch API (time_stretch_batch) gộp nhiều segment vào cùng một lần
+rfft/irfft để xử lý cả video trong vài giây.
+"""
+import math
+
+import numpy as np
+import scipy.fft
+from numpy.lib.stride_tricks import sliding_window_view
+from pydub import AudioSegment
+
+from timeline_mixer import SAMPLE_DTYPES
+
+
+# Giới hạn số frame STFT xử lý trong một lần (≈ 8192 × 513 bins ≈ 35 MB complex64)
+MAX_BATCH_FRAMES = 8192
+
+
+def default_n_fft(sr):
+    """Độ dài cửa sổ FFT ≈ 40ms, làm tròn về lũy thừa của 2"""
+    return 2 ** int(round(math.log2(sr * 0.04)))
+
+
+def stretched_length(n_samples, rate):
+    """Số sample sau khi co giãn với tốc độ rate (rate > 1 = nhanh hơn, ngắn hơn)"""
+    return int(round(n_samples / rate))
+
+
+def _hann(n_fft):
+    """Cửa sổ Hann dạng periodic"""
+    return np.hanning(n_fft + 1)[:-1].astype(np.float32)
+
+
+def _frame_signal(y, n_fft, hop_length):
+    """
+    Chia tín hiệu thành các frame chồng nhau (có pad n_fft//2 hai đầu)
+    
+    Returns:
+        np.ndarray shape (n_frames, n_fft), là view của bản pad
+    """
+    pad = n_fft // 2
+    n_frames = 1 + (len(y) + hop_length - 1) // hop_length
+    padded = np.zeros((n_frames - 1) * hop_length + n_fft, dtype=np.float32)
+    padded[pad:pad + len(y)] = y
+    return sliding_window_view(padded, n_fft)[::hop_length]
+
+
+def _overlap_add(frames, hop_length):
+    """
+    Overlap-add các frame (n_fft phải chia hết cho hop_length)
+    
+    Cộng theo từng khối hop_length bằng reshape, mỗi khối một phép cộng mảng.
+    """
+    n_frames, n_fft = frames.shape
+    out = np.zeros((n_frames - 1) * hop_length + n_fft, dtype=np.float32)
+    for j in range(0, n_fft, hop_length):
+        blocks = out[j:j + n_frames * hop_length].reshape(n_frames, hop_length)
+        blocks += frames[:, j:j + hop_length]
+    return out
+
+
+def _stretch_group(signals, rates, n_fft, hop_length, window):
+    """Co giãn một nhóm tín hiệu mono với chung một lần rfft/irfft"""
+    pad = n_fft // 2
+    
+    # STFT của tất cả segment trong một lần rfft
+    frames = [_frame_signal(y, n_fft, hop_length) for y in signals]
+    counts = np.array([len(f) for f in frames])
+    spec = scipy.fft.rfft(np.concatenate(frames) * window, axis=1)
+    
+    # Thêm một frame 0 sau mỗi segment để nội suy frame cuối (như librosa)
+    n_bins = spec.shape[1]
+    rows = np.arange(counts.sum()) + np.repeat(np.arange(len(signals)), counts)
+    mag = np.zeros((len(rows) + len(signals), n_bins), dtype=np.float32)
+    phase = np.zeros_like(mag)
+    mag[rows] = np.abs(spec)
+    phase[rows] = np.angle(spec)
+    del spec
+    
+    # Độ lệch pha thực giữa hai frame liền nhau
+    phi_advance = (2 * np.pi * hop_length / n_fft) * np.arange(n_bins, dtype=np.float32)
+    dphi = np.empty_like(phase)
+    dphi[:-1] = phase[1:] - phase[:-1] - phi_advance
+    dphi[-1] = 0
+    dphi -= 2 * np.pi * np.round(dphi / (2 * np.pi))
+    dphi += phi_advance
+    # Pha chỉ có nghĩa theo mod 2π: đưa về [-π, π] để tổng tích lũy đủ nhỏ cho float32
+    dphi -= 2 * np.pi * np.round(dphi / (2 * np.pi))
+    
+    # Vị trí (thực) của từng frame output trong chuỗi frame input
+    starts = np.concatenate([[0], np.cumsum(counts + 1)[:-1]])
+    steps = [np.arange(0, n, rate) for n, rate in zip(counts, rates)]
+    n_steps = np.array([len(s) for s in steps])
+    steps = np.concatenate(steps)
+    index = np.floor(steps).astype(np.int64)
+    alpha = (steps - index).astype(np.float32)[:, None]
+    index += np.repeat(starts, n_steps)
+    
+    # Nội suy biên độ, tích lũy pha (cumsum reset ở đầu mỗi segment)
+    out_mag = (1 - alpha) * mag[index] + alpha * mag[index + 1]
+    increments = dphi[index]
+    acc = np.cumsum(increments, axis=0) - increments
+    step_starts = np.concatenate([[0], np.cumsum(n_steps)[:-1]])
+    acc -= np.repeat(acc[step_starts], n_steps, axis=0)
+    acc += np.repeat(phase[starts], n_steps, axis=0)
+    del mag, phase, dphi, increments
+    
+    out_spec = np.empty(acc.shape, dtype=np.complex64)
+    out_spec.real = out_mag * np.cos(acc)
+    out_spec.imag = out_mag * np.sin(acc)
+    del out_mag, acc
+    
+    out_frames = scipy.fft.irfft(out_spec, n=n_fft, axis=1) * window
+    del out_spec
+    
+    # Overlap-add từng segment, chuẩn hóa theo tổng bình phương cửa sổ
+    results = []
+    offset = 0
+    win_sq = window ** 2
+    for y, rate, m in zip(signals, rates, n_steps):
+        seg_frames = out_frames[offset:offset + m]
+        offset += m
+        y_out = _overlap_add(seg_frames, hop_length)
+        norm = _overlap_add(np.broadcast_to(win_sq, seg_frames.shape), hop_length)
+        np.divide(y_out, norm, out=y_out, where=norm > 1e-6)
+        
+        target = stretched_length(len(y), rate)
+        y_out = y_out[pad:pad + target]
+        if len(y_out) < target:
+            y_out = np.concatenate([y_out, np.zeros(target - len(y_out), dtype=np.float32)])
+        results.append(y_out)
+    
+    return results
+
+
+def time_stretch_batch(signals, rates, n_fft=1024, hop_length=None):
+    """
+    Co giãn nhiều tín hiệu mono trong một lần gọi, giữ nguyên cao độ
+    
+    Các segment được gom thành nhóm ≤ MAX_BATCH_FRAMES frame STFT, mỗi
+    nhóm dùng chung một lần rfft/irfft.
+    
+    Args:
+        signals: List np.ndarray 1 chiều (float, khoảng [-1, 1])
+        rates: Tốc độ cho từng tín hiệu (1.0 = giữ nguyên, 1.5 = nhanh hơn 50%)
+        n_fft: Độ dài cửa sổ FFT
+        hop_length: Bước nhảy giữa các frame (mặc định n_fft // 4)
+    
+    Returns:
+        List np.ndarray float32, độ dài round(len(y) / rate)
+    """
+    hop_length = hop_length or n_fft // 4
+    if n_fft % hop_length:
+        raise ValueError("n_fft phải chia hết cho hop_length")
+    window = _hann(n_fft)
+    
+    results = [None] * len(signals)
+    group = []
+    group_frames = 0
+    
+    def flush():
+        stretched = _stretch_group(
+            [np.asarray(signals[i], dtype=np.float32) for i in group],
+            [rates[i] for i in group],
+            n_fft, hop_length, window
+        )
+        for i, y_out in zip(group, stretched):
+            results[i] = y_out
+    
+    for i, (y, rate) in enumerate(zip(signals, rates)):
+        if rate <= 0:
+            raise ValueError(f"Tốc độ phải > 0: {rate}")
+        if len(y) == 0 or rate == 1.0:
+            results[i] = np.array(y, dtype=np.float32)
+            continue
+        n_frames = 2 + len(y) // hop_length
+        if group and group_frames + n_frames > MAX_BATCH_FRAMES:
+            flush()
+            group, group_frames = [], 0
+        group.append(i)
+        group_frames += n_frames
+    if group:
+        flush()
+    
+    return results
+
+
+def time_stretch(y, rate, n_fft=1024, hop_length=None):
+    """
+    Co giãn một tín hiệu, giữ nguyên cao độ
+    
+    Args:
+        y: np.ndarray shape (n,) hoặc (n, channels)
+        rate: Tốc độ (1.0 = bình thường, 1.5 = nhanh hơn 50%)
+    
+    Returns:
+        np.ndarray float32 cùng số chiều với y
+    """
+    y = np.asarray(y, dtype=np.float32)
+    if y.ndim == 1:
+        return time_stretch_batch([y], [rate], n_fft, hop_length)[0]
+    channels = time_stretch_batch(list(y.T), [rate] * y.shape[1], n_fft, hop_length)
+    return np.stack(channels, axis=1)
+
+
+def audio_segment_to_float(audio_segment):
+    """AudioSegment → np.ndarray float32 shape (n_frames, channels), khoảng [-1, 1]"""
+    dtype = SAMPLE_DTYPES[audio_segment.sample_width]
+    samples = np.frombuffer(audio_segment.raw_data, dtype=dtype).reshape(-1, audio_segment.channels)
+    return samples.astype(np.float32) / -np.iinfo(dtype).min
+
+
+def float_to_audio_segment(y, frame_rate, sample_width=2):
+    """np.ndarray float32 shape (n_frames, channels) → AudioSegment"""
+    dtype = SAMPLE_DTYPES[sample_width]
+    info = np.iinfo(dtype)
+    samples = np.clip(np.round(y * -info.min), info.min, info.max).astype(dtype)
+    return AudioSegment(
+        data=samples.tobytes(),
+        sample_width=sample_width,
+        frame_rate=frame_rate,
+        channels=y.shape[1]
+    )
+
+
+def stretch_audio_segments(audio_segments, speeds):
+    """
+    Co giãn nhiều AudioSegment trong một lần gọi (giữ nguyên định dạng)
+    
+    Args:
+        audio_segments: List pydub AudioSegment
+        speeds: Tốc độ cho từng segment
+    
+    Returns:
+        List AudioSegment đã co giãn
+    """
+    # Gom theo sample rate (n_fft phụ thuộc sample rate), tách từng kênh
+    by_rate = {}
+    for i, seg in enumerate(audio_segments):
+        by_rate.setdefault(seg.frame_rate, []).append(i)
+    
+    results = [None] * len(audio_segments)
+    for frame_rate, indices in by_rate.items():
+        arrays = [audio_segment_to_float(audio_segments[i]) for i in indices]
+        signals, rates = [], []
+        for i, y in zip(indices, arrays):
+            signals.extend(y.T)
+            rates.extend([speeds[i]] * y.shape[1])
+        
+        stretched = iter(time_stretch_batch(signals, rates, n_fft=default_n_fft(frame_rate)))
+        for i, y in zip(indices, arrays):
+            y_out = np.stack([next(stretched) for _ in range(y.shape[1])], axis=1)
+            results[i] = float_to_audio_segment(y_out, frame_rate, audio_segments[i].sample_width)
+    
+    return results
+
+
+def stretch_audio_segment(audio_segment, speed=1.0):
+    """Co giãn một AudioSegment, giữ nguyên cao độ"""
+    return stretch_audio_segments([audio_segment], [speed])[0]
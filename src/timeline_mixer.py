@@ -0,0 +1,403 @@
+"""
+Timeline Mixer
+Ghép nhiều audio segment vào một timeline bằng NumPy: cấp phát một bộ
+đệm duy nhất, cộng từng segment tại đúng vị trí, clip một lần khi xuất
+
+Thay cho vòng lặp `final_audio = final_audio.overlay(seg, position=...)`
+của pydub (mỗi lần overlay dựng lại toàn bộ timeline).
+
+Kết quả trùng từng sample với cách overlay cũ, trừ khi clipping:
+audioop.add của pydub bão hòa (saturate) sau MỖI lần overlay, còn
+TimelineMixer cộng trong bộ đệm rộng hơn (int32/int64) và chỉ clip một
+lần ở cuối. Hai cách chỉ khác nhau khi các segment chồng lên nhau làm
+tổng vượt ngưỡng giữa chừng; khi đó cách mới chính xác hơn.
+"""
+import math
+import wave
+
+import numpy as np
+from pydub import AudioSegment
+
+
+# Định dạng của AudioSegment.silent() mà timeline cũ bắt đầu từ đó
+BASE_FRAME_RATE = 11025
+BASE_CHANNELS = 1
+BASE_SAMPLE_WIDTH = 2
+
+# dtype sample trong bộ nhớ (audioop coi mọi sample width là số có dấu; pydub
+# trừ 128 khi đọc WAV 8-bit nên raw_data 8-bit cũng có dấu)
+SAMPLE_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+# PCM 8-bit trong file WAV là số không dấu, lệch 128 so với dạng trong bộ nhớ
+WAV_8BIT_OFFSET = 128
+
+
+def wav_frame_bytes(samples, sample_width):
+    """Bytes ghi vào file WAV cho mảng sample đã clip (8-bit đổi sang không dấu)"""
+    if sample_width == 1:
+        return (samples.astype(np.int16) + WAV_8BIT_OFFSET).astype(np.uint8).tobytes()
+    return samples.tobytes()
+
+
+def resampled_length(n_frames, from_rate, to_rate):
+    """
+    Số frame sau khi audioop.ratecv đổi sample rate (như AudioSegment.set_frame_rate)
+    """
+    if n_frames == 0 or from_rate == to_rate:
+        return n_frames
+    g = math.gcd(from_rate, to_rate)
+    return ((n_frames - 1) * (to_rate // g)) // (from_rate // g) + 1
+
+
+class TimelineMixer:
+    """
+    Bộ trộn timeline dùng một mảng tích lũy duy nhất
+    
+    Định dạng output (sample rate, số kênh, sample width) là giá trị lớn
+    nhất của timeline rỗng và các segment, giống AudioSegment._sync.
+    """
+    
+    def __init__(self, total_duration_ms):
+        """
+        Args:
+            total_duration_ms: Độ dài timeline (ms)
+        """
+        self.total_duration_ms = total_duration_ms
+        self.frame_rate = BASE_FRAME_RATE
+        self.channels = BASE_CHANNELS
+        self.sample_width = BASE_SAMPLE_WIDTH
+        self.n_frames = int(BASE_FRAME_RATE * (total_duration_ms / 1000.0))
+        self._buffer = None
+    
+    def __len__(self):
+        """Độ dài timeline (ms), giống len(AudioSegment)"""
+        return round(1000 * (self.n_frames / self.frame_rate))
+    
+    def _frame_index(self, ms):
+        """ms → chỉ số frame, cùng thứ tự phép tính float với AudioSegment.frame_count"""
+        return int(ms * (self.frame_rate / 1000.0))
+    
+    def _acc_dtype(self):
+        return np.int64 if self.sample_width == 4 else np.int32
+    
+    def _ensure_format(self, frame_rate, channels, sample_width):
+        """Nâng định dạng timeline khi gặp segment có định dạng cao hơn"""
+        target = (
+            max(self.frame_rate, frame_rate),
+            max(self.channels, channels),
+            max(self.sample_width, sample_width)
+        )
+        if target == (self.frame_rate, self.channels, self.sample_width):
+            return
+        
+        if self._buffer is None:
+            # Chưa có dữ liệu: chỉ cần tính lại số frame
+            self.n_frames = resampled_length(self.n_frames, self.frame_rate, target[0])
+            self.frame_rate, self.channels, self.sample_width = target
+            return
+        
+        # Hiếm gặp: chuyển timeline hiện có bằng pydub để giữ đúng cách làm tròn
+        current = self.to_audio_segment()
+        converted = (current.set_channels(target[1])
+                     .set_frame_rate(target[0])
+                     .set_sample_width(target[2]))
+        self.frame_rate, self.channels, self.sample_width = target
+        self.n_frames = int(converted.frame_count())
+        self._buffer = None
+        self._allocate()
+        self._buffer[:] = np.frombuffer(
+            converted.raw_data, dtype=SAMPLE_DTYPES[self.sample_width]
+        ).reshape(-1, self.channels)[:self.n_frames]
+    
+    def _allocate(self):
+        if self._buffer is None:
+            self._buffer = np.zeros((self.n_frames, self.channels), dtype=self._acc_dtype())
+    
+    def _fit_overlay_length(self):
+        """
+        Làm tròn độ dài timeline về số ms nguyên như overlay của pydub
+        
+        overlay ghép seg1[:position] + seg1[position:] với biên là len() tính
+        bằng ms đã làm tròn, nên timeline bị cắt/bù vài frame ở cuối. Phép
+        làm tròn này lũy đẳng nên chỉ có tác dụng ở lần cộng đầu tiên.
+        """
+        n_frames = self._frame_index(len(self))
+        if n_frames == self.n_frames:
+            return
+        if n_frames < self.n_frames:
+            self._buffer = self._buffer[:n_frames]
+        else:
+            pad = np.zeros((n_frames - self.n_frames, self.channels), dtype=self._buffer.dtype)
+            self._buffer = np.concatenate([self._buffer, pad])
+        self.n_frames = n_frames
+    
+    def add(self, audio_seg, position_ms):
+        """
+        Cộng một segment vào timeline tại position_ms
+        
+        Phần vượt quá cuối timeline bị cắt bỏ (giống overlay).
+        
+        Args:
+            audio_seg: pydub AudioSegment
+            position_ms: Vị trí bắt đầu (ms)
+        """
+        self._ensure_format(audio_seg.frame_rate, audio_seg.channels, audio_seg.sample_width)
+        self._allocate()
+        
+        seg = (audio_seg.set_channels(self.channels)
+               .set_frame_rate(self.frame_rate)
+               .set_sample_width(self.sample_width))
+        samples = np.frombuffer(seg.raw_data, dtype=SAMPLE_DTYPES[self.sample_width])
+        samples = samples.reshape(-1, self.channels)
+        
+        self.add_samples(samples, position_ms)
+    
+    def add_samples(self, samples, position_ms):
+        """
+        Cộng mảng sample (đã cùng định dạng với timeline) tại position_ms
+        
+        Args:
+            samples: np.ndarray shape (n_frames, channels)
+            position_ms: Vị trí bắt đầu (ms)
+        """
+        self._allocate()
+        self._fit_overlay_length()
+        if position_ms < 0:
+            position_ms = len(self) + position_ms
+        start = self._frame_index(min(position_ms, len(self)))
+        n = min(len(samples), self.n_frames - start)
+        if n > 0:
+            self._buffer[start:start + n] += samples[:n]
+    
+    def to_array(self):
+        """Timeline đã clip về định dạng sample, shape (n_frames, channels)"""
+        self._allocate()
+        dtype = SAMPLE_DTYPES[self.sample_width]
+        info = np.iinfo(dtype)
+        return np.clip(self._buffer, info.min, info.max).astype(dtype)
+    
+    def to_audio_segment(self):
+        """Chuyển timeline thành pydub AudioSegment"""
+        return AudioSegment(
+            data=self.to_array().tobytes(),
+            sample_width=self.sample_width,
+            frame_rate=self.frame_rate,
+            channels=self.channels
+        )
+    
+    def export(self, out_wav, chunk_frames=1 << 20):
+        """
+        Ghi timeline ra file WAV, clip và ghi theo từng khối để không
+        phải tạo thêm bản sao của cả timeline
+        
+        Args:
+            out_wav: Đường dẫn file WAV output
+            chunk_frames: Số frame mỗi lần ghi
+        """
+        self._allocate()
+        dtype = SAMPLE_DTYPES[self.sample_width]
+        info = np.iinfo(dtype)
+        with wave.open(out_wav, "wb") as wf:
+            wf.setnchannels(self.channels)
+            wf.setsampwidth(self.sample_width)
+            wf.setframerate(self.frame_rate)
+            for k in range(0, self.n_frames, chunk_frames):
+                chunk = np.clip(self._buffer[k:k + chunk_frames], info.min, info.max)
+                wf.writeframesraw(wav_frame_bytes(chunk.astype(dtype), self.sample_width))
+
+
+def negotiate_format(formats):
+    """
+    Định dạng timeline cho một tập segment, giống cách TimelineMixer nâng định dạng
+    
+    Bắt đầu từ định dạng cơ sở (BASE_*), lấy frame rate, số kênh và sample
+    width lớn nhất trong các segment.
+    
+    Args:
+        formats: Các tuple (frame_rate, channels, sample_width)
+    
+    Returns:
+        (frame_rate, channels, sample_width)
+    """
+    fmt = (BASE_FRAME_RATE, BASE_CHANNELS, BASE_SAMPLE_WIDTH)
+    for seg_fmt in formats:
+        fmt = tuple(max(a, b) for a, b in zip(fmt, seg_fmt))
+    return fmt
+
+
+def overlay_timeline_frames(total_duration_ms, frame_rate):
+    """
+    Số frame của timeline overlay cũ khi đã ở sample rate frame_rate
+    
+    Tương đương AudioSegment.silent(total) → set_frame_rate → overlay
+    (kể cả bước làm tròn về ms nguyên), để output streaming dài đúng bằng
+    output của TimelineMixer.
+    """
+    if frame_rate < BASE_FRAME_RATE:
+        return int(total_duration_ms * (frame_rate / 1000.0))
+    n_frames = int(BASE_FRAME_RATE * (total_duration_ms / 1000.0))
+    n_frames = resampled_length(n_frames, BASE_FRAME_RATE, frame_rate)
+    length_ms = round(1000 * (n_frames / frame_rate))
+    return int(length_ms * (frame_rate / 1000.0))
+
+
+class StreamingTimelineWriter:
+    """
+    Ghép timeline theo từng cửa sổ thời gian cố định
+    
+    Chỉ decode các segment chồng lên cửa sổ hiện tại, ghi cửa sổ ra output
+    rồi mới sang cửa sổ kế tiếp. Bộ nhớ tối đa ≈ một cửa sổ + các segment
+    đang chồng lên nó (≈ segment dài nhất), không phụ thuộc độ dài video.
+    
+    Định dạng output cố định từ đầu (thỏa thuận trước bằng negotiate_format
+    như TimelineMixer); segment khác định dạng được chuyển đổi bằng pydub
+    trước khi cộng.
+    """
+    
+    def __init__(self, total_duration_ms, frame_rate, channels=1, sample_width=2, window_ms=10000):
+        """
+        Args:
+            total_duration_ms: Độ dài timeline (ms)
+            frame_rate: Sample rate output
+            channels: Số kênh output
+            sample_width: Số byte mỗi sample
+            window_ms: Độ dài mỗi cửa sổ render (ms)
+        """
+        self.frame_rate = frame_rate
+        self.channels = channels
+        self.sample_width = sample_width
+        self.n_frames = overlay_timeline_frames(total_duration_ms, frame_rate)
+        self.window_frames = max(1, int(window_ms * (frame_rate / 1000.0)))
+    
+    def to_samples(self, audio_seg):
+        """AudioSegment → mảng sample theo định dạng output, shape (frames, channels)"""
+        seg = (audio_seg.set_channels(self.channels)
+               .set_frame_rate(self.frame_rate)
+               .set_sample_width(self.sample_width))
+        return np.frombuffer(seg.raw_data, dtype=SAMPLE_DTYPES[self.sample_width]).reshape(-1, self.channels)
+    
+    def render(self, items):
+        """
+        Sinh lần lượt từng cửa sổ đã clip
+        
+        Args:
+            items: Iterable (start_ms, load) đã sắp xếp theo start_ms;
+                   load() trả về AudioSegment hoặc None (bỏ qua)
+        
+        Yields:
+            np.ndarray shape (frames, channels), dtype theo sample_width
+        
+        Sau khi render xong, self.spans chứa (start_frame, end_frame) của
+        từng item theo thứ tự items (None nếu load() trả về None).
+        """
+        self.spans = []
+        pending = iter(items)
+        next_item = next(pending, None)
+        active = []  # (start_frame, samples)
+        
+        for w0 in range(0, self.n_frames, self.window_frames):
+            w1 = min(w0 + self.window_frames, self.n_frames)
+            
+            # Decode các segment bắt đầu trước khi cửa sổ kết thúc
+            while next_item is not None:
+                start_ms, load = next_item
+                start = self.frame_index(start_ms)
+                if start >= w1:
+                    break
+                audio_seg = load()
+                if audio_seg is not None:
+                    samples = self.to_samples(audio_seg)
+                    active.append((start, samples))
+                    self.spans.append((start, start + len(samples)))
+                else:
+                    self.spans.append(None)
+                next_item = next(pending, None)
+            
+            yield self.mix_window(w0, w1, active)
+            active = [(start, samples) for start, samples in active if start + len(samples) > w1]
+    
+    def frame_index(self, ms):
+        """ms → chỉ số frame trên timeline output"""
+        return int(ms * (self.frame_rate / 1000.0))
+    
+    def window_bounds(self, index):
+        """(w0, w1) của cửa sổ thứ index"""
+        w0 = index * self.window_frames
+        return w0, min(w0 + self.window_frames, self.n_frames)
+    
+    def mix_window(self, w0, w1, placed):
+        """
+        Cộng các segment vào cửa sổ [w0, w1) và clip
+        
+        Args:
+            w0, w1: Frame đầu/cuối của cửa sổ
+            placed: Iterable (start_frame, samples), phần nằm ngoài cửa sổ bị bỏ qua
+        
+        Returns:
+            np.ndarray shape (w1 - w0, channels), dtype theo sample_width
+        """
+        dtype = SAMPLE_DTYPES[self.sample_width]
+        info = np.iinfo(dtype)
+        acc_dtype = np.int64 if self.sample_width == 4 else np.int32
+        
+        window = np.zeros((w1 - w0, self.channels), dtype=acc_dtype)
+        for start, samples in placed:
+            a = max(start, w0)
+            b = min(start + len(samples), w1)
+            if a < b:
+                window[a - w0:b - w0] += samples[a - start:b - start]
+        return np.clip(window, info.min, info.max).astype(dtype)
+    
+    def write_wav(self, items, out_wav):
+        """Render và ghi thẳng ra file WAV"""
+        with wave.open(out_wav, "wb") as wf:
+            wf.setnchannels(self.channels)
+            wf.setsampwidth(self.sample_width)
+            wf.setframerate(self.frame_rate)
+            for window in self.render(items):
+                wf.writeframesraw(wav_frame_bytes(window, self.sample_width))
+    
+    def write_raw(self, items, stream):
+        """Render và ghi PCM thô vào stream (vd: stdin của ffmpeg), 8-bit là số có dấu"""
+        for window in self.render(items):
+            stream.write(window.tobytes())
+    
+    def matches_wav(self, out_wav):
+        """File WAV đã có cùng định dạng và độ dài với timeline này không"""
+        try:
+            with wave.open(out_wav, "rb") as wf:
+                return (wf.getframerate(), wf.getnchannels(), wf.getsampwidth(), wf.getnframes()) == \
+                    (self.frame_rate, self.channels, self.sample_width, self.n_frames)
+        except (OSError, EOFError, wave.Error):
+            return False
+    
+    def patch_wav(self, out_wav, windows):
+        """
+        Ghi đè tại chỗ một số cửa sổ của file WAV đã có (cùng định dạng)
+        
+        Args:
+            out_wav: File WAV do write_wav tạo ra (kiểm tra bằng matches_wav)
+            windows: Iterable (w0, mảng sample đã clip) từ mix_window
+        """
+        frame_size = self.channels * self.sample_width
+        offset = wav_data_offset(out_wav)
+        with open(out_wav, "r+b") as f:
+            for w0, window in windows:
+                f.seek(offset + w0 * frame_size)
+                f.write(wav_frame_bytes(window, self.sample_width))
+
+
+def wav_data_offset(path):
+    """Vị trí byte bắt đầu dữ liệu PCM (chunk "data") trong file WAV"""
+    with open(path, "rb") as f:
+        header = f.read(12)
+        if header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+            raise ValueError(f"Không phải file WAV: {path}")
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                raise ValueError(f"Không tìm thấy chunk data: {path}")
+            size = int.from_bytes(chunk[4:8], "little")
+            if chunk[:4] == b"data":
+                return f.tell()
+            f.seek(size + (size & 1), 1)
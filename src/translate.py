@@ -1,52 +1,239 @@
-from transformers import pipeline
-import json
 import os
+import config
+from translation_cache import TranslationCache, make_cache_key
+from progress_journal import ProgressJournal
+from segment_store import SegmentStore, load_segments, save_segments, segments_path
+from model_registry import get_translator
+from metrics import instrument, record, record_cache
 
 
-def translate_segments(in_json, out_json):
+def _bucket_by_length(texts, tokenizer, batch_size):
+    """
+    Sắp xếp câu theo số token và chia thành các bucket
+    
+    Các câu có độ dài gần nhau được dịch chung một lần, giảm padding
+    trong mỗi batch.
+    
+    Args:
+        texts: Danh sách câu cần dịch
+        tokenizer: Tokenizer của model dịch
+        batch_size: Số câu tối đa mỗi bucket
+    
+    Returns:
+        List các bucket, mỗi bucket là list index trong texts
+    """
+    lengths = [len(tokenizer.tokenize(text)) for text in texts]
+    order = sorted(range(len(texts)), key=lambda i: lengths[i])
+    return [order[k:k + batch_size] for k in range(0, len(order), batch_size)]
+
+
+def translate_batch(translator, texts, batch_size=None, max_length=None, on_batch=None):
+    """
+    Dịch nhiều câu theo batch, kết quả giữ đúng thứ tự ban đầu
+    
+    Args:
+        translator: transformers translation pipeline
+        texts: Danh sách câu tiếng Anh (không rỗng)
+        batch_size: Số câu mỗi lần gọi model (mặc định: config.BATCH_SIZE)
+        max_length: Độ dài tối đa output (mặc định: config.MAX_TRANSLATION_LENGTH)
+        on_batch: Hàm (indices, bản dịch) gọi sau mỗi batch (để lưu tiến độ)
+    
+    Returns:
+        List bản dịch cùng độ dài với texts, None ở câu bị lỗi
+    """
+    batch_size = max(1, batch_size or config.BATCH_SIZE)
+    max_length = max_length or config.MAX_TRANSLATION_LENGTH
+    
+    results = [None] * len(texts)
+    buckets = _bucket_by_length(texts, translator.tokenizer, batch_size)
+    
+    for bucket in buckets:
+        bucket_texts = [texts[i] for i in bucket]
+        try:
+            outputs = translator(bucket_texts, max_length=max_length, batch_size=len(bucket))
+            for i, out in zip(bucket, outputs):
+                results[i] = out["translation_text"]
+        except Exception as e:
+            # Lỗi cả batch → dịch lại từng câu để không mất các câu còn lại
+            print(f"  ⚠️ Lỗi dịch batch ({len(bucket)} câu): {e}, thử dịch từng câu...")
+            for i in bucket:
+                try:
+                    results[i] = translator(texts[i], max_length=max_length)[0]["translation_text"]
+                except Exception as e:
+                    print(f"  ⚠️ Lỗi dịch câu: {texts[i][:50]}... ({e})")
+        
+        if on_batch:
+            on_batch(bucket, [results[i] for i in bucket])
+    
+    return results
+
+
+def _reuse_existing(segments, out_json):
+    """
+    Giữ lại các segment của bản dịch cũ có câu tiếng Anh không đổi
+    
+    So theo vị trí và text gốc; segment được giữ nguyên cả dict (vi_text,
+    timing, voice_* đã chỉnh tay...). Câu lỗi dịch lần trước (vi_text
+    trùng tiếng Anh) không được giữ để dịch lại.
+    
+    Returns:
+        set index các segment đã giữ lại
+    """
+    if isinstance(out_json, SegmentStore):
+        old_segments = out_json.rows(["text", "vi_text"])
+    else:
+        if not os.path.exists(out_json):
+            return set()
+        try:
+            old_segments = load_segments(out_json)
+        except (OSError, ValueError):
+            return set()
+    
+    kept = set()
+    for i, (seg, old) in enumerate(zip(segments, old_segments)):
+        if seg["text"] and old.get("text") == seg["text"] and old.get("vi_text") \
+                and old["vi_text"] != seg["text"]:
+            segments[i] = old
+            kept.add(i)
+    return kept
+
+
+@instrument("translate")
+def translate_segments(in_json, out_json, batch_size=None, use_cache=None, cache_path=None, translator=None,
+                       resume=None, incremental=None):
     """
     Dịch các segments từ tiếng Anh sang tiếng Việt
     
     Args:
-        in_json: Đường dẫn JSON input (tiếng Anh)
-        out_json: Đường dẫn JSON output (đã dịch tiếng Việt)
+        in_json: Đường dẫn JSON input (tiếng Anh) hoặc SegmentStore
+        out_json: Đường dẫn JSON output (đã dịch tiếng Việt) hoặc SegmentStore
+                  (có thể trùng in_json, chỉ cột vi_text được cập nhật)
+        batch_size: Số câu dịch cùng lúc (mặc định: config.BATCH_SIZE)
+        use_cache: Dùng cache bản dịch (mặc định: config.TRANSLATION_CACHE_ENABLED)
+        cache_path: File cache (mặc định: cache/translations.sqlite)
+        translator: Pipeline dịch đã load (mặc định: lấy từ model_registry khi cần);
+                    cache và journal theo model của pipeline này, không theo config
+        resume: Ghi từng batch đã dịch vào <out_json>.progress.jsonl và dùng lại khi
+                chạy lại sau khi bị dừng (mặc định: config.SEGMENT_JOURNAL_ENABLED)
+        incremental: Giữ nguyên các câu trong out_json cũ có tiếng Anh không đổi,
+                     chỉ dịch câu mới/đã sửa (mặc định: config.INCREMENTAL_REDUB)
     """
-    print("🌏 Đang khởi tạo model dịch Helsinki-NLP/opus-mt-en-vi...")
+    if use_cache is None:
+        use_cache = config.TRANSLATION_CACHE_ENABLED
+    if resume is None:
+        resume = config.SEGMENT_JOURNAL_ENABLED
+    if incremental is None:
+        incremental = config.INCREMENTAL_REDUB
+    
+    # Key cache/journal theo model thực sự dịch
+    model_name = config.TRANSLATION_MODEL
+    if translator is not None:
+        model_name = getattr(getattr(translator, "model", None), "name_or_path", None)
+        if not model_name:
+            # Không biết model của translator: bỏ cache/journal để không lẫn bản dịch của model khác
+            use_cache = resume = False
     
     try:
-        # Khởi tạo translator
-        translator = pipeline(
-            "translation",
-            model="Helsinki-NLP/opus-mt-en-vi",
-            device=-1  # CPU mode
+        # Load segments (ghi vào store thì chỉ cần câu gốc và bản dịch cũ)
+        segments = load_segments(
+            in_json, columns=["text", "vi_text"] if isinstance(out_json, SegmentStore) else None
         )
         
-        # Load segments
-        with open(in_json, encoding="utf-8") as f:
-            segments = json.load(f)
+        batch_size = max(1, batch_size or config.BATCH_SIZE)
+        print(f"📝 Đang dịch {len(segments)} câu (batch size: {batch_size})...")
         
-        print(f"📝 Đang dịch {len(segments)} câu...")
+        # Bản dịch cũ còn dùng được (kể cả chỉnh tay) thì giữ nguyên
+        kept = _reuse_existing(segments, out_json) if incremental else set()
+        if kept:
+            print(f"♻️ Giữ nguyên {len(kept)} câu đã dịch không đổi")
         
-        # Dịch từng segment
+        # Chỉ dịch các segment có text
+        todo = [i for i, seg in enumerate(segments) if seg["text"] and i not in kept]
+        texts = [segments[i]["text"] for i in todo]
+        translations = [None] * len(texts)
+        
+        # 1. Tra cache trước
+        cache = None
+        if use_cache and texts:
+            cache = TranslationCache(
+                cache_path,
+                model=model_name,
+                params={"max_length": config.MAX_TRANSLATION_LENGTH}
+            )
+            translations = cache.get_many(texts)
+        
+        # 2. Dịch các câu chưa có trong cache (mỗi câu trùng lặp chỉ dịch một lần)
+        missing = list(dict.fromkeys(
+            text for text, vi_text in zip(texts, translations) if vi_text is None
+        ))
+        translated = {}
+        journal = None
+        if missing and resume:
+            # Các câu đã dịch xong ở lần chạy bị dừng giữa chừng
+            journal = ProgressJournal(os.path.splitext(segments_path(out_json))[0] + ".progress.jsonl")
+            params = {"max_length": config.MAX_TRANSLATION_LENGTH}
+            keys = {text: make_cache_key(text, model_name, params) for text in missing}
+            for text in missing:
+                entry = journal.get(keys[text], keys[text])
+                if entry:
+                    translated[text] = entry["translation"]
+            if translated:
+                print(f"♻️ Tiếp tục lần chạy trước: {len(translated)} câu đã dịch")
+            missing = [text for text in missing if text not in translated]
+        
+        if missing:
+            if translator is None:
+                print(f"🌏 Đang khởi tạo model dịch {config.TRANSLATION_MODEL}...")
+                translator = get_translator(config.TRANSLATION_MODEL)
+            
+            def on_batch(indices, results):
+                # Lưu ngay sau mỗi batch để không mất tiến độ khi bị dừng
+                done = [(missing[i], vi) for i, vi in zip(indices, results) if vi is not None]
+                if journal:
+                    for text, vi in done:
+                        journal.record(keys[text], keys[text], translation=vi)
+                if cache:
+                    cache.put_many(done)
+            
+            translated.update(zip(missing, translate_batch(
+                translator, missing, batch_size=batch_size, on_batch=on_batch
+            )))
+        
+        if journal:
+            journal.close()
+        if translated:
+            translations = [
+                vi_text if vi_text is not None else translated[text]
+                for text, vi_text in zip(texts, translations)
+            ]
+        
+        if cache:
+            stats = cache.stats()
+            print(f"💾 Cache dịch: {stats['hits']} hit / {stats['misses']} miss "
+                  f"({stats['hit_rate']:.0%}), {stats['entries']} entries")
+            record_cache(stats)
+            cache.close()
+        
+        # Ghi kết quả về đúng segment theo thứ tự gốc
         for i, seg in enumerate(segments):
-            if seg["text"]:
-                try:
-                    vi_text = translator(seg["text"], max_length=512)[0]["translation_text"]
-                    seg["vi_text"] = vi_text
-                    print(f"  [{i+1}/{len(segments)}] EN: {seg['text'][:50]}...")
-                    print(f"           VI: {vi_text[:50]}...")
-                except Exception as e:
-                    print(f"  ⚠️ Lỗi dịch câu {i+1}: {e}")
-                    seg["vi_text"] = seg["text"]  # Giữ nguyên nếu lỗi
-            else:
+            if i not in kept:
                 seg["vi_text"] = ""
         
+        for i, vi_text in zip(todo, translations):
+            seg = segments[i]
+            if vi_text is None:
+                print(f"  ⚠️ Lỗi dịch câu {i+1}, giữ nguyên tiếng Anh")
+                seg["vi_text"] = seg["text"]  # Giữ nguyên nếu lỗi
+                continue
+            seg["vi_text"] = vi_text
+            print(f"  [{i+1}/{len(segments)}] EN: {seg['text'][:50]}...")
+            print(f"           VI: {vi_text[:50]}...")
+        
         # Lưu kết quả
-        os.makedirs(os.path.dirname(out_json), exist_ok=True)
-        with open(out_json, "w", encoding="utf-8") as f:
-            json.dump(segments, f, ensure_ascii=False, indent=2)
+        save_segments(out_json, segments, fields=["vi_text"])
         
-        print(f"✅ Dịch hoàn tất: {out_json}")
+        print(f"✅ Dịch hoàn tất: {segments_path(out_json)}")
+        record(segments=len(segments), reused=len(kept), translated=len(missing))
         return True
         
     except Exception as e:
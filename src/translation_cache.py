@@ -0,0 +1,233 @@
+"""
+Translation Cache
+Lưu bản dịch trên đĩa (SQLite) để tái sử dụng giữa các lần chạy
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+import unicodedata
+from pathlib import Path
+
+import config
+
+
+def default_cache_path():
+    """Đường dẫn mặc định của file cache dịch (trong thư mục cache của project)"""
+    base_dir = Path(__file__).parent.parent
+    return str(base_dir / config.CACHE_DIR / "translations.sqlite")
+
+
+def normalize_source_text(text):
+    """
+    Chuẩn hóa câu nguồn trước khi tính key
+    
+    Gộp khoảng trắng và chuẩn hóa Unicode (NFC) để các câu chỉ khác
+    nhau về khoảng trắng dùng chung một bản dịch.
+    """
+    text = unicodedata.normalize("NFC", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def make_cache_key(text, model, params=None):
+    """
+    Tạo key cho cache từ (câu nguồn đã chuẩn hóa, model, tham số generate)
+    
+    Args:
+        text: Câu tiếng Anh
+        model: Tên model dịch
+        params: dict tham số generate (max_length, ...)
+    
+    Returns:
+        SHA-256 hex digest
+    """
+    payload = json.dumps(
+        [normalize_source_text(text), model, params or {}],
+        ensure_ascii=False,
+        sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class TranslationCache:
+    """
+    Cache bản dịch dùng SQLite
+    
+    - Dùng chung được giữa nhiều pipeline chạy song song trên cùng máy
+      (SQLite WAL mode + busy timeout)
+    - Giới hạn số entry / dung lượng, loại bỏ theo LRU
+    - Đếm hit/miss của phiên hiện tại
+    """
+    
+    def __init__(self, path=None, model=None, params=None,
+                 max_entries=None, max_bytes=None):
+        """
+        Args:
+            path: File SQLite (mặc định: cache/translations.sqlite)
+            model: Tên model dịch (mặc định: config.TRANSLATION_MODEL)
+            params: dict tham số generate là một phần của key
+            max_entries: Số entry tối đa (mặc định: config.TRANSLATION_CACHE_MAX_ENTRIES)
+            max_bytes: Tổng dung lượng text tối đa (None = không giới hạn)
+        """
+        self.path = path or default_cache_path()
+        self.model = model or config.TRANSLATION_MODEL
+        self.params = params or {}
+        self.max_entries = max_entries if max_entries is not None else config.TRANSLATION_CACHE_MAX_ENTRIES
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        
+        cache_dir = os.path.dirname(self.path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        
+        self._conn = sqlite3.connect(self.path, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS translations ("
+            " key TEXT PRIMARY KEY,"
+            " source TEXT NOT NULL,"
+            " translation TEXT NOT NULL,"
+            " model TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_translations_last_access"
+            " ON translations(last_access)"
+        )
+        self._conn.commit()
+    
+    def key(self, text):
+        """Key của một câu với model/params của cache này"""
+        return make_cache_key(text, self.model, self.params)
+    
+    def get_many(self, texts):
+        """
+        Tra cứu nhiều câu cùng lúc
+        
+        Args:
+            texts: Danh sách câu tiếng Anh
+        
+        Returns:
+            List bản dịch cùng độ dài, None ở câu chưa có trong cache
+        """
+        keys = [self.key(text) for text in texts]
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        
+        # SQLite giới hạn số biến trong một câu lệnh → tra theo chunk
+        for k in range(0, len(unique_keys), 500):
+            chunk = unique_keys[k:k + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self._conn.execute(
+                f"SELECT key, translation FROM translations WHERE key IN ({placeholders})",
+                chunk
+            ).fetchall()
+            found.update(rows)
+        
+        if found:
+            now = time.time()
+            with self._conn:
+                self._conn.executemany(
+                    "UPDATE translations SET last_access = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+        
+        results = [found.get(key) for key in keys]
+        hit_count = sum(1 for r in results if r is not None)
+        self.hits += hit_count
+        self.misses += len(results) - hit_count
+        return results
+    
+    def get(self, text):
+        """Tra cứu một câu, trả về bản dịch hoặc None"""
+        return self.get_many([text])[0]
+    
+    def put_many(self, pairs):
+        """
+        Lưu nhiều bản dịch
+        
+        Args:
+            pairs: Iterable (câu tiếng Anh, bản dịch)
+        """
+        now = time.time()
+        rows = [
+            (self.key(src), src, dst, self.model,
+             len(src.encode("utf-8")) + len(dst.encode("utf-8")), now)
+            for src, dst in pairs
+        ]
+        if not rows:
+            return
+        
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO translations"
+                " (key, source, translation, model, size, last_access)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                rows
+            )
+        self.evict()
+    
+    def put(self, text, translation):
+        """Lưu một bản dịch"""
+        self.put_many([(text, translation)])
+    
+    def evict(self):
+        """Loại bỏ các entry ít được dùng nhất khi vượt giới hạn"""
+        removed = 0
+        with self._conn:
+            if self.max_entries:
+                count = self._conn.execute("SELECT COUNT(*) FROM translations").fetchone()[0]
+                if count > self.max_entries:
+                    removed += self._conn.execute(
+                        "DELETE FROM translations WHERE key IN ("
+                        " SELECT key FROM translations ORDER BY last_access ASC LIMIT ?)",
+                        (count - self.max_entries,)
+                    ).rowcount
+            
+            if self.max_bytes:
+                total = self._conn.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM translations"
+                ).fetchone()[0]
+                if total > self.max_bytes:
+                    # Xóa dần từ entry cũ nhất cho đến khi đủ chỗ
+                    rows = self._conn.execute(
+                        "SELECT key, size FROM translations ORDER BY last_access ASC"
+                    ).fetchall()
+                    victims = []
+                    for key, size in rows:
+                        if total <= self.max_bytes:
+                            break
+                        victims.append((key,))
+                        total -= size
+                    self._conn.executemany("DELETE FROM translations WHERE key = ?", victims)
+                    removed += len(victims)
+        return removed
+    
+    def stats(self):
+        """Thống kê hit/miss của phiên hiện tại và kích thước cache"""
+        count, size = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM translations"
+        ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": count,
+            "bytes": size
+        }
+    
+    def close(self):
+        """Đóng kết nối SQLite"""
+        self._conn.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
@@ -3,12 +3,21 @@ Advanced TTS with Audio Mixing
 Mix original audio with Vietnamese TTS to preserve emotion
 """
 import os
-import json
 from pydub import AudioSegment
 from pydub.effects import normalize
+import numpy as np
 import edge_tts
 import asyncio
-from text_cleaner import clean_text_for_tts, validate_text
+import config
+from audio_cache import AudioCache, make_audio_key, link_or_copy
+from audio_source import AudioSource
+from extract_audio import AudioBuffer
+from progress_journal import ProgressJournal, input_hash, file_fingerprint
+from segment_store import load_segments, save_segments
+from segment_bank import BANK_NAME, open_bank, audio_exists
+from time_stretch import audio_segment_to_float
+from text_cleaner import TextNormalizer
+from metrics import instrument, record, record_cache
 
 
 # Danh sách giọng tiếng Việt
@@ -35,23 +44,23 @@ async def _tts_with_ssml(text, output_path, voice="female", rate="+0%", pitch="+
     await communicate.save(output_path)
 
 
-def extract_segment_audio(original_audio_path, start_time, end_time, output_path):
+def extract_segment_audio(original_audio, start_time, end_time, output_path):
     """
     Trích xuất một segment audio từ audio gốc
     
     Args:
-        original_audio_path: Audio gốc
+        original_audio: Audio gốc (đường dẫn hoặc AudioSource đã mở sẵn;
+                        nên truyền AudioSource khi trích nhiều segment)
         start_time: Thời gian bắt đầu (seconds)
         end_time: Thời gian kết thúc (seconds)
         output_path: Đường dẫn output
     """
     try:
-        audio = AudioSegment.from_file(original_audio_path)
-        
-        # Extract segment
-        start_ms = int(start_time * 1000)
-        end_ms = int(end_time * 1000)
-        segment = audio[start_ms:end_ms]
+        if isinstance(original_audio, AudioSource):
+            segment = original_audio.segment(start_time, end_time)
+        else:
+            with AudioSource(original_audio) as source:
+                segment = source.segment(start_time, end_time)
         
         # Export
         segment.export(output_path, format="wav")
@@ -66,7 +75,7 @@ def mix_audio_segments(original_segment, tts_segment, output_path, tts_volume=1.
     Mix audio gốc (giảm volume) với TTS để giữ background emotion
     
     Args:
-        original_segment: Audio gốc của segment
+        original_segment: Audio gốc của segment (đường dẫn hoặc AudioSegment)
         tts_segment: Audio TTS tiếng Việt
         output_path: Output path
         tts_volume: Volume của TTS (0.0-1.0)
@@ -74,7 +83,10 @@ def mix_audio_segments(original_segment, tts_segment, output_path, tts_volume=1.
     """
     try:
         # Load both audio
-        original = AudioSegment.from_file(original_segment)
+        if isinstance(original_segment, AudioSegment):
+            original = original_segment
+        else:
+            original = AudioSegment.from_file(original_segment)
         tts = AudioSegment.from_file(tts_segment)
         
         # Điều chỉnh volume
@@ -106,129 +118,416 @@ def mix_audio_segments(original_segment, tts_segment, output_path, tts_volume=1.
         return False
 
 
-def tts_segments_advanced(segments_json, original_audio, out_dir, auto_voice=True, enable_mixing=False):
+def _render_to_file(tts_temp, final_path, orig_segment=None):
+    """
+    Ghi audio cuối của một câu ra file MP3 (mix với audio gốc nếu có)
+    
+    Returns:
+        True nếu đã mix, False nếu chỉ dùng TTS
+    """
+    # File cũ có thể là hard link tới cache → xóa thay vì ghi đè lên
+    if os.path.exists(final_path):
+        os.remove(final_path)
+    if orig_segment is not None and mix_audio_segments(orig_segment, tts_temp, final_path):
+        return True
+    os.replace(tts_temp, final_path)
+    return False
+
+
+def _render_to_bank(bank, key, tts_temp, orig_segment=None):
+    """
+    Ghi audio cuối của một câu vào SegmentBank (PCM float32)
+    
+    MP3 của TTS chỉ được decode một lần ở đây; mix và lưu đều trên float32.
+    
+    Returns:
+        True nếu đã mix, False nếu chỉ dùng TTS
+    """
+    tts_audio = AudioSegment.from_file(tts_temp)
+    if orig_segment is not None:
+        try:
+            samples, frame_rate = mix_audio_samples(orig_segment, tts_audio)
+            bank.put(key, samples, frame_rate)
+            return True
+        except Exception as e:
+            print(f"  ⚠️ Lỗi mix audio: {e}")
+    bank.put(key, audio_segment_to_float(tts_audio), tts_audio.frame_rate)
+    return False
+
+
+def _normalize_peak(y, headroom=0.1):
+    """Như pydub.effects.normalize: đưa đỉnh về -headroom dBFS"""
+    peak = np.abs(y).max() if len(y) else 0
+    if peak == 0:
+        return y
+    return y * (10 ** (-headroom / 20) / peak)
+
+
+def mix_audio_samples(original_segment, tts_audio, tts_volume=1.0, original_volume=0.2):
+    """
+    Bản NumPy của mix_audio_segments: trả về PCM float32 thay vì ghi MP3
+    
+    Cùng các bước (giảm volume, normalize, khớp độ dài theo TTS, cộng) nhưng
+    tính trên float32 nên không lượng tử hóa hay encode lại giữa chừng.
+    
+    Args:
+        original_segment: AudioSegment audio gốc của segment
+        tts_audio: AudioSegment TTS đã decode
+        tts_volume: Volume của TTS (0.0-1.0)
+        original_volume: Volume của audio gốc (0.0-0.5)
+    
+    Returns:
+        (samples float32 shape (n_frames, channels), frame_rate)
+    """
+    # Đưa hai audio về cùng định dạng như overlay của pydub
+    frame_rate = max(tts_audio.frame_rate, original_segment.frame_rate)
+    channels = max(tts_audio.channels, original_segment.channels)
+    original = audio_segment_to_float(original_segment.set_frame_rate(frame_rate).set_channels(channels))
+    tts = audio_segment_to_float(tts_audio.set_frame_rate(frame_rate).set_channels(channels))
+    
+    # Điều chỉnh volume (dB) rồi normalize
+    original_bg = _normalize_peak(original * 10 ** (-(60 - int(original_volume * 60)) / 20))
+    tts_main = _normalize_peak(tts * 10 ** (-(60 - int(tts_volume * 60)) / 20))
+    
+    # Match duration: pad hoặc cắt audio gốc theo độ dài TTS
+    if len(tts_main) > len(original_bg):
+        original_bg = np.concatenate([original_bg, np.zeros((len(tts_main) - len(original_bg), channels), np.float32)])
+    else:
+        original_bg = original_bg[:len(tts_main)]
+    
+    return np.clip(original_bg + tts_main, -1.0, 1.0).astype(np.float32), frame_rate
+
+
+def _voice_params(seg, auto_voice):
+    """
+    Chọn giọng và prosody (rate, pitch, volume) cho một segment
+    
+    Returns:
+        (voice, rate, pitch, volume, emotion)
+    """
+    if auto_voice and "voice_gender" in seg:
+        voice = seg["voice_gender"]
+        rate = seg.get("tts_rate_adjust", "+0%")
+        emotion = seg.get("voice_emotion", "neutral")
+        
+        # Điều chỉnh pitch theo emotion
+        if emotion == "excited":
+            pitch = "+8Hz"
+            volume = "+5%"
+        elif emotion == "calm":
+            pitch = "-5Hz"
+            volume = "-5%"
+        elif emotion == "urgent":
+            pitch = "+3Hz"
+            volume = "+10%"
+        else:
+            pitch = "+0Hz"
+            volume = "+0%"
+    else:
+        voice = "female"
+        rate = "+0%"
+        pitch = "+0Hz"
+        volume = "+0%"
+        emotion = "neutral"
+    
+    return voice, rate, pitch, volume, emotion
+
+
+async def _synthesize_all(jobs, backend, concurrency, timeout, retries, on_done=None):
+    """
+    Tổng hợp tất cả jobs trên cùng một event loop
+    
+    Args:
+        jobs: List dict với text, output_path, voice, rate, pitch, volume
+        backend: Coroutine function (text, output_path, voice, rate, pitch, volume)
+        concurrency: Số request chạy đồng thời tối đa
+        timeout: Timeout mỗi request (giây)
+        retries: Số lần thử lại khi lỗi
+        on_done: Hàm (job, error) gọi ngay khi từng job xong (để lưu tiến độ)
+    
+    Returns:
+        List cùng thứ tự với jobs: None nếu thành công, Exception nếu lỗi
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    
+    async def attempt_all(job):
+        error = None
+        for attempt in range(retries + 1):
+            try:
+                await asyncio.wait_for(
+                    backend(job["text"], job["output_path"], job["voice"],
+                            job["rate"], job["pitch"], job["volume"]),
+                    timeout
+                )
+                return None
+            except Exception as e:
+                error = e
+                # Xóa file dở dang trước khi thử lại
+                if os.path.exists(job["output_path"]):
+                    os.remove(job["output_path"])
+                if attempt < retries:
+                    await asyncio.sleep(0.5 * 2 ** attempt)
+        return error
+    
+    async def run(job):
+        async with semaphore:
+            error = await attempt_all(job)
+        if on_done:
+            on_done(job, error)
+        return error
+    
+    return await asyncio.gather(*(run(job) for job in jobs))
+
+
+@instrument("tts")
+def tts_segments_advanced(segments_json, original_audio, out_dir, auto_voice=True, enable_mixing=False,
+                          concurrency=None, timeout=None, retries=None, tts_backend=None,
+                          backend_id=None, use_cache=None, cache_dir=None, resume=None, use_bank=None):
     """
     TTS nâng cao với:
     - Auto gender selection
     - Prosody control dựa trên emotion
     - Optional: Mix với audio gốc để giữ emotion
+    - Gửi nhiều request Edge TTS đồng thời trên một event loop
     
     Args:
-        segments_json: JSON chứa segments
-        original_audio: Audio gốc (để extract background)
+        segments_json: JSON chứa segments hoặc SegmentStore (chỉ cập nhật vi_text_cleaned, vi_audio_path)
+        original_audio: Audio gốc để extract background (đường dẫn hoặc AudioBuffer)
         out_dir: Output directory
         auto_voice: Tự động chọn giọng nam/nữ
         enable_mixing: Mix audio gốc với TTS (experimental)
+        concurrency: Số request TTS đồng thời (mặc định: config.TTS_CONCURRENCY, 1 = tuần tự)
+        timeout: Timeout mỗi request (mặc định: config.TTS_TIMEOUT)
+        retries: Số lần thử lại (mặc định: config.TTS_RETRIES)
+        tts_backend: Coroutine thay cho Edge TTS, cùng signature với _tts_with_ssml
+                     (dùng để test/benchmark offline)
+        backend_id: Tên backend, là một phần của key cache audio
+        use_cache: Dùng cache audio TTS (mặc định: config.TTS_CACHE_ENABLED)
+        cache_dir: Thư mục cache audio (mặc định: cache/tts_audio)
+        resume: Ghi tiến độ từng câu vào <out_dir>/progress.jsonl và bỏ qua câu
+                đã xong ở lần chạy trước (mặc định: config.SEGMENT_JOURNAL_ENABLED)
+        use_bank: Lưu audio từng câu (PCM float32, không encode lại) vào
+                  <out_dir>/segments.bank thay vì MP3 từng câu
+                  (mặc định: config.TTS_AUDIO_BANK)
     """
+    concurrency = concurrency or config.TTS_CONCURRENCY
+    timeout = timeout or config.TTS_TIMEOUT
+    retries = config.TTS_RETRIES if retries is None else retries
+    backend = tts_backend or _tts_with_ssml
+    if backend_id is None:
+        backend_id = "edge-tts" if tts_backend is None else getattr(tts_backend, "__qualname__", "custom")
+    if use_cache is None:
+        use_cache = config.TTS_CACHE_ENABLED
+    if resume is None:
+        resume = config.SEGMENT_JOURNAL_ENABLED
+    if use_bank is None:
+        use_bank = config.TTS_AUDIO_BANK
+    
     print("🗣️ Đang khởi tạo Advanced TTS...")
     print(f"   📊 Auto voice: {auto_voice}")
     print(f"   🎵 Audio mixing: {'Enabled' if enable_mixing else 'Disabled'}")
+    print(f"   ⚡ Concurrency: {concurrency}")
     
     try:
         # Load segments
-        with open(segments_json, encoding="utf-8") as f:
-            segments = json.load(f)
+        segments = load_segments(segments_json, columns=[
+            "start", "end", "vi_text", "voice_gender", "voice_emotion", "tts_rate_adjust"
+        ])
         
         # Tạo thư mục
         os.makedirs(out_dir, exist_ok=True)
         temp_dir = os.path.join(out_dir, "temp")
         os.makedirs(temp_dir, exist_ok=True)
         
+        cache = AudioCache(cache_dir) if use_cache else None
+        journal = ProgressJournal(os.path.join(out_dir, "progress.jsonl")) if resume else None
+        bank = open_bank(os.path.join(out_dir, BANK_NAME)) if use_bank else None
+        original_fingerprint = None
+        if enable_mixing:
+            original_fingerprint = (original_audio.fingerprint() if isinstance(original_audio, AudioBuffer)
+                                    else file_fingerprint(original_audio))
+        
+        # Mở audio gốc một lần, mỗi segment chỉ đọc đúng đoạn của nó
+        source = None
+        if enable_mixing:
+            try:
+                source = AudioSource(original_audio)
+            except Exception as e:
+                print(f"  ⚠️ Không mở được audio gốc, chỉ dùng TTS: {e}")
+        
         print(f"🎙️ Đang tổng hợp giọng nói cho {len(segments)} câu...")
         
+        # 1. Chuẩn bị jobs: clean text và chọn giọng cho từng segment
+        # Clean, đọc thành lời và validate toàn bộ text trong một lượt
+        normalizer = TextNormalizer(expand=config.TTS_SPOKEN_EXPANSION)
+        normalized = normalizer.normalize_many([seg.get("vi_text", "") for seg in segments])
+        
+        jobs = []
         for i, seg in enumerate(segments):
             if not seg.get("vi_text", "").strip():
                 seg["vi_audio_path"] = None
                 continue
             
-            # Clean và validate text trước khi TTS
-            is_valid, cleaned_text, warning = validate_text(seg["vi_text"])
+            is_valid, cleaned_text, warnings = normalized[i]
             
             if not is_valid:
-                print(f"  [{i+1}/{len(segments)}] ⚠️ Skip: {warning}")
+                print(f"  [{i+1}/{len(segments)}] ⚠️ Skip: {'; '.join(warnings)}")
                 seg["vi_audio_path"] = None
                 continue
             
-            if warning:
-                print(f"  [{i+1}/{len(segments)}] ⚠️ {warning}")
+            if warnings:
+                print(f"  [{i+1}/{len(segments)}] ⚠️ {'; '.join(warnings)}")
             
             # Cập nhật text đã clean
             seg["vi_text_cleaned"] = cleaned_text
             
-            final_path = os.path.join(out_dir, f"{i:04d}.mp3")
+            voice, rate, pitch, volume, emotion = _voice_params(seg, auto_voice)
+            jobs.append({
+                "index": i,
+                "text": cleaned_text,  # Dùng cleaned text
+                "output_path": os.path.join(temp_dir, f"{i:04d}_tts.mp3"),
+                "voice": voice,
+                "rate": rate,
+                "pitch": pitch,
+                "volume": volume,
+                "emotion": emotion,
+                "cache_key": make_audio_key(
+                    text=cleaned_text,
+                    voice=VIETNAMESE_VOICES.get(voice, VIETNAMESE_VOICES["female"]),
+                    rate=rate,
+                    pitch=pitch,
+                    volume=volume,
+                    backend=backend_id
+                ),
+                "final_path": bank.ref(f"{i:04d}") if bank else os.path.join(out_dir, f"{i:04d}.mp3"),
+                "error": None
+            })
+            
+            # Hash toàn bộ input của file cuối cùng (audio TTS + mix với audio gốc)
+            job = jobs[-1]
+            job["input_hash"] = input_hash(
+                audio=job["cache_key"],
+                mixing=enable_mixing,
+                start=seg["start"] if enable_mixing else None,
+                end=seg["end"] if enable_mixing else None,
+                original=original_fingerprint
+            )
+        
+        # Tiếp tục từ lần chạy trước: bỏ qua câu đã xong, dùng lại audio đã tổng hợp
+        if journal:
+            for job in jobs:
+                if journal.get(job["index"], job["input_hash"]) and audio_exists(job["final_path"]):
+                    job["done"] = True
+                    segments[job["index"]]["vi_audio_path"] = job["final_path"]
+                elif (journal.get(f"{job['index']}:tts", job["cache_key"])
+                      and os.path.exists(job["output_path"])):
+                    job["resumed"] = True
+            resumed = sum(1 for job in jobs if job.get("done") or job.get("resumed"))
+            if resumed:
+                print(f"♻️ Tiếp tục lần chạy trước: {resumed}/{len(jobs)} câu đã có audio")
+        
+        # Câu trùng nội dung chỉ tổng hợp một lần, câu đã có trong cache thì lấy ra
+        to_synthesize = []
+        first_job = {}
+        for job in jobs:
+            key = job["cache_key"]
+            if job.get("done"):
+                continue
+            if job.get("resumed"):
+                first_job.setdefault(key, job)
+            elif key in first_job:
+                job["duplicate_of"] = first_job[key]
+            elif cache and cache.fetch(key, job["output_path"]):
+                job["cached"] = True
+            else:
+                first_job[key] = job
+                to_synthesize.append(job)
+        
+        # 2. Generate TTS đồng thời trên một event loop, lưu tiến độ ngay khi từng câu xong
+        def on_done(job, error):
+            job["error"] = error
+            if error is None:
+                if cache:
+                    cache.store(job["cache_key"], job["output_path"])
+                if journal:
+                    journal.record(f"{job['index']}:tts", job["cache_key"], path=job["output_path"])
+        
+        asyncio.run(_synthesize_all(to_synthesize, backend, concurrency, timeout, retries, on_done))
+        
+        for job in jobs:
+            primary = job.get("duplicate_of")
+            if primary is None:
+                continue
+            job["error"] = primary["error"]
+            if job["error"] is None:
+                link_or_copy(primary["output_path"], job["output_path"])
+        
+        if cache:
+            stats = cache.stats()
+            print(f"💾 Cache audio: {stats['hits']} hit / {stats['misses']} miss "
+                  f"({stats['hit_rate']:.0%}), {stats['bytes'] / (1024*1024):.1f} MB")
+            record_cache(stats)
+        
+        # 3. Mix / di chuyển kết quả theo đúng thứ tự segment
+        for job in jobs:
+            if job.get("done"):
+                continue
+            error = job["error"]
+            i = job["index"]
+            seg = segments[i]
+            voice = job["voice"]
+            emotion = job["emotion"]
+            tts_temp = job["output_path"]
+            final_path = job["final_path"]
+            
+            if error is not None:
+                print(f"  ⚠️ Lỗi TTS câu {i+1}: {error!r}")
+                seg["vi_audio_path"] = None
+                continue
             
             try:
-                # 1. Lấy voice info
-                if auto_voice and "voice_gender" in seg:
-                    voice = seg["voice_gender"]
-                    rate = seg.get("tts_rate_adjust", "+0%")
-                    emotion = seg.get("voice_emotion", "neutral")
-                    
-                    # Điều chỉnh pitch theo emotion
-                    if emotion == "excited":
-                        pitch = "+8Hz"
-                        volume = "+5%"
-                    elif emotion == "calm":
-                        pitch = "-5Hz"
-                        volume = "-5%"
-                    elif emotion == "urgent":
-                        pitch = "+3Hz"
-                        volume = "+10%"
-                    else:
-                        pitch = "+0Hz"
-                        volume = "+0%"
-                else:
-                    voice = "female"
-                    rate = "+0%"
-                    pitch = "+0Hz"
-                    volume = "+0%"
-                    emotion = "neutral"
+                # Extract original segment để mix (trong bộ nhớ, không ghi file tạm)
+                orig_segment = None
+                if enable_mixing and source:
+                    try:
+                        orig_segment = source.segment(seg["start"], seg["end"])
+                    except Exception as e:
+                        print(f"  ⚠️ Lỗi extract segment: {e}")
                 
-                # 2. Generate TTS với cleaned text
-                tts_temp = os.path.join(temp_dir, f"{i:04d}_tts.mp3")
-                asyncio.run(_tts_with_ssml(
-                    cleaned_text,  # Dùng cleaned text
-                    tts_temp,
-                    voice,
-                    rate,
-                    pitch,
-                    volume
-                ))
+                if bank is not None:
+                    mixed = _render_to_bank(bank, f"{i:04d}", tts_temp, orig_segment)
+                else:
+                    mixed = _render_to_file(tts_temp, final_path, orig_segment)
                 
-                # 3. Mix với audio gốc nếu enabled
                 if enable_mixing:
-                    # Extract original segment
-                    orig_segment = os.path.join(temp_dir, f"{i:04d}_orig.wav")
-                    if extract_segment_audio(original_audio, seg["start"], seg["end"], orig_segment):
-                        # Mix
-                        if mix_audio_segments(orig_segment, tts_temp, final_path):
-                            print(f"  [{i+1}/{len(segments)}] 🎵 {voice.upper()} | "
-                                  f"{emotion} | MIXED")
-                        else:
-                            # Fallback: dùng TTS only
-                            os.rename(tts_temp, final_path)
-                            print(f"  [{i+1}/{len(segments)}] 🎤 {voice.UPPER()} | "
-                                  f"{emotion} | TTS only")
-                    else:
-                        os.rename(tts_temp, final_path)
+                    if orig_segment is not None:
+                        # Mix lỗi thì dùng TTS only
+                        print(f"  [{i+1}/{len(segments)}] {'🎵' if mixed else '🎤'} {voice.upper()} | "
+                              f"{emotion} | {'MIXED' if mixed else 'TTS only'}")
                 else:
-                    # Chỉ dùng TTS
-                    os.rename(tts_temp, final_path)
                     if auto_voice and "voice_gender" in seg:
                         print(f"  [{i+1}/{len(segments)}] 🎤 {voice.upper()} | "
-                              f"{emotion} | Rate: {rate}")
+                              f"{emotion} | Rate: {job['rate']}")
                     else:
                         print(f"  [{i+1}/{len(segments)}] ✅ {seg['vi_text'][:40]}...")
                 
                 seg["vi_audio_path"] = final_path
-                
+                if journal:
+                    journal.record(i, job["input_hash"], vi_audio_path=final_path)
+            
             except Exception as e:
                 print(f"  ⚠️ Lỗi TTS câu {i+1}: {e}")
                 seg["vi_audio_path"] = None
         
+        if source:
+            source.close()
+        if bank:
+            bank.flush()
+        if journal:
+            journal.close()
+        
         # Lưu lại
-        with open(segments_json, "w", encoding="utf-8") as f:
-            json.dump(segments, f, ensure_ascii=False, indent=2)
+        save_segments(segments_json, segments, fields=["vi_text_cleaned", "vi_audio_path"])
         
         # Cleanup temp
         try:
@@ -238,6 +537,7 @@ def tts_segments_advanced(segments_json, original_audio, out_dir, auto_voice=Tru
             pass
         
         print(f"✅ TTS hoàn tất. Audio lưu tại: {out_dir}")
+        record(segments=len(jobs), synthesized=len(to_synthesize))
         return True
         
     except Exception as e:
@@ -4,10 +4,13 @@ Các utility functions
 
 import os
 import json
+import hashlib
 from pathlib import Path
 from typing import Optional
 import subprocess
 
+from time_stretch import stretch_audio_segment
+
 
 def validate_video_file(video_path: str) -> bool:
     """
@@ -125,8 +128,11 @@ def save_checkpoint(checkpoint_file: str, step: str, data: dict = None):
         "data": data or {}
     }
     
-    with open(checkpoint_file, "w", encoding="utf-8") as f:
+    # Ghi qua file tạm để checkpoint không bị hỏng nếu dừng giữa lúc ghi
+    tmp_path = f"{checkpoint_file}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
         json.dump(checkpoint, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, checkpoint_file)
 
 
 def load_checkpoint(checkpoint_file: str) -> Optional[dict]:
@@ -166,7 +172,10 @@ def normalize_audio(audio_segment, target_dBFS=-20):
 
 def speed_change(audio_segment, speed=1.0):
     """
-    Thay đổi tốc độ audio (time-stretching)
+    Thay đổi tốc độ audio (time-stretching), giữ nguyên cao độ giọng
+    
+    Dùng phase vocoder trong time_stretch.py thay cho cách cũ (đổi
+    frame_rate rồi resample) vốn làm giọng cao/trầm theo tốc độ.
     
     Args:
         audio_segment: pydub AudioSegment
@@ -175,10 +184,70 @@ def speed_change(audio_segment, speed=1.0):
     Returns:
         AudioSegment với tốc độ mới
     """
-    # Thay đổi frame rate để tăng tốc
-    sound_with_altered_frame_rate = audio_segment._spawn(
-        audio_segment.raw_data,
-        overrides={"frame_rate": int(audio_segment.frame_rate * speed)}
-    )
-    # Convert về sample rate gốc
-    return sound_with_altered_frame_rate.set_frame_rate(audio_segment.frame_rate)
+    return stretch_audio_segment(audio_segment, speed)
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """
+    Tính SHA-256 nội dung file (đọc theo chunk, không load cả file vào RAM)
+    
+    Args:
+        path: Đường dẫn file
+        chunk_size: Kích thước mỗi lần đọc (bytes)
+    
+    Returns:
+        SHA-256 hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def merge_segment_fields(base_json, overlay_json, out_json, fields=None):
+    """
+    Ghép các field của segment từ overlay_json vào base_json
+    
+    Dùng khi hai bước chạy song song cùng bổ sung thông tin cho segments
+    (vd: dịch thêm vi_text, phân tích giọng thêm voice_*): mỗi bước ghi ra
+    file riêng rồi ghép lại, không bước nào ghi đè field của bước kia.
+    Segment được khớp theo "id" (nếu có) hoặc theo thứ tự.
+    
+    Args:
+        base_json: JSON segments gốc
+        overlay_json: JSON segments chứa field cần thêm (bỏ qua nếu không tồn tại)
+        out_json: JSON output (có thể trùng base_json)
+        fields: Các field lấy từ overlay (mặc định: các field base chưa có)
+    
+    Returns:
+        Số segment đã được bổ sung field
+    """
+    with open(base_json, encoding="utf-8") as f:
+        segments = json.load(f)
+    
+    merged = 0
+    if os.path.exists(overlay_json):
+        with open(overlay_json, encoding="utf-8") as f:
+            overlay = json.load(f)
+        by_id = {seg["id"]: seg for seg in overlay if "id" in seg}
+        
+        for i, seg in enumerate(segments):
+            if "id" in seg and seg["id"] in by_id:
+                extra = by_id[seg["id"]]
+            elif i < len(overlay):
+                extra = overlay[i]
+            else:
+                continue
+            keys = fields if fields is not None else [k for k in extra if k not in seg]
+            values = {k: extra[k] for k in keys if k in extra}
+            if values:
+                seg.update(values)
+                merged += 1
+    
+    # Ghi qua file tạm để bước khác không đọc phải file ghi dở
+    tmp_path = f"{out_json}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(segments, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, out_json)
+    return merged
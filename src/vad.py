@@ -0,0 +1,105 @@
+"""
+Energy VAD
+Tìm khoảng lặng bằng năng lượng từng frame (không cần model hay dịch vụ
+ngoài) để chia audio dài thành các đoạn cắt đúng chỗ không có tiếng nói
+
+Ngưỡng im lặng tự thích nghi theo từng file: noise floor (percentile thấp
+của năng lượng frame) cộng thêm margin_db, nhưng không vượt quá điểm giữa
+noise floor và mức tiếng nói (percentile cao) để file ít khoảng lặng không
+bị coi cả tiếng nói là im lặng.
+"""
+import numpy as np
+
+
+FRAME_MS = 30  # Độ dài mỗi frame năng lượng (ms)
+
+
+def frame_energy_db(y, sr, frame_ms=FRAME_MS):
+    """
+    Năng lượng RMS của từng frame không chồng lấp (dBFS)
+    
+    Args:
+        y: Mảng audio mono float32
+        sr: Sample rate
+        frame_ms: Độ dài frame (ms)
+    
+    Returns:
+        np.ndarray float64 (n_frames,), frame cuối bị thiếu được bỏ
+    """
+    frame = max(1, int(sr * frame_ms / 1000))
+    n_frames = len(y) // frame
+    if n_frames == 0:
+        return np.zeros(0)
+    frames = np.asarray(y[:n_frames * frame], dtype=np.float32).reshape(n_frames, frame)
+    power = np.einsum("ij,ij->i", frames, frames, dtype=np.float64) / frame
+    return 10.0 * np.log10(power + 1e-10)
+
+
+def silence_runs(energy_db, margin_db=8.0, min_frames=10, noise_percentile=5, speech_percentile=95):
+    """
+    Các đoạn frame im lặng liên tiếp đủ dài
+    
+    Args:
+        energy_db: Kết quả frame_energy_db
+        margin_db: Frame thấp hơn noise floor + margin_db được coi là im lặng
+        min_frames: Số frame tối thiểu của một khoảng lặng
+        noise_percentile: Percentile dùng làm noise floor
+        speech_percentile: Percentile dùng làm mức tiếng nói
+    
+    Returns:
+        List (f0, f1) frame đầu/cuối (không gồm f1) của từng khoảng lặng
+    """
+    if len(energy_db) == 0:
+        return []
+    noise, speech = np.percentile(energy_db, [noise_percentile, speech_percentile])
+    threshold = min(noise + margin_db, (noise + speech) / 2)
+    silent = np.concatenate(([False], energy_db < threshold, [False]))
+    edges = np.flatnonzero(np.diff(silent.astype(np.int8)))
+    starts, ends = edges[0::2], edges[1::2]
+    keep = (ends - starts) >= min_frames
+    return list(zip(starts[keep].tolist(), ends[keep].tolist()))
+
+
+def split_on_silence(y, sr, target_seconds=120, max_seconds=None, min_silence_ms=300, margin_db=8.0):
+    """
+    Chia audio thành các đoạn dài khoảng target_seconds, cắt giữa khoảng lặng
+    
+    Mỗi điểm cắt là giữa khoảng lặng gần target_seconds nhất trong
+    [target/2, max_seconds] tính từ điểm cắt trước. Không có khoảng lặng
+    nào thì cắt ở frame nhỏ tiếng nhất trong [target, max_seconds].
+    
+    Args:
+        y: Mảng audio mono float32
+        sr: Sample rate
+        target_seconds: Độ dài mong muốn mỗi đoạn
+        max_seconds: Độ dài tối đa mỗi đoạn (mặc định: 1.5 × target_seconds)
+        min_silence_ms: Khoảng lặng ngắn hơn bị bỏ qua
+        margin_db: Xem silence_runs
+    
+    Returns:
+        List (start, end) chỉ số sample, phủ kín [0, len(y))
+    """
+    max_seconds = max_seconds or target_seconds * 1.5
+    frame = max(1, int(sr * FRAME_MS / 1000))
+    energy = frame_energy_db(y, sr)
+    runs = silence_runs(energy, margin_db=margin_db, min_frames=max(1, min_silence_ms // FRAME_MS))
+    mids = np.array([(f0 + f1) // 2 for f0, f1 in runs], dtype=np.int64)
+    
+    target = int(target_seconds * 1000 / FRAME_MS)
+    longest = max(int(max_seconds * 1000 / FRAME_MS), target + 1)
+    n_frames = len(energy)
+    
+    cuts = []
+    pos = 0
+    while n_frames - pos > longest:
+        lo, hi = pos + target // 2, pos + longest
+        candidates = mids[(mids >= lo) & (mids <= hi)]
+        if len(candidates):
+            cut = int(candidates[np.argmin(np.abs(candidates - (pos + target)))])
+        else:
+            cut = pos + target + int(np.argmin(energy[pos + target:hi]))
+        cuts.append(cut)
+        pos = cut
+    
+    bounds = [0] + [cut * frame for cut in cuts] + [len(y)]
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if b > a]
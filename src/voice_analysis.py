@@ -2,40 +2,141 @@
 Voice Analysis Module
 Phân tích giọng nói để detect gender và emotion
 """
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import librosa
 import numpy as np
-import json
+import config
+from utils import file_sha256
+from extract_audio import AudioBuffer
+from segment_store import SegmentStore, load_segments, save_segments, segments_path
+from segment_table import SegmentTable
+from metrics import instrument, record
 
 
-def analyze_audio_segment(audio_path, start_time, end_time, sr=16000):
+DEFAULT_ANALYSIS = {"gender": "female", "emotion": "neutral", "pitch_avg": 180, "tts_rate_adjust": "0%"}
+
+# Các field do phân tích giọng nói thêm vào segment
+VOICE_FIELDS = ["voice_gender", "voice_emotion", "voice_pitch", "tts_rate_adjust"]
+
+# Tham số frame dùng chung cho piptrack, RMS và ZCR (mặc định của librosa)
+N_FFT = 2048
+HOP_LENGTH = 512
+
+# Thứ tự các hàng trong mảng đặc trưng theo frame
+FEATURE_PITCH, FEATURE_RMS, FEATURE_ZCR = range(3)
+N_FEATURES = 3
+
+# Mỗi worker cần ít nhất chừng này segments, ít hơn thì chạy tuần tự
+MIN_SEGMENTS_PER_WORKER = 16
+
+# Audio dùng chung trong worker process: (shared_memory, y, sr)
+_worker_audio = None
+
+
+def load_audio(audio_path, sr=16000):
     """
-    Phân tích một segment audio để detect gender và emotion
+    Decode toàn bộ file audio một lần thành mảng NumPy (mono, float32)
     
     Args:
-        audio_path: Đường dẫn file audio
-        start_time: Thời gian bắt đầu (giây)
-        end_time: Thời gian kết thúc (giây)
+        audio_path: Đường dẫn file audio hoặc AudioBuffer (dùng luôn, không decode)
+        sr: Sample rate
+    
+    Returns:
+        (y, sr)
+    """
+    if isinstance(audio_path, AudioBuffer):
+        y = audio_path.samples
+        if sr is not None and sr != audio_path.sample_rate:
+            y = librosa.resample(y, orig_sr=audio_path.sample_rate, target_sr=sr)
+        return y, sr or audio_path.sample_rate
+    return librosa.load(audio_path, sr=sr)
+
+
+def slice_segment(y, sr, start_time, end_time):
+    """
+    Cắt một segment theo chỉ số sample
+    
+    Tính chỉ số giống librosa.load(offset=..., duration=...) (cắt phần lẻ)
+    để kết quả trùng khớp với việc load riêng từng segment.
+    """
+    start = int(start_time * sr)
+    end = start + int((end_time - start_time) * sr)
+    return y[max(start, 0):max(end, 0)]
+
+
+def classify_voice(avg_pitch, pitch_std, energy, speech_rate):
+    """
+    Phân loại gender và emotion từ các đặc trưng của một segment
+    
+    Args:
+        avg_pitch: Pitch trung bình (Hz)
+        pitch_std: Độ lệch chuẩn pitch (Hz)
+        energy: RMS trung bình
+        speech_rate: Zero crossing rate trung bình
+    
+    Returns:
+        dict với gender và emotion info
+    """
+    # Gender classification
+    # Male: 85-180 Hz, Female: 165-255 Hz
+    if avg_pitch < 165:
+        gender = "male"
+    elif avg_pitch > 200:
+        gender = "female"
+    else:
+        # Ambiguous range, dùng pitch variance
+        gender = "male" if pitch_std < 25 else "female"
+    
+    # Emotion classification (simple)
+    if energy > 0.05 and pitch_std > 30:
+        emotion = "excited"
+        rate_adjust = "+15%"
+    elif energy < 0.02 and pitch_std < 15:
+        emotion = "calm"
+        rate_adjust = "-10%"
+    elif speech_rate > 0.15:
+        emotion = "urgent"
+        rate_adjust = "+20%"
+    else:
+        emotion = "neutral"
+        rate_adjust = "0%"
+    
+    return {
+        "gender": gender,
+        "emotion": emotion,
+        "pitch_avg": float(avg_pitch),
+        "pitch_std": float(pitch_std),
+        "energy": float(energy),
+        "speech_rate": float(speech_rate),
+        "tts_rate_adjust": rate_adjust
+    }
+
+
+def analyze_samples(y, sr=16000):
+    """
+    Phân tích gender và emotion từ mảng sample của một segment
+    
+    Args:
+        y: Mảng audio (mono, float32)
         sr: Sample rate
     
     Returns:
         dict với gender và emotion info
     """
     try:
-        # Load audio segment
-        y, sr = librosa.load(audio_path, sr=sr, offset=start_time, duration=end_time-start_time)
-        
         if len(y) == 0:
-            return {"gender": "female", "emotion": "neutral", "pitch_avg": 180}
+            return dict(DEFAULT_ANALYSIS)
         
         # 1. Phân tích pitch để detect gender
         pitches, magnitudes = librosa.piptrack(y=y, sr=sr, fmin=50, fmax=400)
         
-        pitch_values = []
-        for t in range(pitches.shape[1]):
-            index = magnitudes[:, t].argmax()
-            pitch = pitches[index, t]
-            if pitch > 0:
-                pitch_values.append(pitch)
+        # Chọn bin có magnitude lớn nhất cho mọi frame cùng lúc
+        index = magnitudes.argmax(axis=0)
+        frame_pitches = pitches[index, np.arange(pitches.shape[1])]
+        pitch_values = frame_pitches[frame_pitches > 0]
         
         if len(pitch_values) > 0:
             avg_pitch = np.mean(pitch_values)
@@ -44,16 +145,6 @@ def analyze_audio_segment(audio_path, start_time, end_time, sr=16000):
             avg_pitch = 180
             pitch_std = 20
         
-        # Gender classification
-        # Male: 85-180 Hz, Female: 165-255 Hz
-        if avg_pitch < 165:
-            gender = "male"
-        elif avg_pitch > 200:
-            gender = "female"
-        else:
-            # Ambiguous range, dùng pitch variance
-            gender = "male" if pitch_std < 25 else "female"
-        
         # 2. Phân tích emotion
         # Energy (volume)
         rms = librosa.feature.rms(y=y)[0]
@@ -63,57 +154,371 @@ def analyze_audio_segment(audio_path, start_time, end_time, sr=16000):
         zcr = librosa.feature.zero_crossing_rate(y)[0]
         speech_rate = np.mean(zcr)
         
-        # Emotion classification (simple)
-        if energy > 0.05 and pitch_std > 30:
-            emotion = "excited"
-            rate_adjust = "+15%"
-        elif energy < 0.02 and pitch_std < 15:
-            emotion = "calm"
-            rate_adjust = "-10%"
-        elif speech_rate > 0.15:
-            emotion = "urgent"
-            rate_adjust = "+20%"
-        else:
-            emotion = "neutral"
-            rate_adjust = "0%"
-        
-        return {
-            "gender": gender,
-            "emotion": emotion,
-            "pitch_avg": float(avg_pitch),
-            "pitch_std": float(pitch_std),
-            "energy": float(energy),
-            "speech_rate": float(speech_rate),
-            "tts_rate_adjust": rate_adjust
-        }
-        
+        return classify_voice(avg_pitch, pitch_std, energy, speech_rate)
+    
     except Exception as e:
         print(f"  ⚠️ Lỗi phân tích voice: {e}")
-        return {"gender": "female", "emotion": "neutral", "pitch_avg": 180, "tts_rate_adjust": "0%"}
+        return dict(DEFAULT_ANALYSIS)
 
 
-def analyze_all_segments(audio_path, segments_json):
+def analyze_audio_segment(audio_path, start_time, end_time, sr=16000):
+    """
+    Phân tích một segment audio để detect gender và emotion
+    
+    Chỉ decode đoạn cần thiết. Khi phân tích nhiều segment của cùng một
+    file, dùng load_audio + analyze_samples để chỉ decode một lần.
+    
+    Args:
+        audio_path: Đường dẫn file audio
+        start_time: Thời gian bắt đầu (giây)
+        end_time: Thời gian kết thúc (giây)
+        sr: Sample rate
+    
+    Returns:
+        dict với gender và emotion info
+    """
+    try:
+        # Load audio segment
+        y, sr = librosa.load(audio_path, sr=sr, offset=start_time, duration=end_time-start_time)
+    except Exception as e:
+        print(f"  ⚠️ Lỗi phân tích voice: {e}")
+        return dict(DEFAULT_ANALYSIS)
+    
+    return analyze_samples(y, sr)
+
+
+def _frame_features_chunk(y, sr, f0, f1):
+    """
+    Tính đặc trưng của các frame [f0, f1) trên cả file
+    
+    Chỉ pad phần biên cần thiết của khối nên kết quả giống hệt khi tính
+    trên cả file với center=True (piptrack/RMS pad 0, ZCR pad giá trị biên).
+    
+    Returns:
+        np.ndarray float32 shape (N_FEATURES, f1 - f0)
+    """
+    pad = N_FFT // 2
+    # Khoảng sample của khối trong tín hiệu đã pad → quy về chỉ số trong y
+    a = f0 * HOP_LENGTH - pad
+    b = (f1 - 1) * HOP_LENGTH + N_FFT - pad
+    chunk = y[max(a, 0):min(b, len(y))]
+    padding = (max(-a, 0), max(b - len(y), 0))
+    y_const = np.pad(chunk, padding, mode="constant")
+    y_edge = np.pad(chunk, padding, mode="edge")
+    
+    features = np.zeros((N_FEATURES, f1 - f0), dtype=np.float32)
+    pitches, magnitudes = librosa.piptrack(
+        y=y_const, sr=sr, n_fft=N_FFT, hop_length=HOP_LENGTH,
+        fmin=50, fmax=400, center=False
+    )
+    index = magnitudes.argmax(axis=0)
+    frames = np.arange(pitches.shape[1])
+    features[FEATURE_PITCH] = pitches[index, frames]
+    features[FEATURE_RMS] = librosa.feature.rms(
+        y=y_const, frame_length=N_FFT, hop_length=HOP_LENGTH, center=False
+    )[0]
+    features[FEATURE_ZCR] = librosa.feature.zero_crossing_rate(
+        y_edge, frame_length=N_FFT, hop_length=HOP_LENGTH, center=False
+    )[0]
+    return features
+
+
+def compute_frame_features(y, sr=16000, chunk_frames=4096, workers=1):
+    """
+    Tính đặc trưng theo frame cho toàn bộ file một lần
+    
+    Tính theo từng khối frame để bộ nhớ không phụ thuộc độ dài video;
+    mỗi frame giống hệt khi tính trên cả file với center=True.
+    
+    Args:
+        y: Mảng audio của cả file (mono, float32)
+        sr: Sample rate
+        chunk_frames: Số frame mỗi khối
+        workers: Số process tính song song các khối
+    
+    Returns:
+        np.ndarray float32 shape (N_FEATURES, n_frames): pitch, rms, zcr
+    """
+    n_frames = 1 + len(y) // HOP_LENGTH
+    ranges = [(f0, min(f0 + chunk_frames, n_frames)) for f0 in range(0, n_frames, chunk_frames)]
+    
+    if workers > 1 and len(ranges) > 1:
+        chunks = _map_shared_audio(y, sr, _features_task, ranges, min(workers, len(ranges)))
+    else:
+        chunks = [_frame_features_chunk(y, sr, f0, f1) for f0, f1 in ranges]
+    
+    return np.concatenate(chunks, axis=1)
+
+
+def feature_sidecar_path(audio_path, content_hash, sr=16000):
+    """Đường dẫn file .npy chứa đặc trưng frame, nằm cạnh file audio"""
+    stem, _ = os.path.splitext(audio_path)
+    # Số hàng đặc trưng nằm trong tên để sidecar có bố cục cũ không bị đọc nhầm
+    return f"{stem}.features-{content_hash[:16]}-sr{sr}-hop{HOP_LENGTH}-n{N_FEATURES}.npy"
+
+
+def load_frame_features(audio_path, sr=16000, workers=1):
+    """
+    Lấy đặc trưng frame của cả file, tính và lưu sidecar nếu chưa có
+    
+    Sidecar được đặt tên theo hash nội dung audio nên chỉ phải tính lại
+    khi audio thay đổi; phân tích lại sau khi đổi cách chia segment gần
+    như không tốn thời gian.
+    
+    AudioBuffer không kèm file WAV thì tính trực tiếp, không lưu sidecar.
+    
+    Returns:
+        np.ndarray (memory-mapped, chỉ đọc) shape (N_FEATURES, n_frames)
+    """
+    audio = audio_path
+    if isinstance(audio, AudioBuffer):
+        audio_path = audio.path
+        if audio_path is None:
+            print("   🧮 Đang tính đặc trưng frame cho cả file...")
+            y, sr = load_audio(audio, sr=sr)
+            return compute_frame_features(y, sr, workers=workers)
+    
+    sidecar = feature_sidecar_path(audio_path, file_sha256(audio_path), sr)
+    
+    if not os.path.exists(sidecar):
+        print("   🧮 Đang tính đặc trưng frame cho cả file...")
+        y, sr = load_audio(audio, sr=sr)
+        features = compute_frame_features(y, sr, workers=workers)
+        
+        # Xóa sidecar cũ của audio trước đó
+        stem, _ = os.path.splitext(audio_path)
+        for old in glob.glob(f"{glob.escape(stem)}.features-*.npy"):
+            os.remove(old)
+        
+        tmp_path = sidecar + ".tmp.npy"
+        np.save(tmp_path, features)
+        os.replace(tmp_path, sidecar)
+    else:
+        print(f"   ♻️ Dùng lại đặc trưng frame: {os.path.basename(sidecar)}")
+    
+    return np.load(sidecar, mmap_mode="r")
+
+
+def _as_table(segments):
+    """Nhận list dict segment hoặc SegmentTable"""
+    return segments if isinstance(segments, SegmentTable) else SegmentTable.from_segments(segments)
+
+
+def segment_frame_ranges(segments, sr=16000):
+    """
+    Khoảng frame [f0, f1) của từng segment (frame có tâm nằm trong segment)
+    
+    Args:
+        segments: List dict segment hoặc SegmentTable
+    
+    Returns:
+        (f0, f1) hai mảng int64
+    """
+    table = _as_table(segments)
+    f0 = np.ceil(table.start * sr / HOP_LENGTH).astype(np.int64)
+    f1 = np.floor(table.end * sr / HOP_LENGTH).astype(np.int64) + 1
+    return f0, np.maximum(f1, f0)
+
+
+def segment_stats(features, f0, f1):
+    """
+    Tính thống kê của mọi segment cùng lúc bằng tổng tích lũy
+    
+    Args:
+        features: Mảng (N_FEATURES, n_frames) từ compute_frame_features
+        f0, f1: Khoảng frame của từng segment
+    
+    Returns:
+        dict các mảng: avg_pitch, pitch_std, energy, speech_rate, n_frames
+    """
+    n_frames = features.shape[1]
+    f0 = np.clip(f0, 0, n_frames)
+    f1 = np.clip(f1, 0, n_frames)
+    
+    def window_sum(values):
+        csum = np.concatenate(([0.0], np.cumsum(values, dtype=np.float64)))
+        return csum[f1] - csum[f0]
+    
+    pitch = np.asarray(features[FEATURE_PITCH], dtype=np.float64)
+    voiced = pitch > 0
+    n = (f1 - f0).astype(np.float64)
+    n_voiced = window_sum(voiced)
+    sum_pitch = window_sum(np.where(voiced, pitch, 0.0))
+    sum_pitch_sq = window_sum(np.where(voiced, pitch * pitch, 0.0))
+    
+    with np.errstate(invalid="ignore", divide="ignore"):
+        avg_pitch = sum_pitch / n_voiced
+        pitch_std = np.sqrt(np.maximum(sum_pitch_sq / n_voiced - avg_pitch ** 2, 0.0))
+        energy = window_sum(features[FEATURE_RMS]) / n
+        speech_rate = window_sum(features[FEATURE_ZCR]) / n
+    
+    # Không có frame có pitch → giá trị mặc định như analyze_samples
+    avg_pitch = np.where(n_voiced > 0, avg_pitch, 180.0)
+    pitch_std = np.where(n_voiced > 0, pitch_std, 20.0)
+    
+    return {
+        "avg_pitch": avg_pitch,
+        "pitch_std": pitch_std,
+        "energy": energy,
+        "speech_rate": speech_rate,
+        "n_frames": f1 - f0
+    }
+
+
+def analyze_segments_precomputed(audio_path, segments, sr=16000, workers=1):
+    """
+    Phân tích tất cả segments từ đặc trưng frame tính sẵn cho cả file
+    
+    Returns:
+        List dict kết quả (cùng dạng analyze_samples), cùng thứ tự segments
+    """
+    features = load_frame_features(audio_path, sr, workers=workers)
+    f0, f1 = segment_frame_ranges(segments, sr)
+    stats = segment_stats(features, f0, f1)
+    
+    results = []
+    for k in range(len(segments)):
+        if stats["n_frames"][k] == 0:
+            results.append(dict(DEFAULT_ANALYSIS))
+            continue
+        results.append(classify_voice(
+            stats["avg_pitch"][k],
+            stats["pitch_std"][k],
+            stats["energy"][k],
+            stats["speech_rate"][k]
+        ))
+    return results
+
+
+def _init_worker(shm_name, length, sr):
+    """
+    Initializer của worker: map audio dùng chung, không copy
+    
+    Worker dùng chung resource tracker với process cha nên chỉ process
+    cha chịu trách nhiệm unlink.
+    """
+    global _worker_audio
+    shm = shared_memory.SharedMemory(name=shm_name)
+    y = np.ndarray((length,), dtype=np.float32, buffer=shm.buf)
+    _worker_audio = (shm, y, sr)
+
+
+def _analyze_spans(y, sr, spans):
+    """Phân tích các segment theo khoảng sample [start, end) (từ SegmentTable.sample_bounds)"""
+    return [analyze_samples(y[max(start, 0):max(end, 0)], sr) for start, end in spans]
+
+
+def _analyze_task(spans):
+    """Worker: phân tích một nhóm segment (start, end) liên tiếp"""
+    _, y, sr = _worker_audio
+    return _analyze_spans(y, sr, spans)
+
+
+def _features_task(frame_range):
+    """Worker: tính đặc trưng cho một khối frame"""
+    _, y, sr = _worker_audio
+    return _frame_features_chunk(y, sr, *frame_range)
+
+
+def _map_shared_audio(y, sr, func, tasks, workers):
+    """
+    Chạy func trên tasks bằng process pool, audio đặt trong shared memory
+    
+    Mảng audio chỉ được copy một lần vào shared memory; worker đọc trực
+    tiếp từ đó thay vì nhận bản pickle. Kết quả giữ đúng thứ tự tasks.
+    """
+    y = np.ascontiguousarray(y, dtype=np.float32)
+    shm = shared_memory.SharedMemory(create=True, size=max(y.nbytes, 1))
+    try:
+        view = np.ndarray(y.shape, dtype=np.float32, buffer=shm.buf)
+        view[:] = y
+        del view
+        
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(shm.name, len(y), sr)
+        ) as pool:
+            return list(pool.map(func, tasks))
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def analyze_samples_parallel(y, sr, segments, workers):
+    """
+    Phân tích các segments song song trên nhiều process
+    
+    Tự chạy tuần tự khi số segment quá ít để bù chi phí tạo process.
+    Khoảng sample của mọi segment được tính một lần (giống slice_segment).
+    
+    Args:
+        segments: List dict segment hoặc SegmentTable
+    
+    Returns:
+        List dict kết quả, cùng thứ tự segments
+    """
+    starts, ends = _as_table(segments).sample_bounds(sr)
+    spans = list(zip(starts.tolist(), ends.tolist()))
+    workers = min(workers, len(spans) // MIN_SEGMENTS_PER_WORKER)
+    
+    if workers <= 1:
+        return _analyze_spans(y, sr, spans)
+    
+    # Chia thành các nhóm liên tiếp, mỗi worker nhận vài nhóm để cân bằng tải
+    n_chunks = workers * 4
+    size = -(-len(spans) // n_chunks)
+    chunks = [spans[k:k + size] for k in range(0, len(spans), size)]
+    
+    results = []
+    for chunk_results in _map_shared_audio(y, sr, _analyze_task, chunks, workers):
+        results.extend(chunk_results)
+    return results
+
+
+@instrument("analyze")
+def analyze_all_segments(audio_path, segments_json, precompute=None, workers=None, out_json=None):
     """
     Phân tích tất cả segments và thêm voice info vào JSON
     
     Args:
-        audio_path: Đường dẫn audio gốc
-        segments_json: Đường dẫn file JSON chứa segments
+        audio_path: Đường dẫn audio gốc hoặc AudioBuffer đã decode sẵn
+        segments_json: Đường dẫn file JSON chứa segments hoặc SegmentStore
+        out_json: File/SegmentStore lưu kết quả (mặc định: ghi đè segments_json)
+        precompute: Tính đặc trưng frame một lần cho cả file và lưu sidecar
+                    (mặc định: config.VOICE_ANALYSIS_PRECOMPUTE)
+        workers: Số process phân tích song song (mặc định: config.VOICE_ANALYSIS_WORKERS)
     """
+    if precompute is None:
+        precompute = config.VOICE_ANALYSIS_PRECOMPUTE
+    if workers is None:
+        workers = config.VOICE_ANALYSIS_WORKERS
+    
     print("🎤 Đang phân tích giọng nói (gender & emotion)...")
     
     try:
-        # Load segments
-        with open(segments_json, encoding="utf-8") as f:
-            segments = json.load(f)
+        # Load segments (với store chỉ cần timing, kết quả chỉ cập nhật VOICE_FIELDS)
+        out_json = out_json or segments_json
+        if isinstance(out_json, SegmentStore) and out_json is segments_json:
+            # Đọc timing thẳng vào bảng, không tạo dict segment từ store;
+            # mỗi segment chỉ nhận dict VOICE_FIELDS để update_many
+            table = SegmentTable.load(segments_json)
+            segments = [{} for _ in range(len(table))]
+        else:
+            segments = load_segments(
+                segments_json, columns=["start", "end"] if isinstance(out_json, SegmentStore) else None
+            )
+            table = SegmentTable.from_segments(segments)
+        
+        if precompute:
+            analyses = analyze_segments_precomputed(audio_path, table, workers=workers)
+        else:
+            # Decode audio một lần, cắt từng segment theo chỉ số sample
+            y, sr = load_audio(audio_path)
+            analyses = analyze_samples_parallel(y, sr, table, workers)
         
         # Phân tích từng segment
-        for i, seg in enumerate(segments):
-            analysis = analyze_audio_segment(
-                audio_path,
-                seg["start"],
-                seg["end"]
-            )
+        for i, (seg, analysis) in enumerate(zip(segments, analyses)):
             
             # Thêm thông tin vào segment
             seg["voice_gender"] = analysis["gender"]
@@ -126,12 +531,12 @@ def analyze_all_segments(audio_path, segments_json):
                   f"Pitch: {seg['voice_pitch']:.0f}Hz")
         
         # Lưu lại
-        with open(segments_json, "w", encoding="utf-8") as f:
-            json.dump(segments, f, ensure_ascii=False, indent=2)
+        save_segments(out_json, segments, fields=VOICE_FIELDS)
         
-        print(f"✅ Phân tích hoàn tất. Thông tin lưu tại: {segments_json}")
+        print(f"✅ Phân tích hoàn tất. Thông tin lưu tại: {segments_path(out_json)}")
+        record(segments=len(segments), precompute=bool(precompute), workers=workers)
         return True
-        
+    
     except Exception as e:
         print(f"❌ Lỗi phân tích voice: {e}")
         return False